@@ -0,0 +1,324 @@
+"""asyncio front end of the baking service.
+
+Serves the routes of server.py with aiohttp on a single event loop.
+Submitting a job returns at once; parsing and cache lookups run in worker
+threads. Clients wait for state changes instead of polling:
+
+- GET /pullState/<jobId>?since=<version> answers as soon as the job
+  differs from the version of an earlier answer (long-poll), or after
+  timeout seconds at the latest
+- GET /events/<jobId> streams every change of the job as a Server-Sent
+  Event until it has finished
+
+A waiting client costs a coroutine, not a thread. Run with
+`python asyncserver.py`, the configuration is read like for server.py.
+"""
+import asyncio
+import json
+import math
+import multiprocessing
+import zlib
+from pathlib import Path
+
+from aiohttp import web
+
+from remote import cache
+from server import bakingMan, loadConfig, serverConfig, submitFile, \
+    submitUrl, submitDirect, removeResults, resultOf, filterJobs, jsonBody, \
+    BodyDecoder, bodyChunk, bodyError, parseBody, deletedJob
+from util import colorprint, default_out_dir
+
+corsHeaders = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'PUT, GET, POST, DELETE, OPTIONS',
+    'Access-Control-Allow-Headers':
+    'Origin, Accept, Content-Type, X-Requested-With, X-CSRF-Token'
+}
+
+routes = web.RouteTableDef()
+
+
+class JobWatcher(object):
+    """Wakes the coroutines waiting for changes of a job.
+
+    BakingMan reports changes from its worker threads, they are handed to
+    the event loop, which sets the event all waiters of the job share.
+    """
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.events = {}
+
+    def changed(self, jobId: str):
+        self.loop.call_soon_threadsafe(self.wake, jobId)
+
+    def wake(self, jobId: str):
+        event = self.events.pop(jobId, None)
+        if event is not None:
+            event.set()
+
+    def watch(self, jobId: str) -> asyncio.Event:
+        """Event set by the next change of the job; taken before reading
+        the job, so that no change in between is missed."""
+        return self.events.setdefault(jobId, asyncio.Event())
+
+    def forget(self, jobId: str):
+        # finished and unknown jobs do not change anymore, nobody waits
+        # for their events
+        self.events.pop(jobId, None)
+
+    async def wait(self, event: asyncio.Event, timeout: float) -> bool:
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+
+watcherKey = web.AppKey("watcher", JobWatcher)
+
+
+def dumps(result) -> str:
+    return json.dumps(result, sort_keys=True, separators=(',', ':'))
+
+
+def jsonResponse(request: web.Request, result, status=200) -> web.Response:
+    status, body, headers = jsonBody(result, request.headers, status)
+    return web.Response(status=status, body=body, headers=headers)
+
+
+async def inThread(function, *args):
+    return await asyncio.get_running_loop().run_in_executor(
+        None, function, *args)
+
+
+def jobState(jobId: str):
+    """The status of the job with its version, None once it is finished
+    (or unknown) and does not change anymore."""
+    job, version = bakingMan.getJobVersion(jobId)
+    if job is None:
+        return {"state": "undefined"}, None
+    job = dict(job)
+    job["version"] = version
+    return job, version
+
+
+@web.middleware
+async def cors(request: web.Request, handler):
+    if request.method == 'OPTIONS':
+        return web.Response(headers=corsHeaders)
+    response = await handler(request)
+    response.headers.update(corsHeaders)
+    return response
+
+
+async def postParams(request: web.Request):
+    """Parameters of a POST request and the hash of its body, like
+    server.extractPostParams; aiohttp already decompressed the body."""
+    if request.content_type.startswith('multipart/'):
+        return await request.post(), None
+
+    decoder = BodyDecoder(False)
+    async for chunk in request.content.iter_chunked(bodyChunk):
+        decoder.feed(chunk)
+    # parsing multi-MB bodies would block the event loop
+    jobSource = await inThread(parseBody, decoder.finish(),
+                               request.content_type)
+    return jobSource, decoder.digest()
+
+
+def fileResponse(root: Path, filename: str, headers=None) -> web.FileResponse:
+    # only files below root, like bottle.static_file
+    root = root.resolve()
+    path = (root / filename).resolve()
+    if root not in path.parents or not path.is_file():
+        raise web.HTTPNotFound()
+    return web.FileResponse(path, headers=headers)
+
+
+@routes.get('/bakeFile/{fileParam:.+}')
+async def bakeFile(request: web.Request):
+    return jsonResponse(
+        request, submitFile(request.match_info['fileParam'], request.query))
+
+
+@routes.post('/bakeUrl/')
+async def bakeUrl(request: web.Request):
+    try:
+        jobSource, _ = await postParams(request)
+    except (ValueError, zlib.error) as e:
+        return jsonResponse(request, *bodyError(e))
+    return jsonResponse(request, await inThread(submitUrl, jobSource))
+
+
+@routes.post('/bakeDirect/')
+async def bakeDirect(request: web.Request):
+    try:
+        jobSource, bodyDigest = await postParams(request)
+    except (ValueError, zlib.error) as e:
+        return jsonResponse(request, *bodyError(e))
+    return jsonResponse(request, await inThread(submitDirect, jobSource,
+                                                bodyDigest))
+
+
+def pollTimeout(query) -> float:
+    """Seconds a long-poll waits, the timeout query parameter bounded by
+    longPollTimeout."""
+    timeout = float(query.get('timeout', 30))
+    if not math.isfinite(timeout) or timeout < 0:
+        raise ValueError("timeout must be a non-negative number")
+    return min(timeout, serverConfig["longPollTimeout"])
+
+
+@routes.get('/pullState/{jobId}')
+async def pullState(request: web.Request):
+    jobId = request.match_info['jobId']
+    watcher = request.app[watcherKey]
+    try:
+        timeout = pollTimeout(request.query)
+    except ValueError as e:
+        return jsonResponse(request, {"error": str(e)}, 400)
+    result, version = jobState(jobId)
+
+    since = request.query.get('since')
+    if since is not None and version is not None and str(version) == since:
+        # read again after taking the event, the job may have changed
+        event = watcher.watch(jobId)
+        result, version = jobState(jobId)
+        if version is None:
+            watcher.forget(jobId)
+        elif str(version) == since:
+            if await watcher.wait(event, timeout):
+                result, version = jobState(jobId)
+    return jsonResponse(request, result)
+
+
+@routes.get('/getResult/{jobId}')
+async def getResult(request: web.Request):
+    # finished jobs are read back from disk
+    result = await inThread(resultOf, request.match_info['jobId'])
+    status = 200 if "error" not in result else 404
+    return jsonResponse(request, result, status)
+
+
+@routes.get('/events/{jobId}')
+async def events(request: web.Request):
+    jobId = request.match_info['jobId']
+    watcher = request.app[watcherKey]
+    response = web.StreamResponse(headers={
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache'
+    })
+    response.headers.update(corsHeaders)
+    await response.prepare(request)
+
+    sent = None
+    while True:
+        event = watcher.watch(jobId)
+        result, version = jobState(jobId)
+        if version is None or version != sent:
+            await response.write('event: state\ndata: {}\n\n'.format(
+                dumps(result)).encode('utf-8'))
+            sent = version
+        if version is None:
+            watcher.forget(jobId)
+            break
+        # comments keep proxies from closing idle streams
+        if not await watcher.wait(event, serverConfig["longPollTimeout"]):
+            await response.write(b': keep-alive\n\n')
+    await response.write_eof()
+    return response
+
+
+def jobsPage(query, requestHeaders):
+    """jsonBody of the page of jobs selected by the query, with the number
+    of selected jobs in X-Total-Count."""
+    try:
+        page, total = filterJobs(bakingMan.getAllJobs(), query)
+    except ValueError as e:
+        return jsonBody({"error": str(e)}, requestHeaders, 400)
+    status, body, headers = jsonBody(page, requestHeaders)
+    headers['X-Total-Count'] = str(total)
+    return status, body, headers
+
+
+@routes.get('/pullAll/')
+async def pullAll(request: web.Request):
+    # copying, filtering and encoding thousands of jobs would block the
+    # event loop
+    status, body, headers = await inThread(jobsPage, request.query,
+                                           request.headers)
+    return web.Response(status=status, body=body, headers=headers)
+
+
+@routes.delete('/job/{jobId}')
+async def deleteJob(request: web.Request):
+    jobId = request.match_info['jobId']
+    colorprint("deleteJob id {}".format(jobId), 33)
+    return jsonResponse(request, *await inThread(deletedJob, jobId))
+
+
+@routes.get('/getImage/{jobId}')
+async def getImage(request: web.Request):
+    jobId = request.match_info['jobId']
+    job = bakingMan.getJobStatus(jobId)
+    fileName = None
+    if job is not None and job["state"] == "finished":
+        fileName = job["urlAoMapImage"]
+    elif job is not None and request.query.get("partial") == "1":
+        fileName = job.get("urlAoMapPartial")
+
+    if fileName is None:
+        return jsonResponse(request,
+                            {"error": "no image for jobId {}".format(jobId)},
+                            404)
+    return fileResponse(default_out_dir, fileName,
+                        {'Cache-Control': 'no-cache'})
+
+
+@routes.get('/getFile/{filename:.+}')
+async def getFile(request: web.Request):
+    filename = request.match_info['filename']
+    colorprint("getFile " + filename, 33)
+    disposition = 'attachment; filename="{}"'.format(Path(filename).name)
+    return fileResponse(default_out_dir, filename,
+                        {'Content-Disposition': disposition})
+
+
+@routes.get('/cacheStats/')
+async def cacheStats(request: web.Request):
+    return jsonResponse(request, cache.metrics())
+
+
+@routes.get('/removeResults/')
+async def removeResultsRoute(request: web.Request):
+    await inThread(removeResults)
+    return web.Response()
+
+
+async def watchJobs(app: web.Application):
+    app[watcherKey] = JobWatcher(asyncio.get_running_loop())
+    bakingMan.addListener(app[watcherKey].changed)
+    yield
+    bakingMan.removeListener(app[watcherKey].changed)
+
+
+def makeApp() -> web.Application:
+    app = web.Application(middlewares=[cors],
+                          client_max_size=serverConfig["maxRequestSize"])
+    app.add_routes(routes)
+    app.cleanup_ctx.append(watchJobs)
+    return app
+
+
+if __name__ == '__main__':
+    # baking runs in spawned processes, which must not start the server
+    multiprocessing.freeze_support()
+    loadConfig()
+    bakingMan.start()
+
+    try:
+        web.run_app(makeApp(),
+                    host=serverConfig["host"],
+                    port=serverConfig["port"])
+    finally:
+        bakingMan.stop()
@@ -1,106 +1,532 @@
+import heapq
+import itertools
+import multiprocessing
+import os
 import threading
 import json
+import time
 
-from collections import namedtuple
-from time import sleep
+from collections import namedtuple, OrderedDict
+try:
+    import resource
+except ImportError:
+    # not available on Windows, jobMemory has no effect there
+    resource = None
 from typing import List
-from service import startWithDirectArgs
-from util import colorprint
+from jobstore import JobStore
+from service import startWithDirectArgs, aoConfig, BakeCancelled
+from remote import remoteConfig, configureCache, atomicWrite, cache
+from util import colorprint, default_out_dir
 
-BakingJob = namedtuple('BakingJob', ['jobId', 'jobArgs', "state"])
+# progress and urlAoMapPartial are reported by running jobs
+BakingJob = namedtuple(
+    'BakingJob', ['jobId', 'jobArgs', "state", "progress", "urlAoMapPartial"],
+    defaults=(0.0, None))
 
+# workers: number of jobs baked concurrently, each in its own process
+# threads: baking threads per job, 0 splits the cores evenly among workers
+# resultTTL, maxResults: age in seconds and number of finished jobs kept
+# persistJobs: keep jobs in out/jobs/jobs.sqlite, queued and interrupted jobs
+#   are baked after a restart
+# jobTimeout: seconds a job may run before its process is killed, 0 for none
+# jobMemory: address space of a baking process in MB, 0 for no limit
+# cancelGrace: seconds a cancelled job has to stop after its current tile
+#   before its process is killed
+bakingConfig = {
+    "workers": 1,
+    "threads": 0,
+    "resultTTL": 24 * 60 * 60,
+    "maxResults": 10000,
+    "persistJobs": True,
+    "jobTimeout": 0,
+    "jobMemory": 0,
+    "cancelGrace": 10.0
+}
 
-class BakingMan(threading.Thread):
-    def __init__(self):
-        super().__init__()
-        self.isProcessRunning = False
+
+def runInProcess(jobId, args, config, connection, cancelled):
+    # entry point of the worker process, which does not share the
+    # configuration of the server process
+    aoConfig.update(config["aoConfig"])
+    remoteConfig.update(config["remoteConfig"])
+    configureCache()
+
+    memory = config["bakingConfig"]["jobMemory"]
+    if memory and resource is not None:
+        limit = memory * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+    def progress(fraction, urlPartial):
+        # checked between tiles, a cancelled job stops at the next one
+        if cancelled.is_set():
+            raise BakeCancelled()
+        update = {"progress": fraction}
+        if urlPartial is not None:
+            update["urlAoMapPartial"] = urlPartial
+        connection.send(("progress", update))
+
+    try:
+        output = startWithDirectArgs(args, progress)
+    except BakeCancelled:
+        colorprint("Cancelled jobId {}".format(jobId), 33)
+        output = {"error": "cancelled", "cancelled": True}
+    except FileNotFoundError as e:
+        colorprint("File not found for jobId {}".format(jobId), 31)
+        print(e)
+        output = {"error": "file not found ({})".format(e)}
+    except json.decoder.JSONDecodeError as e:
+        colorprint("JSON not valid for jobId {}".format(jobId), 31)
+        print(e)
+        output = {"error": "JSON not valid ({})".format(e)}
+    except MemoryError:
+        colorprint("Out of memory for jobId {}".format(jobId), 31)
+        output = {
+            "error": "out of memory (limit {} MB)".format(
+                config["bakingConfig"]["jobMemory"])
+        }
+    except Exception as e:
+        colorprint("Exception for jobId {}".format(jobId), 31)
+        print(e)
+        output = {"error": "exception during baking ({})".format(e)}
+
+    # counters and accesses of this process go into the shared cache index
+    cache.flush()
+    connection.send(("result", output))
+    connection.close()
+
+
+class ResultStore(object):
+    """Finished job records, bounded by age and count.
+
+    Only a summary of every record stays in memory, the heavy fields are
+    spilled to one JSON file per job and loaded again on request.
+    """
+    heavyFields = ("jobArgs", "transforms", "igxcModified")
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not self.directory.exists():
+            self.directory.mkdir(parents=True)
+        self.summaries = OrderedDict()
+        # key of the submission -> jobId of its successful result
+        self.keys = {}
+        self.jobKeys = {}
+
+    def path(self, jobId: str):
+        return self.directory / (jobId + '.json')
+
+    def spill(self, result: dict) -> dict:
+        """Writes the heavy fields to disk and returns the summary."""
+        heavy = {k: v for k, v in result.items() if k in self.heavyFields}
+        atomicWrite(self.path(result["jobId"]),
+                    json.dumps(heavy).encode('utf-8'))
+        return {k: v for k, v in result.items() if k not in self.heavyFields}
+
+    def add(self, summary: dict, key=None) -> list:
+        """Adds a summary and returns the jobIds of expired ones."""
+        self.summaries[summary["jobId"]] = summary
+        if key is not None and summary["state"] == "finished":
+            self.keys[key] = summary["jobId"]
+            self.jobKeys[summary["jobId"]] = key
+        return self.expire()
+
+    def find(self, key) -> str:
+        return self.keys.get(key)
+
+    def complete(self, summary: dict) -> dict:
+        """The record of a summary with the heavy fields read back."""
+        if summary is None:
+            return None
+        jobId = summary["jobId"]
+        try:
+            with self.path(jobId).open('r') as f:
+                heavy = json.load(f)
+        except FileNotFoundError:
+            heavy = {}
+        result = dict(summary)
+        result.update(heavy)
+        return result
+
+    def expire(self) -> list:
+        # summaries are ordered by finishing time
+        deadline = time.time() - bakingConfig["resultTTL"]
+        expired = []
+        while len(self.summaries) > 0:
+            jobId, summary = next(iter(self.summaries.items()))
+            if len(self.summaries) <= bakingConfig["maxResults"] and \
+                    summary["timeFinished"] >= deadline:
+                break
+            del self.summaries[jobId]
+            key = self.jobKeys.pop(jobId, None)
+            if key is not None and self.keys.get(key) == jobId:
+                del self.keys[key]
+            expired.append(jobId)
+            try:
+                self.path(jobId).unlink()
+            except FileNotFoundError:
+                pass
+        return expired
+
+    def __contains__(self, jobId: str) -> bool:
+        return jobId in self.summaries
+
+    def __len__(self) -> int:
+        return len(self.summaries)
+
+
+class BakingMan(object):
+    def __init__(self, workers=None):
+        self.workers = workers
         self.currentId = 0
-        self.queue: List[BakingJob] = []
-        self.currentJob = None
-        self.results: List[BakingJob] = []
+        self.queue = []
+        self.sequence = itertools.count()
+        self.jobs = {}
+        self.times = {}
+        self.pendingKeys = {}
+        self.jobKeys = {}
+        self.cancelEvents = {}
+        # baking processes of running jobs, and the outputs recorded for
+        # those that are killed (None while stopping, they are not finished)
+        self.processes = {}
+        self.kills = {}
+        # changes of queued and running jobs, for clients waiting on them
+        self.versions = {}
+        self.listeners = []
+        self.results = ResultStore(default_out_dir / 'jobs')
+        self.store = None
+        self.condition = threading.Condition()
+        self.threads: List[threading.Thread] = []
         self.running = False
+        self.context = multiprocessing.get_context('spawn')
+
+    def addJob(self, args, priority=0, key=None):
+        # lower priority values are baked first, FIFO among equal values;
+        # a job with the key of a queued or running job is attached to it
+        with self.condition:
+            if key is not None and key in self.pendingKeys:
+                jobId = self.pendingKeys[key]
+                colorprint(
+                    "Attaching request to pending jobId {}".format(jobId), 32)
+                return int(jobId)
+
+            jobId = self.getUniqueId()
+            timeCreated = time.time()
+            sequence = next(self.sequence)
+            self.queueJob(jobId, args, priority, sequence, key, timeCreated)
+            if self.store is not None:
+                self.store.add(jobId, key, priority, sequence, args,
+                               timeCreated)
+            self.condition.notify()
+        self.notifyListeners(jobId)
+        return int(jobId)
+
+    def queueJob(self, jobId, args, priority, sequence, key, timeCreated):
+        self.jobs[jobId] = BakingJob(jobId, args, "pending")
+        self.times[jobId] = {"timeCreated": timeCreated}
+        heapq.heappush(self.queue, (priority, sequence, jobId))
+        if key is not None:
+            self.pendingKeys[key] = jobId
+            self.jobKeys[jobId] = key
+        self.versions[jobId] = 0
+
+    def addFinishedJob(self, args, output, key=None):
+        # register an already available result without baking; with the
+        # key of a kept successful result, that job is returned instead
+        with self.condition:
+            jobId = self.results.find(key) if key is not None else None
+            if jobId is not None:
+                return int(jobId)
+            jobId = self.getUniqueId()
+            self.times[jobId] = {"timeCreated": time.time()}
+            if key is not None:
+                self.jobKeys[jobId] = key
+        self.finishJob(
+            self.makeResult(BakingJob(jobId, args, "pending"), output))
+        return int(jobId)
+
+    def finishJob(self, result: dict):
+        jobId = result["jobId"]
+        with self.condition:
+            result.update(self.times.pop(jobId, {}))
+        result["timeFinished"] = time.time()
+
+        # write the heavy fields without blocking state queries
+        summary = self.results.spill(result)
+        with self.condition:
+            self.jobs.pop(jobId, None)
+            key = self.jobKeys.pop(jobId, None)
+            if self.pendingKeys.get(key) == jobId:
+                del self.pendingKeys[key]
+            expired = self.results.add(summary, key)
+            self.versions.pop(jobId, None)
+            if self.store is not None:
+                self.store.finished(jobId, key, summary)
+                self.store.remove(expired)
+        self.notifyListeners(jobId)
+
+    def updateJob(self, jobId: str, **fields):
+        with self.condition:
+            if jobId not in self.jobs:
+                return
+            self.jobs[jobId] = self.jobs[jobId]._replace(**fields)
+            self.versions[jobId] += 1
+        self.notifyListeners(jobId)
+
+    def addListener(self, listener):
+        """listener(jobId) is called after every change of a job, from the
+        thread making the change."""
+        with self.condition:
+            self.listeners.append(listener)
+
+    def removeListener(self, listener):
+        with self.condition:
+            self.listeners.remove(listener)
+
+    def notifyListeners(self, jobId: str):
+        with self.condition:
+            listeners = list(self.listeners)
+        for listener in listeners:
+            listener(jobId)
+
+    def cancelJob(self, jobId: str) -> bool:
+        """Removes a queued job or stops a running one after its current
+        tile, its process is killed if that takes longer than cancelGrace;
+        returns False for unknown and finished jobs."""
+        with self.condition:
+            job = self.jobs.get(jobId)
+            if job is None:
+                return False
+            if job.state == "running":
+                self.cancelEvents[jobId].set()
+                return True
+            queue = [entry for entry in self.queue if entry[2] != jobId]
+            if len(queue) == len(self.queue):
+                # already taken out by a concurrent cancelJob finishing it
+                return False
+            self.queue = queue
+            heapq.heapify(self.queue)
+        self.finishJob(self.makeResult(job, {"error": "cancelled",
+                                             "cancelled": True}))
+        return True
+
+    def resume(self):
+        """Restores the jobs of the store: results are kept again, queued
+        jobs and those interrupted while running are queued again."""
+        jobs = self.store.load()
+        finished = sorted((job for job in jobs if job["summary"] is not None),
+                          key=lambda job: job["summary"]["timeFinished"])
+        with self.condition:
+            for job in finished:
+                self.store.remove(self.results.add(job["summary"], job["key"]))
+            queued = 0
+            for job in jobs:
+                if job["summary"] is None and job["args"] is not None:
+                    self.queueJob(job["jobId"], job["args"], job["priority"],
+                                  job["sequence"], job["key"],
+                                  job["timeCreated"])
+                    queued += 1
+            if len(jobs) > 0:
+                self.currentId = max(self.currentId,
+                                     max(int(job["jobId"]) for job in jobs))
+                self.sequence = itertools.count(
+                    max(job["sequence"] or 0 for job in jobs) + 1)
+        colorprint(
+            "Resuming {} queued jobs and {} results".format(
+                queued, len(self.results)), 32)
 
-    def addJob(self, args):
-        self.getUniqueId()
-        newJob = BakingJob(str(self.currentId), args, "pending")
-        self.queue.append(newJob)
-        return self.currentId
+    def start(self):
+        if bakingConfig["persistJobs"] and self.store is None:
+            self.store = JobStore(self.results.directory / 'jobs.sqlite')
+            self.resume()
+
+        workers = self.workers or bakingConfig["workers"]
+        threads = bakingConfig["threads"] or max(
+            1, (os.cpu_count() or 1) // workers)
+        colorprint(
+            "Starting {} baking workers with {} threads each".format(
+                workers, threads), 32)
+
+        self.running = True
+        for i in range(workers):
+            worker = threading.Thread(target=self.run,
+                                      args=(threads, ),
+                                      name="BakingWorker-{}".format(i),
+                                      daemon=True)
+            worker.start()
+            self.threads.append(worker)
 
     def stop(self, blocking=True):
-        self.running = False
+        # running bakes are killed, not finished
+        with self.condition:
+            self.running = False
+            for jobId in list(self.processes):
+                self.kill(jobId, None)
+            self.condition.notify_all()
         if blocking:
-            self.join()
+            for worker in self.threads:
+                worker.join()
+        # jobs still running are queued again by the next start
+        if self.store is not None:
+            self.store.close()
+            self.store = None
 
-    def run(self):
-        self.running = True
-        while self.running:
-            if not self.isProcessRunning:
-                if len(self.queue) > 0:
-                    BakingMan.isProcessRunning = True
-                    self.currentJob = self.queue.pop(0)
-                    try:
-                        self.runJob()
-                    except FileNotFoundError as e:
-                        BakingMan.isProcessRunning = False
-                        colorprint(
-                            "File not found for jobId {}".format(
-                                self.currentJob.jobId), 31)
-                        self.currentJob = None
-                        print(e)
-                    except json.decoder.JSONDecodeError as e:
-                        BakingMan.isProcessRunning = False
-                        colorprint(
-                            "JSON not valid for jobId {}".format(
-                                self.currentJob.jobId), 31)
-                        self.currentJob = None
-                        print(e)
-                    except Exception as e:
-                        BakingMan.isProcessRunning = False
-                        colorprint(
-                            "Exception for jobId {}".format(
-                                self.currentJob.jobId), 31)
-                        self.currentJob = None
-                        print(e)
-
-                else:
-                    sleep(0.5)
-
-    def runJob(self):
-        colorprint(
-            "Starting runJob with jobId {}".format(self.currentJob.jobId), 32)
+    def run(self, threads):
+        while True:
+            with self.condition:
+                while self.running and len(self.queue) == 0:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                _, _, jobId = heapq.heappop(self.queue)
+                job = self.jobs[jobId]._replace(state="running")
+                self.jobs[jobId] = job
+                self.times[jobId]["timeStarted"] = time.time()
+                self.versions[jobId] += 1
+                self.cancelEvents[jobId] = self.context.Event()
+                if self.store is not None:
+                    self.store.started(jobId)
+            self.notifyListeners(jobId)
+
+            self.runJob(job, threads)
+
+    def runJob(self, job: BakingJob, threads: int):
+        colorprint("Starting runJob with jobId {}".format(job.jobId), 32)
 
-        self.currentJob = self.currentJob._replace(state="running")
-        output = startWithDirectArgs(self.currentJob.jobArgs)
+        args = dict(job.jobArgs)
+        args.setdefault("threads", threads)
 
+        config = {
+            "aoConfig": aoConfig,
+            "remoteConfig": remoteConfig,
+            "bakingConfig": bakingConfig
+        }
+
+        receiver, sender = self.context.Pipe(duplex=False)
+        with self.condition:
+            cancelled = self.cancelEvents[job.jobId]
+        process = self.context.Process(target=runInProcess,
+                                       args=(job.jobId, args, config, sender,
+                                             cancelled),
+                                       daemon=True)
+        process.start()
+        sender.close()
+        with self.condition:
+            self.processes[job.jobId] = process
+            if not self.running:
+                self.kill(job.jobId, None)
+
+        timeout = bakingConfig["jobTimeout"]
+        deadline = time.monotonic() + timeout if timeout else None
+        cancelDeadline = None
+        output = None
+        try:
+            # progress updates until the result arrives, checking the limits
+            # of the job every second
+            while output is None:
+                if receiver.poll(1.0):
+                    kind, payload = receiver.recv()
+                    if kind == "result":
+                        output = payload
+                    else:
+                        self.updateJob(job.jobId, **payload)
+                    continue
+
+                now = time.monotonic()
+                if cancelled.is_set() and cancelDeadline is None:
+                    cancelDeadline = now + bakingConfig["cancelGrace"]
+                if cancelDeadline is not None and now > cancelDeadline:
+                    self.kill(job.jobId, {
+                        "error": "cancelled",
+                        "cancelled": True
+                    })
+                elif deadline is not None and now > deadline:
+                    self.kill(job.jobId, {
+                        "error":
+                        "timed out after {} seconds".format(timeout)
+                    })
+        except EOFError:
+            output = {
+                "error":
+                "baking process exited with code {}".format(process.exitcode)
+            }
+        except Exception as e:
+            # an unreadable message or a broken pipe, the process may still
+            # run and is killed so that the job finishes
+            process.kill()
+            output = {"error": "lost the baking process: {!r}".format(e)}
+        finally:
+            receiver.close()
+            process.join()
+            with self.condition:
+                del self.cancelEvents[job.jobId]
+                del self.processes[job.jobId]
+                killed = job.jobId in self.kills
+                killOutput = self.kills.pop(job.jobId, None)
+
+        if killed and "urlAoMapImage" not in output:
+            if killOutput is None:
+                # stopping, the job is baked again by the next start
+                colorprint("Stopped runJob with jobId {}".format(job.jobId),
+                           33)
+                return None
+            output = killOutput
+
+        result = self.makeResult(job, output)
+        if result["state"] == "cancelled":
+            colorprint("Cancelled runJob with jobId {}".format(job.jobId), 33)
+        elif result["state"] == "error":
+            colorprint("Error in startWithDirectArgs", 31)
+        else:
+            colorprint("Finished runJob with jobId {}".format(job.jobId), 32)
+
+        self.finishJob(result)
+        return result
+
+    def kill(self, jobId: str, output):
+        """Kills the baking process of a running job, which then finishes
+        with output, or not at all for None."""
+        with self.condition:
+            process = self.processes.get(jobId)
+            if process is None or jobId in self.kills:
+                return
+            colorprint("Killing the baking process of jobId {}".format(jobId),
+                       31)
+            self.kills[jobId] = output
+            process.kill()
+
+    def makeResult(self, job: BakingJob, output: dict) -> dict:
         result = {}
-        if "error" in output and output["error"] is not None:
+        if output.get("cancelled"):
             result = {
-                "jobId": self.currentJob.jobId,
-                "jobArgs": self.currentJob.jobArgs,
+                "jobId": job.jobId,
+                "jobArgs": job.jobArgs,
+                "state": "cancelled"
+            }
+
+        elif "error" in output and output["error"] is not None:
+            result = {
+                "jobId": job.jobId,
+                "jobArgs": job.jobArgs,
                 "state": "error",
                 "error": output["error"]
             }
-            colorprint("Error in startWithDirectArgs", 31)
 
         else:
             result = {
-                "jobId": self.currentJob.jobId,
-                "jobArgs": self.currentJob.jobArgs,
+                "jobId": job.jobId,
+                "jobArgs": job.jobArgs,
                 "urlAoMapImage": output["urlAoMapImage"],
                 "urlAoMappingJson": output["urlAoMappingJson"],
                 "urlIgxcModified": output["urlIgxcModified"],
                 "urlIgxcOriginal": output["urlIgxcOriginal"],
+                "urlAoMapMips": output.get("urlAoMapMips", []),
                 "transforms": output["transforms"],
                 "state": "finished",
+                "progress": 1.0,
+                "quality": output.get("quality"),
+                "raysPerTexel": output.get("raysPerTexel"),
                 "igxcModified": output["igxcModified"]
             }
-            colorprint(
-                "Finished runJob with jobId {}".format(self.currentJob.jobId),
-                32)
-
-        self.results.append(result)
-        self.isProcessRunning = False
-        self.currentJob = None
         return result
 
     def getUniqueId(self) -> str:
@@ -108,48 +534,58 @@ class BakingMan(threading.Thread):
         return str(self.currentId)
 
     def hasQueuedJob(self, jobId: str) -> bool:
-        for entry in self.queue:
-            if entry.jobId == jobId:
-                return True
-        return False
+        with self.condition:
+            job = self.jobs.get(jobId)
+            return job is not None and job.state == "pending"
 
     def isJobFinished(self, jobId: str) -> bool:
-        if self.hasJob(jobId):
-            for entry in self.results:
-                if entry["jobId"] == jobId:
-                    return True
-        return False
+        with self.condition:
+            return jobId in self.results
 
     def hasJob(self, jobId: str) -> bool:
-        if self.currentJob != None and self.currentJob.jobId == jobId:
-            return True
+        with self.condition:
+            return jobId in self.jobs or jobId in self.results
 
-        for entry in self.results:
-            if entry["jobId"] == jobId:
-                return True
+    def getJob(self, jobId: str) -> BakingJob:
+        with self.condition:
+            if jobId in self.jobs:
+                return self.jobs[jobId]._asdict()
+            summary = self.results.summaries.get(jobId)
+        # read the heavy fields without blocking state queries
+        return self.results.complete(summary)
 
-        for entry in self.queue:
-            if entry.jobId == jobId:
-                return True
-        return False
+    def statusOf(self, job: BakingJob) -> dict:
+        # queued and running jobs without the heavy fields, like the
+        # summaries of finished ones
+        status = job._asdict()
+        del status["jobArgs"]
+        status.update(self.times.get(job.jobId, {}))
+        return status
 
-    def getJob(self, jobId: str) -> BakingJob:
-        if self.currentJob != None and self.currentJob.jobId == jobId:
-            return self.currentJob._asdict()
-
-        for entry in self.results:
-            if entry["jobId"] == jobId:
-                return entry
-
-        for entry in self.queue:
-            if entry.jobId == jobId:
-                return entry._asdict()
-        return None
-
-    def getAllJobs(self) -> List[BakingJob]:
-        allJobs = self.results[:]
-        for entry in self.queue:
-            allJobs.append(json.loads(json.dumps(entry._asdict())))
-        if self.currentJob != None:
-            allJobs.append(json.loads(json.dumps(self.currentJob._asdict())))
+    def getJobStatus(self, jobId: str) -> dict:
+        """State, progress, times and result URLs of a job; the heavy
+        fields of finished jobs are only returned by getJob."""
+        with self.condition:
+            if jobId in self.jobs:
+                return self.statusOf(self.jobs[jobId])
+            summary = self.results.summaries.get(jobId)
+            return dict(summary) if summary is not None else None
+
+    def getJobVersion(self, jobId: str):
+        """The status of the job and its change count, None for finished
+        jobs, which do not change anymore."""
+        with self.condition:
+            return self.getJobStatus(jobId), self.versions.get(jobId)
+
+    def getAllJobs(self) -> List[dict]:
+        # statuses of finished, queued and running jobs, in that order
+        with self.condition:
+            allJobs = [
+                dict(entry) for entry in self.results.summaries.values()
+            ]
+            for _, _, jobId in sorted(self.queue):
+                allJobs.append(self.statusOf(self.jobs[jobId]))
+            for entry in self.jobs.values():
+                if entry.state == "running":
+                    allJobs.append(self.statusOf(entry))
         return allJobs
@@ -0,0 +1,210 @@
+import hashlib
+import json
+import math
+import os
+import time
+
+import numpy
+
+from remote import atomicWrite
+from util import default_out_dir
+
+# maximum ray distance of ambient_occlusion in src/ao/aobench.impala;
+# objects further apart than this cannot occlude each other
+occlusionRange = 0.45
+
+statedir = default_out_dir / 'state'
+if not statedir.exists():
+    statedir.mkdir(parents=True)
+
+
+def jsonHash(value) -> str:
+    return hashlib.md5(json.dumps(value,
+                                  sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def sceneKey(igxcContent: dict,
+             basePath,
+             resolution: int,
+             quality: str = "final") -> str:
+    """Identifies a configurable scene independent of its object states."""
+    return jsonHash([
+        igxcContent.get("Geometries"),
+        igxcContent.get("BasePath"),
+        str(basePath), resolution, quality
+    ])
+
+
+def objectHashes(igxcContent: dict) -> dict:
+    hashes = {}
+    for tObject in igxcContent.get("Objects") or []:
+        hashes[tObject.get("Path")] = jsonHash(tObject)
+    return hashes
+
+
+def objectBounds(vertices: numpy.ndarray, ranges: dict) -> dict:
+    bounds = {}
+    for name, objectRanges in ranges.items():
+        parts = [vertices[start:end] for start, end in objectRanges]
+        points = numpy.concatenate(parts).reshape(-1, 3)
+        if len(points) > 0:
+            bounds[name] = [
+                points.min(axis=0).tolist(),
+                points.max(axis=0).tolist()
+            ]
+    return bounds
+
+
+def load(key: str):
+    """Returns the state stored for the scene key and its raw AO buffer."""
+    try:
+        with (statedir / (key + '.json')).open('r') as f:
+            state = json.load(f)
+        buff = numpy.load(str(statedir / (key + '.npy')))
+        # the modification time orders the states for expire
+        os.utime(str(statedir / (key + '.json')))
+    except (FileNotFoundError, ValueError):
+        return None, None
+    return state, buff
+
+
+def placementOf(key: str):
+    """Atlas placement of the state stored for the scene key, if any; the
+    AO buffer is not read."""
+    try:
+        with (statedir / (key + '.json')).open('r') as f:
+            return json.load(f).get("placement")
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def save(key: str, state: dict, buff: numpy.ndarray):
+    with (statedir / (key + '.npy.tmp')).open('wb') as f:
+        numpy.save(f, buff)
+    (statedir / (key + '.npy.tmp')).replace(statedir / (key + '.npy'))
+    atomicWrite(statedir / (key + '.json'), json.dumps(state).encode('utf-8'))
+
+
+def expire(budget=None, ttl=None, keep=None) -> int:
+    """Removes the least recently used states until they take at most
+    budget bytes, and those unused for ttl seconds, except keep; returns
+    the number of removed states."""
+    states = []
+    for path in statedir.glob('*.json'):
+        key = path.stem
+        try:
+            size = path.stat().st_size + \
+                (statedir / (key + '.npy')).stat().st_size
+            states.append((path.stat().st_mtime, key, size))
+        except FileNotFoundError:
+            # removed by another process
+            continue
+
+    total = sum(size for _, _, size in states)
+    deadline = time.time() - ttl if ttl else None
+    removed = 0
+    for mtime, key, size in sorted(states):
+        overBudget = budget is not None and total > budget
+        if key == keep or not (overBudget or
+                               (deadline is not None and mtime < deadline)):
+            continue
+        remove(key)
+        total -= size
+        removed += 1
+    return removed
+
+
+def remove(key: str):
+    # the buffer first, load fails without the state
+    for suffix in ('.npy', '.json'):
+        try:
+            (statedir / (key + suffix)).unlink()
+        except FileNotFoundError:
+            pass
+
+
+def clear():
+    for path in statedir.iterdir():
+        if path.is_file():
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+
+def changedObjects(previous: dict, current: dict) -> set:
+    """Paths of objects that differ, including children of moved parents."""
+    changed = {
+        path
+        for path in set(previous) | set(current)
+        if previous.get(path) != current.get(path)
+    }
+    return {
+        path
+        for path in set(previous) | set(current) if any(
+            path == c or path.startswith(c + '.') or c == '.'
+            for c in changed)
+    }
+
+
+def affectedObjects(previous: dict, current: dict):
+    """Objects whose AO tiles have to be baked again, or None for all.
+
+    An incremental bake is only possible if the geometry hashes match;
+    affected are the changed objects, the objects that moved in the atlas
+    and all objects within occlusion range of the old or new bounds of the
+    changed ones.
+    """
+    if previous is None or previous["hashes"] != current["hashes"]:
+        return None
+    if "tiles" not in previous:
+        return None
+
+    moved = {
+        path
+        for path in current["mapping"]
+        if previous["mapping"].get(path) != current["mapping"][path]
+    }
+    changed = changedObjects(previous["objects"], current["objects"])
+
+    def overlaps(a, b):
+        return all(a[0][i] - occlusionRange <= b[1][i]
+                   and b[0][i] <= a[1][i] + occlusionRange for i in range(3))
+
+    changedBounds = [
+        bounds[path] for bounds in (previous["bounds"], current["bounds"])
+        for path in changed if path in bounds
+    ]
+    affected = changed | moved
+    for path, bounds in current["bounds"].items():
+        if any(overlaps(bounds, other) for other in changedBounds):
+            affected.add(path)
+    return affected & set(current["mapping"])
+
+
+def tileRect(bounds: list, w: int, h: int):
+    """Pixel rectangle (x0, y0, x1, y1) covered by atlas UV bounds
+    (umin, vmin, umax, vmax), see TransformedTriExtractor.tiles."""
+    umin, vmin, umax, vmax = bounds
+    # rasterization samples pixel corners, so include the closing edge;
+    # the packers leave a gap of at least one pixel between tiles
+    x0 = max(math.floor(umin * w), 0)
+    x1 = min(math.ceil(umax * w) + 1, w)
+    y0 = max(math.floor((1.0 - vmax) * h), 0)
+    y1 = min(math.ceil((1.0 - vmin) * h) + 1, h)
+    return x0, y0, x1, y1
+
+
+def clearTiles(previous: numpy.ndarray, tiles: dict,
+               objects: set) -> numpy.ndarray:
+    """Copy of previous with the tiles of the given objects cleared, so
+    baking only these objects into it gives the complete map."""
+    w, h = previous.shape[0], previous.shape[1]
+    result = previous.copy()
+    # the buffer is laid out row by row, see out_fun in mapping_cpu.impala
+    rows = result.reshape(h, w, 4)
+    for path in objects:
+        for bounds in tiles.get(path, []):
+            x0, y0, x1, y1 = tileRect(bounds, w, h)
+            rows[y0:y1, x0:x1] = 0
+    return result
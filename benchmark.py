@@ -0,0 +1,521 @@
+import argparse
+import timeit
+
+import glm
+import numpy
+
+import scene
+import visitor
+
+
+def compareMeshes(reference: scene.Mesh, candidate: scene.Mesh) -> bool:
+    if reference.triangleCount() != candidate.triangleCount():
+        return False
+
+    for a, b in zip(reference.triangles, candidate.triangles):
+        for attr in ('vertices', 'normals', 'texcoords', 'globalUVs'):
+            va, vb = getattr(a, attr), getattr(b, attr)
+            if (va is None) != (vb is None):
+                return False
+            if va is not None and not numpy.allclose(
+                    numpy.array([list(v) for v in va]),
+                    numpy.array([list(v) for v in vb])):
+                return False
+    return True
+
+
+# bakes of two backends agree if few texels are covered by only one of
+# them and the AO values show no bias; the sampling noise of texels is
+# independent, so their mean absolute difference is not a criterion
+maxCoverageMismatch = 0.01
+maxBias = 2.0
+
+
+def compareBuffers(a: numpy.ndarray, b: numpy.ndarray) -> dict:
+    """Coverage mismatch (fraction of covered texels) and mean absolute
+    and signed AO difference (of 255) of two baked buffers."""
+    coveredA, coveredB = a[..., 3] > 0, b[..., 3] > 0
+    both = coveredA & coveredB
+    diff = a[..., 0].astype(int) - b[..., 0].astype(int)
+    return {
+        "coverageMismatch":
+        numpy.count_nonzero(coveredA != coveredB) /
+        max(numpy.count_nonzero(coveredA | coveredB), 1),
+        "meanDeviation":
+        float(numpy.abs(diff[both]).mean()) if both.any() else 0.0,
+        "bias":
+        float(diff[both].mean()) if both.any() else 0.0
+    }
+
+
+def buffersAgree(comparison: dict) -> bool:
+    return comparison["coverageMismatch"] <= maxCoverageMismatch and \
+        abs(comparison["bias"]) <= maxBias
+
+
+def benchCtm(args):
+    import openctm
+
+    def load(vectorized):
+        group = scene.Group('bench')
+        openctm.read(group, args.file, vectorized=vectorized)
+        return group.children[0]
+
+    reference = load(False)
+    candidate = load(True)
+    print('identical triangles:', compareMeshes(reference, candidate))
+
+    tTriangles = min(
+        timeit.repeat(lambda: load(False), number=1, repeat=args.repeat))
+    tArrays = min(
+        timeit.repeat(lambda: load(True), number=1, repeat=args.repeat))
+    print('per-triangle loader: {:.3f}s'.format(tTriangles))
+    print('       array loader: {:.3f}s'.format(tArrays))
+    print('            speedup: {:.1f}x'.format(tTriangles / tArrays))
+
+    # decoding in libopenctm is shared by both loaders and bounds the speedup
+    def decode():
+        ctm = openctm.ctmNewContext(openctm.CTM_IMPORT)
+        openctm.ctmLoad(ctm, bytes(str(args.file), 'utf-8'))
+        openctm.ctmFreeContext(ctm)
+
+    tDecode = min(timeit.repeat(decode, number=1, repeat=args.repeat))
+    print('     ctmLoad decode: {:.3f}s'.format(tDecode))
+    print('  speedup after it: {:.0f}x'.format(
+        (tTriangles - tDecode) / max(tArrays - tDecode, 1e-6)))
+
+
+def benchObj(args):
+    import wavefront
+
+    def load():
+        group = scene.Group('bench')
+        with open(args.file, 'rb') as f:
+            wavefront.read(group, f)
+        return group
+
+    group = load()
+    triangles = sum(mesh.triangleCount() for mesh in group.children)
+    tLoad = min(timeit.repeat(load, number=1, repeat=args.repeat))
+    print('{} meshes, {} triangles: {:.3f}s'.format(len(group.children),
+                                                   triangles, tLoad))
+
+
+def benchGeometry(args):
+    from pathlib import Path
+
+    import igxc
+    from remote import remoteConfig
+
+    def load():
+        group = igxc.loadGeometry('bench', Path(args.file), scene.Group('.'))
+        return sum(mesh.triangleCount() for mesh in group.children)
+
+    remoteConfig["geometryCache"] = False
+    tDecode = min(timeit.repeat(load, number=1, repeat=args.repeat))
+    remoteConfig["geometryCache"] = True
+    triangles = load()
+    tCached = min(timeit.repeat(load, number=1, repeat=args.repeat))
+    print('{} triangles'.format(triangles))
+    print('decoded: {:.3f}s'.format(tDecode))
+    print(' cached: {:.3f}s'.format(tCached))
+    print('speedup: {:.1f}x'.format(tDecode / tCached))
+
+
+def randomIgxc(megabytes: float, seed: int = 0) -> dict:
+    """igxc configuration of about the given size, the objects reference a
+    few hundred geometries."""
+    rng = numpy.random.default_rng(seed)
+    objects = [{"Path": "."}]
+    while len(objects) * 300 < megabytes * 1e6:
+        i = len(objects)
+        position, rotation = rng.random(3).tolist(), rng.random()
+        objects.append({
+            "Path": ".object{}".format(i),
+            "Geometry": "geometry{}".format(i % 500),
+            "Transform": {
+                "Position": dict(zip("XYZ", position)),
+                "Rotation": {"X": 0, "Y": rotation, "Z": 0, "W": 1},
+                "Scale": {"X": 1, "Y": 1, "Z": 1}
+            },
+            "Metadata": {"name": "object {}".format(i), "tags": ["a", "b"]}
+        })
+    return {
+        "Objects": objects,
+        "Geometries": {
+            "geometry{}".format(i): "geometry{}.ctm".format(i)
+            for i in range(500)
+        },
+        "Hashes": {"geometry{}".format(i): str(i) for i in range(500)}
+    }
+
+
+def benchRequest(args):
+    import gzip
+    import json
+    import tempfile
+
+    import server
+    import service
+    from util import prepareOutFilename
+
+    igxc = randomIgxc(args.megabytes)
+    body = json.dumps({
+        "igxcContent": igxc,
+        "basePath": "base",
+        "resolution": 1024
+    }).encode('utf-8')
+    compressed = gzip.compress(body, compresslevel=5)
+    print('igxc body: {:.1f} MB, {:.1f} MB gzip compressed'.format(
+        len(body) / 1e6,
+        len(compressed) / 1e6))
+
+    def best(function):
+        return min(timeit.repeat(function, number=1, repeat=args.repeat))
+
+    def previousName():
+        # outFilenameFor before hashing its parts one by one
+        return prepareOutFilename(
+            json.dumps(igxc["Objects"], sort_keys=True) +
+            json.dumps(igxc["Hashes"], sort_keys=True), 1024)
+
+    def decode():
+        decoder = server.BodyDecoder(True)
+        for start in range(0, len(compressed), server.bodyChunk):
+            decoder.feed(compressed[start:start + server.bodyChunk])
+        return server.parseBody(decoder.finish(), 'application/json')
+
+    def original(encode):
+        with tempfile.TemporaryFile('w') as f:
+            f.write(encode(igxc))
+
+    name = service.outFilenameFor(igxc, None, 1024, "final")
+    print('same output name as before:', name == previousName())
+    server.recentName(('bench', 1024, 'final'), name)
+    timings = [
+        ('parse body', lambda: json.loads(body)),
+        ('decode gzip and parse body', decode),
+        ('output name, concatenated', previousName),
+        ('output name, by part',
+         lambda: service.outFilenameFor(igxc, None, 1024, "final")),
+        ('output name, repeated body',
+         lambda: server.recentName(('bench', 1024, 'final'))),
+        ('original igxc, indented',
+         lambda: original(lambda c: json.dumps(c, indent=4))),
+        ('original igxc, compact', lambda: original(json.dumps)),
+    ]
+    for label, function in timings:
+        print('{:>27}: {:.3f}s'.format(label, best(function)))
+
+
+def benchJobs(args):
+    import tempfile
+    from pathlib import Path
+
+    import bakerman
+
+    # like /bakeUrl/, or /bakeDirect/ with the igxc in the arguments
+    jobArgs = {"url": "https://example.com/scene.igxc", "resolution": 1024}
+    if args.kilobytes > 0:
+        jobArgs = {"igxcContent": randomIgxc(args.kilobytes / 1000)}
+
+    def submit(persist):
+        # workers are not started, the jobs stay queued
+        with tempfile.TemporaryDirectory() as directory:
+            bakerman.bakingConfig["persistJobs"] = persist
+            man = bakerman.BakingMan()
+            man.results = bakerman.ResultStore(Path(directory))
+            if persist:
+                man.store = bakerman.JobStore(
+                    man.results.directory / 'jobs.sqlite')
+            start = timeit.default_timer()
+            for i in range(args.jobs):
+                man.addJob(dict(jobArgs, quality=str(i)), key=str(i))
+            submitted = timeit.default_timer() - start
+            if persist:
+                man.store.close()
+                # a restart finds every job queued again
+                man = bakerman.BakingMan()
+                man.results = bakerman.ResultStore(Path(directory))
+                man.store = bakerman.JobStore(
+                    man.results.directory / 'jobs.sqlite')
+                man.resume()
+                man.store.close()
+                assert len(man.queue) == args.jobs
+            stored = timeit.default_timer() - start
+        return submitted, stored
+
+    for persist in (False, True):
+        submitted, stored = submit(persist)
+        print('{:>9}: {:.0f} jobs/s submitted, {:.2f}s until stored'.format(
+            'persisted' if persist else 'in memory', args.jobs / submitted,
+            stored))
+
+
+def randomScene(triangles: int, meshes: int, seed: int = 0) -> scene.Group:
+    rng = numpy.random.default_rng(seed)
+    root = scene.Group('.')
+    for i in range(meshes):
+        comp = scene.Group('.object{}'.format(i))
+        comp.parent = root
+        comp.transform = glm.rotate(
+            glm.translate(glm.mat4(1), glm.vec3(*rng.random(3))),
+            float(rng.random()), glm.vec3(0, 1, 0))
+        root.add(comp)
+
+        geo = scene.Group('geometry{}'.format(i))
+        geo.parent = comp
+        comp.add(geo)
+
+        count = triangles // meshes
+        vertCount = max(3, count // 2)
+        mesh = scene.ArrayMesh(
+            'random',
+            rng.random((vertCount, 3), dtype=numpy.float32),
+            normals=rng.random((vertCount, 3), dtype=numpy.float32) - 0.5,
+            globalUVs=rng.random((vertCount, 2), dtype=numpy.float32),
+            indices=rng.integers(0, vertCount,
+                                 (count, 3)).astype(numpy.uint32))
+        mesh.parent = geo
+        geo.add(mesh)
+    return root
+
+
+def soupScene(triangles: int, meshes: int, size: float,
+              seed: int = 0) -> scene.Group:
+    """Random scene of small triangles, closer to real geometry for tracing
+    than the unit cube spanning triangles of randomScene."""
+    rng = numpy.random.default_rng(seed)
+    root = scene.Group('.')
+    count = triangles // meshes
+    for i in range(meshes):
+        comp = scene.Group('.object{}'.format(i))
+        comp.parent = root
+        root.add(comp)
+
+        centers = rng.random((count, 1, 3), dtype=numpy.float32)
+        vertices = centers + size * (
+            rng.random((count, 3, 3), dtype=numpy.float32) - 0.5)
+        faceNormals = numpy.cross(vertices[:, 1] - vertices[:, 0],
+                                  vertices[:, 2] - vertices[:, 0])
+        faceNormals /= numpy.linalg.norm(faceNormals, axis=1, keepdims=True)
+        uvCenters = rng.random((count, 1, 2), dtype=numpy.float32)
+        mesh = scene.ArrayMesh(
+            'soup',
+            vertices,
+            normals=numpy.repeat(faceNormals[:, None], 3, axis=1),
+            globalUVs=numpy.clip(
+                uvCenters + 4 * size *
+                (rng.random((count, 3, 2), dtype=numpy.float32) - 0.5), 0,
+                1))
+        mesh.parent = comp
+        comp.add(mesh)
+    return root
+
+
+def extract(root: scene.Group):
+    triCounter = visitor.TriCounter()
+    root.accept(triCounter)
+    meshCounter = visitor.MeshCounter()
+    root.accept(meshCounter)
+
+    vertices = numpy.zeros((triCounter.count, 3, 3), dtype=numpy.float32)
+    normals = numpy.zeros((triCounter.count, 3, 3), dtype=numpy.float32)
+    texcoord = numpy.zeros((triCounter.count, 3, 2), dtype=numpy.float32)
+    buckets = int(numpy.ceil(numpy.sqrt(meshCounter.count)))
+    triExtractor = visitor.TransformedTriExtractor(
+        vertices,
+        normals,
+        texcoord,
+        packer=visitor.SimplePacker(buckets, buckets, 1024))
+    root.accept(triExtractor)
+    return vertices, normals, texcoord
+
+
+def benchExtract(args):
+    # compare against the per-triangle path on a small scene
+    small = randomScene(2000, 4)
+    candidate = extract(small)
+
+    class TriangleMeshes(visitor.SceneVisitor):
+        def visit_Mesh(self, mesh, direction):
+            if direction == 'forward':
+                reference = scene.Mesh(mesh.name)
+                reference.parent = mesh.parent
+                for tri in mesh.triangles:
+                    reference.add(tri)
+                mesh.parent.children[mesh.parent.children.index(
+                    mesh)] = reference
+
+    small.accept(TriangleMeshes())
+    reference = extract(small)
+    maxError = max(
+        numpy.abs(a - b).max() for a, b in zip(reference, candidate))
+    print('max deviation from per-triangle path:', maxError)
+
+    large = randomScene(args.triangles, args.meshes)
+    tArrays = min(
+        timeit.repeat(lambda: extract(large), number=1, repeat=args.repeat))
+    print('extraction of {} triangles: {:.3f}s'.format(
+        args.triangles, tArrays))
+
+
+def benchBake(args):
+    import service
+
+    root = soupScene(args.triangles, args.meshes, args.size)
+    vertices, normals, texcoord = extract(root)
+    size = (args.resolution, args.resolution)
+
+    sampling = service.samplingFor(args.quality)
+    buffers = {}
+    for backend in args.backends:
+        try:
+            service.bakingBackend(backend)
+        except ImportError as e:
+            print('{} backend not available ({})'.format(backend, e))
+            continue
+        rays = numpy.zeros(size, dtype=numpy.int32)
+        times = timeit.repeat(lambda: buffers.__setitem__(
+            backend,
+            service.bakeBuffer(vertices,
+                               normals,
+                               texcoord,
+                               size,
+                               args.threads,
+                               backend,
+                               sampling=sampling,
+                               rays=rays)),
+                              number=1,
+                              repeat=args.repeat)
+        covered = numpy.count_nonzero(buffers[backend][..., 3])
+        print('{:>6} backend: {:.3f}s, {:.2f} Mrays/s, {:.1f} rays/texel'.
+              format(backend, min(times),
+                     rays.sum() / min(times) / 1e6,
+                     rays.sum() / max(covered, 1)))
+
+        if args.quality != 'reference':
+            reference = service.bakeBuffer(
+                vertices,
+                normals,
+                texcoord,
+                size,
+                args.threads,
+                backend,
+                sampling=service.samplingFor('reference'))
+            mask = reference[..., 3] > 0
+            diff = numpy.abs(buffers[backend][..., 0].astype(int) -
+                             reference[..., 0].astype(int))[mask]
+            print('        deviation from reference: mean {:.2f}, '
+                  'max {} / 255'.format(diff.mean(), diff.max()))
+
+    if len(buffers) == 2:
+        comparison = compareBuffers(*buffers.values())
+        print('coverage mismatch: {:.2%} of texels'.format(
+            comparison["coverageMismatch"]))
+        print('mean AO deviation: {:.2f} / 255, bias {:+.2f}'.format(
+            comparison["meanDeviation"], comparison["bias"]))
+        print('backends agree:', buffersAgree(comparison))
+
+
+def benchPack(args):
+    root = randomScene(args.meshes * 100, args.meshes)
+    # spread the mesh sizes over two orders of magnitude
+    rng = numpy.random.default_rng(1)
+    for comp in root.children:
+        comp.transform = comp.transform * glm.scale(
+            glm.mat4(1), glm.vec3(float(10**rng.uniform(-1, 1))))
+
+    meshAreas = visitor.MeshAreas()
+    root.accept(meshAreas)
+    areas = numpy.array(meshAreas.areas)
+
+    buckets = int(numpy.ceil(numpy.sqrt(args.meshes)))
+    gridTexels = numpy.full(len(areas), (args.resolution / buckets)**2)
+    packer = visitor.AreaPacker(meshAreas.areas, meshAreas.uvAreas,
+                                meshAreas.uvBounds, args.resolution)
+    areaTexels = numpy.array([w * h for _, _, w, h in packer.tiles])
+
+    for name, texels in (('grid', gridTexels), ('area', areaTexels)):
+        density = texels / areas
+        print('{} packer: texels per unit area min {:.0f}, median {:.0f}, '
+              'max {:.0f}, atlas used {:.0%}'.format(
+                  name, density.min(), numpy.median(density), density.max(),
+                  texels.sum() / args.resolution**2))
+
+
+def start():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--repeat',
+                        help='number of timed repetitions',
+                        type=int,
+                        default=3)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    ctmParser = subparsers.add_parser(
+        'ctm', help='compare the OpenCTM loader modes on a file')
+    ctmParser.add_argument('file', type=str)
+    ctmParser.set_defaults(func=benchCtm)
+
+    objParser = subparsers.add_parser('obj',
+                                      help='time the OBJ reader on a file')
+    objParser.add_argument('file', type=str)
+    objParser.set_defaults(func=benchObj)
+
+    geometryParser = subparsers.add_parser(
+        'geometry', help='compare decoding a file with the geometry cache')
+    geometryParser.add_argument('file', type=str)
+    geometryParser.set_defaults(func=benchGeometry)
+
+    requestParser = subparsers.add_parser(
+        'request', help='time the handling of a large /bakeDirect/ body')
+    requestParser.add_argument('--megabytes', type=float, default=10.0)
+    requestParser.set_defaults(func=benchRequest)
+
+    jobsParser = subparsers.add_parser(
+        'jobs', help='time submitting jobs with and without the job store')
+    jobsParser.add_argument('--jobs', type=int, default=10000)
+    jobsParser.add_argument('--kilobytes',
+                            help='size of the igxc of every job, 0 for '
+                            'url jobs',
+                            type=float,
+                            default=0.0)
+    jobsParser.set_defaults(func=benchJobs)
+
+    extractParser = subparsers.add_parser(
+        'extract', help='time TransformedTriExtractor on a random scene')
+    extractParser.add_argument('--triangles', type=int, default=1000000)
+    extractParser.add_argument('--meshes', type=int, default=100)
+    extractParser.set_defaults(func=benchExtract)
+
+    bakeParser = subparsers.add_parser(
+        'bake', help='compare the baking backends on a random scene')
+    bakeParser.add_argument('--triangles', type=int, default=20000)
+    bakeParser.add_argument('--meshes', type=int, default=16)
+    bakeParser.add_argument('--size',
+                            help='edge length of the triangles',
+                            type=float,
+                            default=0.05)
+    bakeParser.add_argument('--resolution', type=int, default=128)
+    bakeParser.add_argument('--threads', type=int, default=0)
+    bakeParser.add_argument('--backends',
+                            nargs='+',
+                            default=['native', 'numpy'])
+    bakeParser.add_argument('--quality',
+                            help='AO sampling preset',
+                            default='final')
+    bakeParser.set_defaults(func=benchBake)
+
+    packParser = subparsers.add_parser(
+        'pack', help='compare the texel density of the UV packers')
+    packParser.add_argument('--meshes', type=int, default=400)
+    packParser.add_argument('--resolution', type=int, default=2048)
+    packParser.set_defaults(func=benchPack)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    start()
@@ -1,12 +1,10 @@
-from PIL import Image
-import numpy as np
-
-from service import default_out_dir
-
+import argparse
 
-def clamp(n, smallest, largest):
-    return max(smallest, min(n, largest))
+import numpy
+from PIL import Image
 
+import dilate
+from util import default_out_dir
 
 # assets for debugging
 DBG_blur_file = 'assets/4x5hard.png'
@@ -14,76 +12,32 @@ DBG_blur_file = 'assets/4x5soft.png'
 DBG_blur_file = 'assets/border.png'
 DBG_blur_file = 'out/test.png'
 
-im_frame = Image.open(DBG_blur_file)
-imgData = im_frame.getdata()
-
-loaded = im_frame.load()
-
-originalImg = np.array(imgData, np.uint8)
-newImg = np.array(imgData, np.uint8)
-
-width = imgData.size[0]
-height = imgData.size[1]
-nb = [
-    [],
-    [],
-    [],
-    [],
-    # [],
-    [],
-    [],
-    [],
-    [],
-]
-for column in range(0, width):
-    for row in range(0, height):
-        # pixel raster around center pixel
-        # 0 1 2
-        # 3 c 4
-        # 5 6 7
-        centerIdx = column + row * width
-        leftCol = clamp(column - 1, 0, width - 1)
-        rightCol = clamp(column + 1, 0, width - 1)
-        upperRow = clamp(row - 1, 0, height - 1)
-        lowerRow = clamp(row + 1, 0, height - 1)
-
-        nb[0] = originalImg[leftCol + upperRow * width]
-        nb[1] = originalImg[column + upperRow * width]
-        nb[2] = originalImg[rightCol + upperRow * width]
-
-        nb[3] = originalImg[leftCol + row * width]
-        centerPixel = originalImg[centerIdx]
-        nb[4] = originalImg[rightCol + row * width]
-
-        nb[5] = originalImg[leftCol + lowerRow * width]
-        nb[6] = originalImg[column + lowerRow * width]
-        nb[7] = originalImg[rightCol + lowerRow * width]
 
-        # check alpha channel
-        if centerPixel[3] == 0:
+def start():
+    parser = argparse.ArgumentParser(
+        description='Dilate the charts of an AO map into its empty texels.')
+    parser.add_argument('file', nargs='?', default=DBG_blur_file)
+    parser.add_argument('--texels',
+                        help='texels to grow the charts by (default: all)',
+                        type=int)
+    parser.add_argument('--mips',
+                        help='number of mip levels to write',
+                        type=int,
+                        default=0)
+    parser.add_argument('--show', action='store_true')
+    args = parser.parse_args()
 
-            valid_pixels = list(filter(lambda x: x[3] > 0, nb))
-            lenValPix = len(valid_pixels)
-            if lenValPix > 0:
-                # take average of red channel
-                avg = 0
-                for ii in range(lenValPix):
-                    avg += valid_pixels[ii][0]
-                avg = int(avg / lenValPix)
-                loaded[column, row] = (avg, avg, avg, 255)
+    pixels = numpy.asarray(Image.open(args.file).convert('RGBA'))
+    levels = dilate.dilate(pixels, args.texels, args.mips)
 
-        elif centerPixel[3] < 255:
-            # make semitransparent areas fully visible
-            loaded[column, row] = (centerPixel[0], centerPixel[1],
-                                   centerPixel[2], 255)
-    print("column %d of %d" % (column, width))
+    images = [Image.fromarray(level) for level in levels]
+    images[0].save(default_out_dir / "padded.png")
+    for level, image in enumerate(images[1:], 1):
+        image.save(default_out_dir / "padded_mip{}.png".format(level))
 
-# pythonArray = newImg.tolist()
-# newImgAsImage = Image.fromarray(pythonArray, 'RGBA')
-# convertedImage = newImgAsImage.convert("RGB")
-# convertedImage.save("art.png")
+    if args.show:
+        images[0].show()
 
-im_frame.save(default_out_dir + "padded.png")
 
-im_frame.show()
-print("huhu")
+if __name__ == '__main__':
+    start()
@@ -0,0 +1,115 @@
+"""Seam dilation of baked atlases.
+
+Empty texels (alpha 0) take the colors of the charts around them, so that
+bilinear filtering and mipmapping do not pick up the background at chart
+borders. Colors are spread with a pull-push pyramid: every level is the
+coverage weighted 2x2 average of the finer one, and empty texels take the
+value of the next coarser level. This fills the whole atlas in log2(size)
+vectorized passes; the levels double as mipmaps free of background.
+"""
+import numpy
+
+# texels out of reach of any chart are unoccluded
+background = 255
+
+
+def pull(level: numpy.ndarray, dtype=numpy.float32) -> numpy.ndarray:
+    """Next coarser level of an array of premultiplied colors with the
+    coverage in the last channel."""
+    h, w = level.shape[0], level.shape[1]
+    if h % 2 or w % 2:
+        level = numpy.pad(level, ((0, h % 2), (0, w % 2), (0, 0)))
+    # adding strided views is much faster than a reshaped sum
+    rows = level[0::2].astype(dtype)
+    rows += level[1::2]
+    return rows[:, 0::2] + rows[:, 1::2]
+
+
+def push(level: numpy.ndarray, coarser: numpy.ndarray) -> numpy.ndarray:
+    """Colors of a level with its empty texels taken from the filled
+    coarser level."""
+    h, w = level.shape[0], level.shape[1]
+    filled = coarser.repeat(2, axis=0).repeat(2, axis=1)[:h, :w]
+    numpy.divide(level[..., :3],
+                 level[..., 3:],
+                 out=filled,
+                 where=level[..., 3:] > 0)
+    return filled
+
+
+def grow(mask: numpy.ndarray, texels: int, axis: int) -> numpy.ndarray:
+    """Texels at most texels away from a masked one along axis; the reach
+    roughly doubles per pass."""
+    def part(start, stop):
+        index = [slice(None)] * mask.ndim
+        index[axis] = slice(start, stop)
+        return tuple(index)
+
+    reach = 0
+    while reach < texels:
+        step = min(reach + 1, texels - reach)
+        grown = mask.copy()
+        grown[part(step, None)] |= mask[part(None, -step)]
+        grown[part(None, -step)] |= mask[part(step, None)]
+        mask, reach = grown, reach + step
+    return mask
+
+
+def chebyshevMask(covered: numpy.ndarray, texels: int) -> numpy.ndarray:
+    """Texels at most texels away from a covered one, as separable column
+    and row passes of a square dilation."""
+    return grow(grow(covered, texels, 0), texels, 1)
+
+
+def toPixels(colors: numpy.ndarray) -> numpy.ndarray:
+    pixels = numpy.empty(colors.shape[:2] + (4, ), dtype=numpy.uint8)
+    pixels[..., :3] = numpy.rint(colors)
+    pixels[..., 3] = 255
+    return pixels
+
+
+def packed(pixels: numpy.ndarray) -> numpy.ndarray:
+    """One uint32 per RGBA texel, to move whole texels at once."""
+    return pixels.view(numpy.uint32)[..., 0]
+
+
+def dilate(pixels: numpy.ndarray, texels=None, mipLevels: int = 0) -> list:
+    """Dilates the charts of an RGBA atlas of shape (height, width, 4).
+
+    Empty texels within texels of a chart get its colors (all of them if
+    texels is None), others the background. Returns the opaque atlas
+    followed by mipLevels downsampled levels.
+    """
+    pixels = numpy.ascontiguousarray(pixels, dtype=numpy.uint8)
+    h, w = pixels.shape[0], pixels.shape[1]
+    covered = pixels[..., 3] > 0
+
+    # the full resolution level is only pulled, so it is summed in uint16;
+    # its empty texels are filled in place below
+    level = numpy.where(covered, packed(pixels), 0)
+    level = level.view(numpy.uint8).reshape(h, w, 4)
+    level[..., 3] = covered
+    levels = [pull(level, numpy.uint16).astype(numpy.float32)]
+    while levels[-1].shape[0] > 1 or levels[-1].shape[1] > 1:
+        levels.append(pull(levels[-1]))
+
+    # filled levels from the coarsest one, finest first afterwards
+    mips = [
+        numpy.full(levels[-1].shape[:2] + (3, ),
+                   background,
+                   dtype=numpy.float32)
+    ]
+    for level in reversed(levels):
+        mips.append(push(level, mips[-1]))
+    mips = mips[:0:-1]
+
+    result = pixels.copy()
+    result[..., 3] = 255
+    fill = packed(toPixels(mips[0])).repeat(2, axis=0).repeat(2, axis=1)
+    fill = fill[:h, :w]
+    if texels is not None:
+        outside = packed(numpy.full((1, 4), background, dtype=numpy.uint8))
+        fill = numpy.where(chebyshevMask(covered, texels), fill, outside)
+    numpy.copyto(packed(result), fill, where=~covered)
+
+    return [result] + [toPixels(colors) for colors in mips[:mipLevels]]
@@ -0,0 +1,111 @@
+"""Cache of decoded geometry files.
+
+Decoding MG2 compressed CTM files (or parsing OBJ files) dominates the
+loading of scenes whose files come from the download cache every time. The
+array meshes a reader produced are kept in the download cache as one .npy
+file per attribute, keyed by the SHA-1 of the file content and the loader
+version. Later jobs load them memory-mapped: no decoding, no copies, and
+processes baking the same geometry share its pages.
+"""
+import hashlib
+import json
+import time
+
+import numpy
+
+import scene
+from remote import cache, remoteConfig
+from util import colorprint
+
+# bump when a reader changes the arrays it produces for the same file
+loaderVersion = 1
+
+attributes = ('vertices', 'normals', 'texcoords', 'globalUVs', 'indices')
+
+
+def contentKey(file, suffix: str) -> str:
+    digest = hashlib.sha1()
+    with open(str(file), 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return '{}.v{}{}'.format(digest.hexdigest(), loaderVersion, suffix)
+
+
+def saveArray(array: numpy.ndarray):
+    def write(filename):
+        with open(filename, 'wb') as f:
+            numpy.save(f, numpy.ascontiguousarray(array), allow_pickle=False)
+
+    return write
+
+
+def store(key: str, meshes: list):
+    """Stores the arrays of the meshes, then the manifest listing them, so
+    that a manifest in the cache always refers to complete arrays."""
+    manifest = []
+    for i, mesh in enumerate(meshes):
+        # memory-mapping empty arrays fails, they add nothing to a bake
+        if mesh.triangleCount() == 0:
+            continue
+        arrays = {}
+        for attribute in attributes:
+            array = getattr(mesh, attribute)
+            if array is not None:
+                name = '{}.{}.{}.npy'.format(key, i, attribute)
+                cache.storeWith(name, saveArray(array))
+                arrays[attribute] = name
+        manifest.append({"name": mesh.name, "arrays": arrays})
+    cache.store(key + '.json', json.dumps({"meshes": manifest}).encode())
+
+
+def load(key: str):
+    """Memory-mapped meshes of the key, or None if they are not (or not
+    completely) in the cache."""
+    manifestFile = cache.lookup(key + '.json')
+    if manifestFile is None:
+        return None
+    try:
+        meshes = []
+        for entry in json.loads(manifestFile.read_text())["meshes"]:
+            arrays = {}
+            for attribute, name in entry["arrays"].items():
+                filename = cache.lookup(name)
+                if filename is None:
+                    raise FileNotFoundError(name + ' evicted')
+                arrays[attribute] = numpy.load(str(filename),
+                                               mmap_mode='r',
+                                               allow_pickle=False)
+            meshes.append(scene.ArrayMesh(entry["name"], **arrays))
+        return meshes
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        colorprint("Discarding cached geometry {} ({})".format(key, e), 33)
+        return None
+
+
+def read(group: scene.Group, file, reader):
+    """Adds the meshes of file to group, from the cache if possible and with
+    reader(group, file) otherwise."""
+    if not remoteConfig["geometryCache"]:
+        reader(group, file)
+        return
+
+    start = time.perf_counter()
+    key = contentKey(file.resolve(), file.suffix)
+    meshes = load(key)
+    if meshes is not None:
+        for mesh in meshes:
+            mesh.parent = group
+            group.add(mesh)
+        colorprint(
+            "Geometry from cache ({}, {:.3f}s)".format(
+                key,
+                time.perf_counter() - start), 32)
+        return
+
+    first = len(group.children)
+    reader(group, file)
+    meshes = group.children[first:]
+    # readers report failures without raising, do not cache their result
+    if len(meshes) > 0 and all(
+            isinstance(mesh, scene.ArrayMesh) for mesh in meshes):
+        store(key, meshes)
@@ -1,9 +1,13 @@
 import json
+import struct
+from collections import Counter
+
 import glm
-from remote import fetch, CachedFile
+from remote import fetchAll, CachedFile, cachedCopy
 import scene
 import wavefront
 import openctm
+import geocache
 from pathlib import Path
 
 
@@ -57,6 +61,18 @@ def readTransform(tTransform):
     return tf
 
 
+def readObj(group, file):
+    with file.open('rb') as objFile:
+        wavefront.read(group, objFile)
+
+
+def readCtm(group, file):
+    openctm.read(group, file.resolve())
+
+
+geometryReaders = {'.obj': readObj, '.ctm': readCtm}
+
+
 def loadGeometry(geometry, file, parent: scene.SceneNode):
     if file is None:
         return None
@@ -64,16 +80,62 @@ def loadGeometry(geometry, file, parent: scene.SceneNode):
     group = scene.Group(geometry)
 
     group.parent = parent
-    if file.suffix == '.obj':
-        pass  # wavefront.read(group, file.open())
-
-    if file.suffix == '.ctm':
-        openctm.read(group, file.resolve())
+    reader = geometryReaders.get(file.suffix)
+    if reader is not None:
+        geocache.read(group, file, reader)
 
     return group
 
 
-def load(igxc, basepath):
+class SceneTooLarge(ValueError):
+    pass
+
+
+def geometryTriangles(file) -> int:
+    """Triangle count of a geometry file without decoding it: from the
+    header of CTM files, the corners of the face lines of OBJ files."""
+    # downloaded files resolve to their copy in the cache
+    path = file.resolve()
+    with path.open('rb') as f:
+        if path.suffix == '.ctm':
+            magic, _, _, _, triangles = struct.unpack('<4si4sii', f.read(20))
+            if magic != b'OCTM':
+                raise IOError("not an OpenCTM file: {}".format(file))
+            return triangles
+
+        return wavefront.countTriangles(f)
+
+
+def availableGeometries(igxc, basepath) -> dict:
+    """Geometry files of the igxc that are local or already downloaded."""
+    if 'BasePath' in igxc:
+        basepath = CachedFile(igxc['BasePath'])
+    if basepath is None:
+        return {}
+
+    files = dict()
+    for k, v in igxc.get('Geometries', {}).items():
+        filename = basepath / v
+        if isinstance(filename, CachedFile):
+            filename = cachedCopy(filename, v[-4:])
+        if filename is not None and filename.is_file():
+            files[k] = filename
+    return files
+
+
+def sceneTriangles(igxc, files: dict) -> int:
+    """Triangles of the scene with all instances, counting the geometries
+    in files only."""
+    uses = Counter(
+        tObject.get('Geometry') for tObject in igxc.get('Objects', []))
+    return sum(count * geometryTriangles(files[geometry])
+               for geometry, count in uses.items()
+               if files.get(geometry) is not None)
+
+
+def load(igxc, basepath, triangleLimit=None):
+    """Scene graph of the igxc; raises SceneTooLarge before decoding any
+    geometry if the scene has more than triangleLimit triangles."""
     if "Objects" not in igxc:
         raise AttributeError("'Objects' not in igxc")
     if "Geometries" not in igxc:
@@ -86,13 +148,16 @@ def load(igxc, basepath):
         basepath = CachedFile(igxc['BasePath'])
 
     try:
+        # download everything that is not available locally in parallel
+        tFetch = dict()
         for k, v in igxc['Geometries'].items():
             filename = basepath / v
             if filename.is_file():
                 tFileImport[k] = filename
             else:
-                tFileImport[k] = fetch(filename, v[-4:])
-            # print(tFileImport[k])
+                tFetch[k] = (filename, v[-4:])
+        tFileImport.update(fetchAll(tFetch))
+        # print(tFileImport)
     except FileNotFoundError as e:
         print(e)
         raise
@@ -106,6 +171,11 @@ def load(igxc, basepath):
 
     print(len(tFileImport), 'files referenced in total')
 
+    if triangleLimit is not None:
+        triangles = sceneTriangles(igxc, tFileImport)
+        if triangles > triangleLimit:
+            raise SceneTooLarge(triangles, triangleLimit)
+
     # traverse scene graph
     objects = dict()
     meshes = dict()
@@ -135,13 +205,16 @@ def load(igxc, basepath):
         tGeometry = tObject.get('Geometry')
         # print("LOG", "Geometry:", tGeometry)
         if tGeometry is not None:
-            # if tGeometry in meshes:
-            #     geo = meshes.get(tGeometry)
-            # else:
-            geometryFile = tFileImport.get(tGeometry)
-            # print("LOG", "geometryFile:", geometryFile)
-            geo = loadGeometry(tGeometry, geometryFile, comp)
-            meshes[tGeometry] = geo
+            # load every geometry once, further objects share its meshes
+            if tGeometry in meshes:
+                geo = meshes.get(tGeometry)
+                if geo is not None:
+                    geo = geo.instance(comp)
+            else:
+                geometryFile = tFileImport.get(tGeometry)
+                # print("LOG", "geometryFile:", geometryFile)
+                geo = loadGeometry(tGeometry, geometryFile, comp)
+                meshes[tGeometry] = geo
             # print("LOG", "geo:", geo)
 
             if geo is not None:
@@ -149,5 +222,5 @@ def load(igxc, basepath):
             else:
                 print("LOG", "Geometry:", tGeometry, "not found")
 
-    print(len(meshes), 'meshes used in total')
+    print(len(meshes), 'unique geometries used in total')
     return root
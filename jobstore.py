@@ -0,0 +1,144 @@
+"""Durable record of the jobs of a BakingMan.
+
+Jobs are kept in an SQLite database in WAL mode, so queued jobs and the
+results clients are still polling for survive restarts of the server.
+Changes are queued in memory and written by a background thread in one
+transaction per batch; submitting a job costs a list append, not a disk
+sync. Changes made less than a batch interval before a crash are lost,
+stop writes everything still queued.
+"""
+import json
+import sqlite3
+import threading
+from pathlib import Path
+
+from util import colorprint
+
+schema = """
+CREATE TABLE IF NOT EXISTS jobs (
+    jobId INTEGER PRIMARY KEY,
+    key TEXT,
+    priority INTEGER,
+    sequence INTEGER,
+    state TEXT,
+    args TEXT,
+    summary TEXT,
+    timeCreated REAL
+)
+"""
+
+
+class JobStore(object):
+    def __init__(self, filename: Path, interval=0.05):
+        self.interval = interval
+        self.connection = sqlite3.connect(str(filename),
+                                          check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        # a batch is durable once committed, syncing every commit is not
+        # needed in WAL mode
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(schema)
+        self.connection.commit()
+
+        self.changes = []
+        self.writing = False
+        # threads waiting in flush, the writer commits without batching
+        self.flushes = 0
+        self.condition = threading.Condition()
+        self.running = True
+        self.writer = threading.Thread(target=self.write,
+                                       name="JobStoreWriter",
+                                       daemon=True)
+        self.writer.start()
+
+    def load(self) -> list:
+        """All stored jobs as dicts ordered by jobId, args and summary
+        decoded; call before queueing changes."""
+        rows = self.connection.execute(
+            'SELECT jobId, key, priority, sequence, state, args, summary, '
+            'timeCreated FROM jobs ORDER BY jobId').fetchall()
+        jobs = []
+        for row in rows:
+            job = dict(
+                zip(('jobId', 'key', 'priority', 'sequence', 'state', 'args',
+                     'summary', 'timeCreated'), row))
+            job['jobId'] = str(job['jobId'])
+            job['args'] = json.loads(job['args']) if job['args'] else None
+            job['summary'] = json.loads(
+                job['summary']) if job['summary'] else None
+            jobs.append(job)
+        return jobs
+
+    def queue(self, statement: str, encode=None):
+        # encode() returns the parameters, it runs in the writer thread so
+        # large job arguments are serialized off the request path
+        with self.condition:
+            self.changes.append((statement, encode))
+            # the first change wakes the writer, which then waits for more
+            if len(self.changes) == 1:
+                self.condition.notify_all()
+
+    def add(self, jobId: str, key, priority: int, sequence: int, args: dict,
+            timeCreated: float):
+        self.queue(
+            'INSERT OR REPLACE INTO jobs (jobId, key, priority, sequence, '
+            'state, args, timeCreated) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            lambda: (int(jobId), key, priority, sequence, "pending",
+                     json.dumps(args), timeCreated))
+
+    def started(self, jobId: str):
+        self.queue('UPDATE jobs SET state = ? WHERE jobId = ?',
+                   lambda: ("running", int(jobId)))
+
+    def finished(self, jobId: str, key, summary: dict):
+        # the heavy fields, arguments included, are kept by the ResultStore
+        self.queue(
+            'INSERT OR REPLACE INTO jobs (jobId, key, state, summary, '
+            'timeCreated) VALUES (?, ?, ?, ?, ?)', lambda:
+            (int(jobId), key, summary["state"], json.dumps(summary),
+             summary.get("timeCreated")))
+
+    def remove(self, jobIds: list):
+        for jobId in jobIds:
+            self.queue('DELETE FROM jobs WHERE jobId = ?',
+                       lambda jobId=jobId: (int(jobId), ))
+
+    def write(self):
+        while True:
+            with self.condition:
+                while self.running and len(self.changes) == 0:
+                    self.condition.wait()
+                if self.running and self.flushes == 0:
+                    # let more changes arrive, they are committed together
+                    self.condition.wait(self.interval)
+                changes, self.changes = self.changes, []
+                self.writing = len(changes) > 0
+            if not self.writing:
+                return
+
+            try:
+                with self.connection:
+                    for statement, encode in changes:
+                        self.connection.execute(statement, encode())
+            except (sqlite3.Error, TypeError, ValueError) as e:
+                colorprint("Could not store {} job changes ({})".format(
+                    len(changes), e), 31)
+            with self.condition:
+                self.writing = False
+                self.condition.notify_all()
+
+    def flush(self):
+        """Waits until the queued changes are committed."""
+        with self.condition:
+            self.flushes += 1
+            self.condition.notify_all()
+            while len(self.changes) > 0 or self.writing:
+                self.condition.wait()
+            self.flushes -= 1
+
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.writer.join()
+        self.connection.close()
@@ -0,0 +1,483 @@
+"""Pure NumPy implementation of the ig_rendering_support baking functions.
+
+Follows bakeAO of src/main.cpp and src/ao/aobench.impala
+closely enough to compare speed and output against the AnyDSL build, and
+bakes on machines without that toolchain.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+
+# see ambient_occlusion in src/ao/aobench.impala
+NAO_SAMPLES = 16
+tmin = 0.0001
+tmax = 0.45
+
+leafSize = 4
+rayBatch = 1 << 17
+texelBatch = 1 << 12
+rasterChunk = 1 << 22
+
+
+def checkTriangles(name: str, array, width: int):
+    """Rejects arrays bakeAO of src/main.cpp would not take without a copy."""
+    if not isinstance(array, numpy.ndarray) or \
+            array.dtype != numpy.float32 or not array.flags.c_contiguous:
+        raise TypeError(name + " must be a C-contiguous float32 array")
+    if array.ndim != 3 or array.shape[1:] != (3, width):
+        raise ValueError("{} must have shape (n, 3, {})".format(name, width))
+
+
+def checkData(data):
+    """Rejects AO buffers bakeAO of src/main.cpp would not write into."""
+    if not isinstance(data, numpy.ndarray) or \
+            data.dtype != numpy.uint8 or not data.flags.c_contiguous or \
+            not data.flags.writeable:
+        raise TypeError("data must be a writeable C-contiguous uint8 array")
+    if data.ndim != 3 or data.shape[2] != 4:
+        raise ValueError("data must have shape (w, h, 4)")
+
+
+class BVH(object):
+    """Binary BVH over triangles with median splits, stored in flat arrays.
+
+    The children of inner node i are child[i] and child[i] + 1, leaves
+    reference count[i] triangles of order starting at start[i].
+    """
+    def __init__(self, vertices: numpy.ndarray):
+        checkTriangles("vertices", vertices, 3)
+        tris = vertices
+        lower = tris.min(axis=1)
+        upper = tris.max(axis=1)
+        centroids = (lower + upper) * 0.5
+        order = numpy.arange(len(tris))
+
+        levels = []
+        starts = numpy.zeros(1, dtype=numpy.int64)
+        counts = numpy.array([len(tris)], dtype=numpy.int64)
+        firstId = 0
+        while len(starts) > 0:
+            ordered = centroids[order]
+            bmin = numpy.minimum.reduceat(lower[order], starts, axis=0)
+            bmax = numpy.maximum.reduceat(upper[order], starts, axis=0)
+            split = counts > leafSize
+
+            # children of this level are numbered in pairs after it
+            child = numpy.full(len(starts), -1, dtype=numpy.int64)
+            nextId = firstId + len(starts)
+            child[split] = nextId + 2 * numpy.arange(numpy.count_nonzero(split))
+            levels.append((bmin, bmax, child, starts, counts))
+
+            if not split.any():
+                break
+
+            # sort the triangles of every split node along the largest
+            # extent of its centroid bounds, leaves keep their order
+            cmin = numpy.minimum.reduceat(ordered, starts, axis=0)
+            cmax = numpy.maximum.reduceat(ordered, starts, axis=0)
+            axis = numpy.argmax(cmax - cmin, axis=1)
+            segment = numpy.repeat(numpy.arange(len(starts)), counts)
+            key = ordered[numpy.arange(len(order)), axis[segment]]
+            key[~split[segment]] = 0.0
+            order = order[numpy.lexsort((key, segment))]
+
+            half = counts[split] // 2
+            starts = numpy.stack([starts[split], starts[split] + half],
+                                 axis=1).reshape(-1)
+            counts = numpy.stack([half, counts[split] - half],
+                                 axis=1).reshape(-1)
+            firstId = nextId
+
+        self.bmin = numpy.concatenate([level[0] for level in levels])
+        self.bmax = numpy.concatenate([level[1] for level in levels])
+        self.child = numpy.concatenate([level[2] for level in levels])
+        self.start = numpy.concatenate([level[3] for level in levels])
+        self.count = numpy.concatenate([level[4] for level in levels])
+        self.depth = len(levels)
+
+        # triangles in leaf order
+        ordered = tris[order]
+        self.v0 = ordered[:, 0]
+        self.e1 = ordered[:, 1] - ordered[:, 0]
+        self.e2 = ordered[:, 2] - ordered[:, 0]
+
+    arrays = ("bmin", "bmax", "child", "start", "count", "v0", "e1", "e2")
+
+    @property
+    def triangleCount(self) -> int:
+        return len(self.v0)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(getattr(self, name).nbytes for name in self.arrays)
+
+    def save(self, path: str):
+        with open(path, 'wb') as f:
+            numpy.savez(f,
+                        depth=self.depth,
+                        **{name: getattr(self, name)
+                           for name in self.arrays})
+
+    @staticmethod
+    def load(path: str) -> 'BVH':
+        bvh = BVH.__new__(BVH)
+        with numpy.load(path) as content:
+            for name in BVH.arrays:
+                setattr(bvh, name, content[name])
+            bvh.depth = int(content["depth"])
+        return bvh
+
+    def occluded(self, origins, directions, near, far) -> numpy.ndarray:
+        """Any-hit test of a batch of rays, True where a triangle is hit.
+
+        Every ray walks the tree depth-first with its own stack, one node
+        per ray and iteration, and stops at its first hit.
+        """
+        count = len(origins)
+        hit = numpy.zeros(count, dtype=bool)
+        invDir = 1.0 / numpy.where(directions == 0.0, 1e-30, directions)
+        stack = numpy.zeros((count, self.depth + 2), dtype=numpy.int32)
+        top = numpy.ones(count, dtype=numpy.int64)
+
+        active = numpy.arange(count)
+        while len(active) > 0:
+            top[active] -= 1
+            nodes = stack[active, top[active]]
+
+            o, inv = origins[active], invDir[active]
+            t0 = (self.bmin[nodes] - o) * inv
+            t1 = (self.bmax[nodes] - o) * inv
+            tEnter = numpy.maximum(numpy.minimum(t0, t1).max(axis=1), near)
+            tExit = numpy.minimum(numpy.maximum(t0, t1).min(axis=1), far)
+            keep = tEnter <= tExit
+            rays, nodes = active[keep], nodes[keep]
+
+            leaf = self.child[nodes] < 0
+            if leaf.any():
+                self.intersectLeaves(rays[leaf], nodes[leaf], origins,
+                                     directions, near, far, hit)
+
+            inner = rays[~leaf]
+            child = self.child[nodes[~leaf]]
+            stack[inner, top[inner]] = child + 1
+            stack[inner, top[inner] + 1] = child
+            top[inner] += 2
+
+            active = active[(top[active] > 0) & ~hit[active]]
+        return hit
+
+    def intersectLeaves(self, rays, nodes, origins, directions, near, far,
+                        hit):
+        # expand every (ray, leaf) pair into its (ray, triangle) pairs
+        counts = self.count[nodes]
+        rays = numpy.repeat(rays, counts)
+        offsets = numpy.arange(len(rays)) - numpy.repeat(
+            numpy.cumsum(counts) - counts, counts)
+        tris = numpy.repeat(self.start[nodes], counts) + offsets
+
+        # Moeller-Trumbore, both sides
+        d = directions[rays]
+        e1, e2 = self.e1[tris], self.e2[tris]
+        p = numpy.cross(d, e2)
+        det = numpy.einsum('ij,ij->i', e1, p)
+        valid = numpy.abs(det) > 1e-12
+        invDet = 1.0 / numpy.where(valid, det, 1.0)
+        s = origins[rays] - self.v0[tris]
+        u = numpy.einsum('ij,ij->i', s, p) * invDet
+        q = numpy.cross(s, e1)
+        v = numpy.einsum('ij,ij->i', d, q) * invDet
+        t = numpy.einsum('ij,ij->i', e2, q) * invDet
+        valid &= (u >= 0.0) & (v >= 0.0) & (u + v <= 1.0)
+        valid &= (t > near) & (t < far)
+        hit[rays[valid]] = True
+
+
+def edge(xa, ya, xb, yb, x, y):
+    """Half-edge function of processTriangle incl. the fill convention."""
+    dx = xa - xb
+    dy = ya - yb
+    c = dy * xa - dx * ya
+    c += (dy < 0) | ((dy == 0) & (dx > 0))
+    return c + dx * y - dy * x
+
+
+def rasterize(texcoord: numpy.ndarray, w: int, h: int):
+    """Texels covered by the triangles in the atlas.
+
+    Returns pixel x, y, triangle index and barycentric coordinates of every
+    covered texel; later triangles win where they overlap.
+    """
+    # 28.4 fixed-point coordinates, see processTriangle
+    X = numpy.trunc(16.0 * texcoord[..., 0] * w).astype(numpy.int64)
+    Y = numpy.trunc(16.0 * (1.0 - texcoord[..., 1]) * h).astype(numpy.int64)
+    xmin = numpy.clip((X.min(axis=1) + 0xF) >> 4, 0, w)
+    xmax = numpy.clip((X.max(axis=1) + 0xF) >> 4, 0, w)
+    ymin = numpy.clip((Y.min(axis=1) + 0xF) >> 4, 0, h)
+    ymax = numpy.clip((Y.max(axis=1) + 0xF) >> 4, 0, h)
+    bw = numpy.maximum(xmax - xmin, 0)
+    bh = numpy.maximum(ymax - ymin, 0)
+
+    owner = numpy.full(w * h, -1, dtype=numpy.int64)
+    bary = numpy.zeros((w * h, 3), dtype=numpy.float32)
+
+    # enumerate the bounding rectangles in chunks of bounded size
+    areas = bw * bh
+    total = numpy.cumsum(areas)
+    cuts = numpy.searchsorted(
+        total, numpy.arange(1, total[-1] // rasterChunk + 1) * rasterChunk)
+    edges = numpy.unique(
+        numpy.concatenate([[0], numpy.minimum(cuts + 1, len(areas)),
+                           [len(areas)]]))
+    for begin, end in zip(edges[:-1], edges[1:]):
+        tris = numpy.arange(begin, end)
+        counts = areas[tris]
+        tri = numpy.repeat(tris, counts)
+        local = numpy.arange(len(tri)) - numpy.repeat(
+            numpy.cumsum(counts) - counts, counts)
+        px = xmin[tri] + local % bw[tri]
+        py = ymin[tri] + local // bw[tri]
+        x, y = px << 4, py << 4
+
+        X1, X2, X3 = X[tri, 0], X[tri, 1], X[tri, 2]
+        Y1, Y2, Y3 = Y[tri, 0], Y[tri, 1], Y[tri, 2]
+        # both windings are drawn, see render in aobench.impala
+        front = (edge(X1, Y1, X2, Y2, x, y) > 0) & (edge(
+            X2, Y2, X3, Y3, x, y) > 0) & (edge(X3, Y3, X1, Y1, x, y) > 0)
+        back = (edge(X3, Y3, X2, Y2, x, y) > 0) & (edge(
+            X2, Y2, X1, Y1, x, y) > 0) & (edge(X1, Y1, X3, Y3, x, y) > 0)
+        denominator = (X2 - X3) * (Y3 - Y1) - (Y2 - Y3) * (X3 - X1)
+        covered = (front | back) & (denominator != 0)
+
+        tri, x, y = tri[covered], x[covered], y[covered]
+        X2, X3, Y2, Y3 = X2[covered], X3[covered], Y2[covered], Y3[covered]
+        X1, Y1 = X1[covered], Y1[covered]
+        invDenominator = 1.0 / denominator[covered]
+        xo, yo = x - X3, y - Y3
+        t1 = invDenominator * ((Y2 - Y3) * xo - (X2 - X3) * yo)
+        t2 = invDenominator * ((Y3 - Y1) * xo - (X3 - X1) * yo)
+
+        pixel = (y >> 4) * w + (x >> 4)
+        owner[pixel] = tri
+        bary[pixel] = numpy.stack([t1, t2, 1.0 - t1 - t2], axis=1)
+
+    pixels = numpy.flatnonzero(owner >= 0)
+    return pixels % w, pixels // w, owner[pixels], bary[pixels]
+
+
+class GBuffer(object):
+    """Covered texels of an atlas, rasterized once for all tiles of a bake.
+
+    Every texel is listed once, under the last triangle covering it; the
+    texels of triangle t are the entries first[t]..first[t + 1].
+    """
+    def __init__(self, texcoord: numpy.ndarray, width: int, height: int):
+        checkTriangles("texcoord", texcoord, 2)
+        if width <= 0 or height <= 0:
+            raise ValueError("width and height must be positive")
+        self.width, self.height = width, height
+        if len(texcoord) == 0:
+            px = py = tri = numpy.zeros(0, dtype=numpy.int64)
+            bary = numpy.zeros((0, 3), dtype=numpy.float32)
+        else:
+            px, py, tri, bary = rasterize(texcoord, width, height)
+        order = numpy.argsort(tri, kind='stable')
+        self.px, self.py = px[order], py[order]
+        self.tri, self.bary = tri[order], bary[order]
+        self.first = numpy.searchsorted(self.tri,
+                                        numpy.arange(len(texcoord) + 1))
+
+    @property
+    def triangleCount(self) -> int:
+        return len(self.first) - 1
+
+    @property
+    def texelCount(self) -> int:
+        return len(self.tri)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(a.nbytes for a in (self.px, self.py, self.tri, self.bary,
+                                      self.first))
+
+    def texels(self, begin: int, end: int):
+        """px, py, triangle and barycentric coordinates of the texels of
+        the triangles begin..end."""
+        texels = slice(self.first[begin], self.first[end])
+        return (self.px[texels], self.py[texels], self.tri[texels],
+                self.bary[texels])
+
+
+def orthoBasis(n: numpy.ndarray):
+    """Vectorized ortho_basis of aobench.impala."""
+    helper = numpy.zeros_like(n)
+    useX = (numpy.abs(n[:, 0]) < 0.6)
+    useY = ~useX & (numpy.abs(n[:, 1]) < 0.6)
+    useZ = ~useX & ~useY & (numpy.abs(n[:, 2]) < 0.6)
+    helper[useX | ~(useY | useZ), 0] = 1.0
+    helper[useY, 1] = 1.0
+    helper[useZ, 2] = 1.0
+
+    def normalize(v):
+        l = numpy.linalg.norm(v, axis=1, keepdims=True)
+        return numpy.divide(v, l, out=numpy.zeros_like(v), where=l > 0)
+
+    b0 = normalize(numpy.cross(helper, n))
+    b1 = normalize(numpy.cross(n, b0))
+    return b0, b1, n
+
+
+def traceVisible(bvh: BVH, points, basis, samples: int, rng) -> numpy.ndarray:
+    """Number of unoccluded cosine-weighted rays out of samples per point."""
+    b0, b1, b2 = basis
+    visible = numpy.zeros(len(points), dtype=numpy.int64)
+    perBatch = max(1, rayBatch // samples)
+    for begin in range(0, len(points), perBatch):
+        batch = slice(begin, begin + perBatch)
+        count = len(points[batch])
+        theta = numpy.sqrt(rng.random((count, samples), dtype=numpy.float32))
+        phi = 2.0 * numpy.pi * rng.random((count, samples),
+                                          dtype=numpy.float32)
+        x = (numpy.cos(phi) * theta)[..., None]
+        y = (numpy.sin(phi) * theta)[..., None]
+        z = numpy.sqrt(1.0 - theta * theta)[..., None]
+        directions = x * b0[batch, None] + y * b1[batch, None] + z * b2[batch,
+                                                                         None]
+        origins = numpy.broadcast_to(points[batch, None], directions.shape)
+
+        hit = bvh.occluded(origins.reshape(-1, 3), directions.reshape(-1, 3),
+                           tmin, tmax)
+        visible[batch] = samples - hit.reshape(count, samples).sum(axis=1)
+    return visible
+
+
+def ambientOcclusion(bvh: BVH,
+                     points,
+                     normals,
+                     rng,
+                     minSamples=NAO_SAMPLES * NAO_SAMPLES,
+                     maxSamples=NAO_SAMPLES * NAO_SAMPLES,
+                     batch=NAO_SAMPLES,
+                     maxError=0.0):
+    """Fraction of unoccluded rays and number of rays for every point.
+
+    Rays are traced in batches until the standard error of a point drops
+    below maxError, see ambient_occlusion in aobench.impala.
+    """
+    basis = orthoBasis(normals)
+    visible = numpy.zeros(len(points), dtype=numpy.int64)
+    count = numpy.zeros(len(points), dtype=numpy.int64)
+    maxSamples = max(maxSamples, 1)
+    minSamples = max(1, min(minSamples, maxSamples))
+    batch = max(batch, 1)
+
+    # active points advance in lockstep and share their sample count
+    active = numpy.arange(len(points))
+    while len(active) > 0:
+        samples = min(batch, maxSamples - int(count[active[0]]))
+        visible[active] += traceVisible(bvh, points[active],
+                                        [b[active] for b in basis], samples,
+                                        rng)
+        count[active] += samples
+
+        n = count[active]
+        p = (visible[active] + 1.0) / (n + 2.0)
+        converged = (n >= minSamples) & (p *
+                                         (1.0 - p) <= maxError**2 * n)
+        active = active[~converged & (n < maxSamples)]
+    return visible / numpy.maximum(count, 1), count
+
+
+def bakeAO(data,
+           vertices,
+           normals,
+           texcoord,
+           threads=0,
+           bvh=None,
+           begin=0,
+           end=-1,
+           minSamples=NAO_SAMPLES * NAO_SAMPLES,
+           maxSamples=NAO_SAMPLES * NAO_SAMPLES,
+           batch=NAO_SAMPLES,
+           maxError=0.0,
+           rays=None,
+           gbuffer=None):
+    """Bakes ambient occlusion into data, like ig_rendering_support.bakeAO.
+
+    Only the triangles begin..end of texcoord are drawn (end < 0 up to the
+    last one), all triangles occlude. A BVH of the same geometry in any
+    triangle order can be passed, and a GBuffer of texcoord shared by the
+    tiles of a bake. Sampling and the rays output follow the arguments of
+    the same names of ig_rendering_support.bakeAO.
+    """
+    checkData(data)
+    w, h = data.shape[0], data.shape[1]
+    checkTriangles("vertices", vertices, 3)
+    checkTriangles("normals", normals, 3)
+    checkTriangles("texcoord", texcoord, 2)
+    if len(normals) not in (0, len(vertices)):
+        raise ValueError("normals must be empty or given for every triangle")
+    if len(texcoord) != len(vertices):
+        raise ValueError("texcoord must be given for every triangle")
+    if end < 0 or end > len(texcoord):
+        end = len(texcoord)
+    begin = max(0, min(begin, end))
+    print("bakeAO (numpy) image({}x{}), {} triangles, {} drawn".format(
+        w, h, len(vertices), end - begin))
+    if end == begin or len(vertices) == 0:
+        return
+
+    if bvh is None:
+        bvh = BVH(vertices)
+    elif bvh.triangleCount != len(vertices):
+        raise ValueError(
+            "BVH was built for a different number of triangles")
+    if gbuffer is None:
+        # without a shared G-buffer only the drawn triangles are rasterized
+        px, py, tri, bary = GBuffer(texcoord[begin:end], w,
+                                    h).texels(0, end - begin)
+        tri = tri + begin
+    elif (gbuffer.width, gbuffer.height,
+          gbuffer.triangleCount) != (w, h, len(texcoord)):
+        raise ValueError(
+            "GBuffer was built for a different map or number of triangles")
+    else:
+        px, py, tri, bary = gbuffer.texels(begin, end)
+    if len(tri) == 0:
+        return
+
+    points = numpy.einsum('ij,ijk->ik', bary, vertices[tri])
+    if len(normals) > 0:
+        n = numpy.einsum('ij,ijk->ik', bary, normals[tri])
+    else:
+        corners = vertices[tri]
+        n = numpy.cross(corners[:, 1] - corners[:, 0],
+                        corners[:, 2] - corners[:, 0])
+        l = numpy.linalg.norm(n, axis=1, keepdims=True)
+        n = numpy.divide(n, l, out=numpy.zeros_like(n), where=l > 0)
+
+    # numpy releases the GIL in the heavy array operations
+    workers = threads or os.cpu_count() or 1
+    seeds = numpy.random.SeedSequence().spawn(
+        (len(points) + texelBatch - 1) // texelBatch)
+
+    def shade(k):
+        texels = slice(k * texelBatch, (k + 1) * texelBatch)
+        return ambientOcclusion(bvh, points[texels], n[texels],
+                                numpy.random.default_rng(seeds[k]),
+                                minSamples, maxSamples, batch, maxError)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        shaded = list(executor.map(shade, range(len(seeds))))
+    value = numpy.concatenate([v for v, _ in shaded])
+    counts = numpy.concatenate([c for _, c in shaded])
+
+    # the buffer is laid out row by row, see out_fun in mapping_cpu.impala
+    out = data.reshape(-1, 4)
+    idx = py * w + px
+    shade8 = numpy.clip((value * 255.5).astype(numpy.int32), 0, 255)
+    out[idx, 0:3] = shade8[:, None]
+    out[idx, 3] = 255
+    if rays is not None:
+        rays.reshape(-1)[idx] = counts
+
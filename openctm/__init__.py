@@ -1,9 +1,71 @@
 from .openctm import *
 import scene
 import glm
+from numpy.ctypeslib import as_array
 
 
-def read(group, file):
+def readArrays(mesh, triCount, vertCount, pindices, pvertices, pnormals,
+               ptexCoords, puvCoords):
+    # wrap the context-owned buffers and copy them, so the result outlives
+    # the OpenCTM context; the index buffer is kept to share vertices.
+    # This takes a small fraction of ctmLoad, which decodes the file and
+    # bounds how much faster than readTriangles reading a file gets
+    def copy(pointer, width):
+        if not pointer:
+            return None
+        return as_array(pointer, shape=(vertCount, width)).copy()
+
+    indices = as_array(pindices, shape=(triCount, 3)).copy()
+
+    return scene.ArrayMesh(mesh,
+                           copy(pvertices, 3),
+                           normals=copy(pnormals, 3),
+                           texcoords=copy(ptexCoords, 2),
+                           globalUVs=copy(puvCoords, 2),
+                           indices=indices)
+
+
+def readTriangles(mesh, triCount, vertCount, pindices, pvertices, pnormals,
+                  ptexCoords, puvCoords):
+    mesh = scene.Mesh(mesh)
+
+    def readVec3(array, idx):
+        return glm.vec3(array[idx * 3], array[idx * 3 + 1],
+                        array[idx * 3 + 2])
+
+    def readVec2(array, idx):
+        return glm.vec2(array[idx * 2], array[idx * 2 + 1])
+
+    for i in range(triCount):
+        i0, i1, i2 = pindices[i * 3], pindices[i * 3 + 1], pindices[i * 3 +
+                                                                    2]
+        v0, v1, v2 = readVec3(pvertices,
+                              i0), readVec3(pvertices,
+                                            i1), readVec3(pvertices, i2)
+        tri = scene.Triangle(v0, v1, v2)
+
+        if pnormals:
+            n0, n1, n2 = readVec3(pnormals, i0), readVec3(pnormals,
+                                                          i1), readVec3(
+                                                              pnormals, i2)
+            tri.normals = (n0, n1, n2)
+
+        if ptexCoords:
+            t0, t1, t2 = readVec2(ptexCoords, i0), readVec2(
+                ptexCoords, i1), readVec2(ptexCoords, i2)
+            tri.texcoords = (t0, t1, t2)
+
+        if puvCoords:
+            uv0, uv1, uv2 = readVec2(puvCoords, i0), readVec2(
+                puvCoords, i1), readVec2(puvCoords, i2)
+            tri.globalUVs = (uv0, uv1, uv2)
+
+        mesh.add(tri)
+
+    return mesh
+
+
+def read(group, file, vectorized=True):
     print('Load', file)
     try:
         ctm = ctmNewContext(CTM_IMPORT)
@@ -72,42 +134,11 @@ def read(group, file):
         if uvMapCount > 1:
             puvCoords = ctmGetFloatArray(ctm, CTM_UV_MAP_2)
 
-        mesh = scene.Mesh('ctm')
+        readMesh = readArrays if vectorized else readTriangles
+        mesh = readMesh('ctm', triCount, vertCount, pindices, pvertices,
+                        pnormals, ptexCoords, puvCoords)
         mesh.parent = group
 
-        def readVec3(array, idx):
-            return glm.vec3(array[idx * 3], array[idx * 3 + 1],
-                            array[idx * 3 + 2])
-
-        def readVec2(array, idx):
-            return glm.vec2(array[idx * 2], array[idx * 2 + 1])
-
-        for i in range(triCount):
-            i0, i1, i2 = pindices[i * 3], pindices[i * 3 + 1], pindices[i * 3 +
-                                                                        2]
-            v0, v1, v2 = readVec3(pvertices,
-                                  i0), readVec3(pvertices,
-                                                i1), readVec3(pvertices, i2)
-            tri = scene.Triangle(v0, v1, v2)
-
-            if hasNormals:
-                n0, n1, n2 = readVec3(pnormals, i0), readVec3(pnormals,
-                                                              i1), readVec3(
-                                                                  pnormals, i2)
-                tri.normals = (n0, n1, n2)
-
-            if ptexCoords:
-                t0, t1, t2 = readVec2(ptexCoords, i0), readVec2(
-                    ptexCoords, i1), readVec2(ptexCoords, i2)
-                tri.texcoords = (t0, t1, t2)
-
-            if puvCoords:
-                uv0, uv1, uv2 = readVec2(puvCoords, i0), readVec2(
-                    puvCoords, i1), readVec2(puvCoords, i2)
-                tri.globalUVs = (uv0, uv1, uv2)
-
-            mesh.add(tri)
-
         group.add(mesh)
 
     except Exception as e:
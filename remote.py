@@ -1,11 +1,322 @@
 import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
 from pathlib import Path
+
+import requests
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
 from urlpath import URL
 
 cachedir = Path.cwd() / 'cache'
 if not cachedir.exists():
     cachedir.mkdir(parents=True)
 
+# fetchTimeout: seconds to connect to a server and to wait for each read
+#   of a download, a stalled download fails instead of blocking its worker;
+#   None waits forever
+remoteConfig = {
+    "fetchWorkers": 8,
+    "fetchTimeout": 60.0,
+    "cacheBudget": None,
+    "cachePolicy": "lru",
+    "cacheRevalidate": False,
+    "geometryCache": True
+}
+
+_local = threading.local()
+_pool = None
+_poolWorkers = 0
+_poolLock = threading.Lock()
+
+
+def atomicWrite(filename: Path, content: bytes):
+    # write to a temporary file in the same directory and rename it, so
+    # concurrent readers never see a partially written file
+    fd, tmpName = tempfile.mkstemp(dir=str(filename.parent),
+                                   prefix='.' + filename.name,
+                                   suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            tmp.write(content)
+        os.replace(tmpName, str(filename))
+    except BaseException:
+        os.unlink(tmpName)
+        raise
+
+
+@contextmanager
+def fileLock(path: Path):
+    """Exclusive lock on path across processes, held for the block."""
+    with open(str(path), 'a+b') as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class DownloadCache(object):
+    """Size-bounded file cache for downloads with LRU or LFU eviction.
+
+    Entries are tracked in an index file with size, access time, hit count
+    and the validators (ETag, Last-Modified) of the response. The baking
+    processes share the cache: each one records its accesses and counters
+    and merges them into the index under a file lock, so that the index and
+    its counters cover all processes.
+    """
+    statNames = ("hits", "misses", "revalidated", "filesEvicted",
+                 "bytesEvicted")
+
+    def __init__(self, directory: Path, budget=None, policy='lru'):
+        self.directory = directory
+        self.budget = budget
+        self.policy = policy
+        self.indexFile = directory / 'index.json'
+        self.lockFile = directory / '.lock'
+        self.lock = threading.RLock()
+        self.dirty = False
+        # changes and counters of this process not merged into the index
+        self.changes = []
+        self.stats = dict.fromkeys(self.statNames, 0)
+        self.entries = self.loadIndex()
+
+    def readIndex(self):
+        """Entries and counters of the index file."""
+        try:
+            with self.indexFile.open('r') as f:
+                index = json.load(f)
+        except (FileNotFoundError, ValueError):
+            index = {}
+        if "entries" not in index:
+            # index of a single process, without counters
+            index = {"entries": index}
+        stats = dict.fromkeys(self.statNames, 0)
+        stats.update(index.get("stats", {}))
+        return index["entries"], stats
+
+    def loadIndex(self) -> dict:
+        entries, _ = self.readIndex()
+
+        # reconcile with the files actually present in the cache
+        present = {}
+        for path in self.directory.iterdir():
+            if not path.is_file() or path == self.indexFile or \
+                    path.name.startswith('.'):
+                continue
+            stat = path.stat()
+            entry = entries.get(path.name, {"hits": 0})
+            entry["size"] = stat.st_size
+            entry.setdefault("atime", stat.st_mtime)
+            present[path.name] = entry
+        return present
+
+    def change(self, kind: str, name: str, value=None):
+        # kind is "add", "adopt" (add unless known), "access" or "remove"
+        self.changes.append((kind, name, value))
+        self.dirty = True
+
+    def count(self, stat: str, value=1):
+        with self.lock:
+            self.stats[stat] += value
+            self.dirty = True
+
+    @staticmethod
+    def apply(entries: dict, changes: list):
+        for kind, name, value in changes:
+            if kind == "add":
+                entries[name] = dict(value)
+            elif kind == "adopt":
+                entries.setdefault(name, dict(value))
+            elif kind == "access" and name in entries:
+                entry = entries[name]
+                entry["atime"] = max(entry["atime"], value)
+                entry["hits"] += 1
+            elif kind == "remove":
+                entries.pop(name, None)
+
+    def flush(self, force=False):
+        """Merges the changes of this process into the index, evicting
+        entries over the budget."""
+        with self.lock:
+            if not self.dirty and not force:
+                return
+            changes, self.changes = self.changes, []
+            stats = self.stats
+            self.stats = dict.fromkeys(self.statNames, 0)
+            self.dirty = False
+
+        with fileLock(self.lockFile):
+            entries, totals = self.readIndex()
+            self.apply(entries, changes)
+            for stat, value in stats.items():
+                totals[stat] += value
+            added = {name for kind, name, _ in changes if kind == "add"}
+            self.evict(entries, totals, added)
+            atomicWrite(
+                self.indexFile,
+                json.dumps({
+                    "entries": entries,
+                    "stats": totals
+                }).encode('utf-8'))
+
+        with self.lock:
+            # changes made meanwhile are merged by the next flush
+            self.apply(entries, self.changes)
+            self.entries = entries
+
+    def lookup(self, name: str):
+        with self.lock:
+            entry = self.entries.get(name)
+            path = self.directory / name
+            if not path.is_file():
+                if entry is not None:
+                    del self.entries[name]
+                    self.change("remove", name)
+                self.count("misses")
+                return None
+            if entry is None:
+                # stored by another process since the last merge
+                entry = {"size": path.stat().st_size, "hits": 0}
+                self.entries[name] = entry
+                self.change("adopt", name, dict(entry, atime=time.time()))
+            now = time.time()
+            entry["atime"] = now
+            entry["hits"] += 1
+            self.change("access", name, now)
+            self.count("hits")
+            return path
+
+    def validators(self, name: str) -> dict:
+        with self.lock:
+            entry = self.entries.get(name, {})
+            headers = {}
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("lastModified"):
+                headers["If-Modified-Since"] = entry["lastModified"]
+            return headers
+
+    def store(self, name: str, content: bytes, headers=None) -> Path:
+        path = self.directory / name
+        atomicWrite(path, content)
+        self.register(name, len(content), headers)
+        return path
+
+    def storeWith(self, name: str, write) -> Path:
+        """Like store for content that write(filename) writes itself."""
+        path = self.directory / name
+        fd, tmpName = tempfile.mkstemp(dir=str(self.directory),
+                                       prefix='.' + name,
+                                       suffix='.tmp')
+        os.close(fd)
+        try:
+            write(tmpName)
+            os.replace(tmpName, str(path))
+        except BaseException:
+            os.unlink(tmpName)
+            raise
+        self.register(name, path.stat().st_size)
+        return path
+
+    def register(self, name: str, size: int, headers=None):
+        headers = headers or {}
+        with self.lock:
+            self.entries[name] = {
+                "size": size,
+                "atime": time.time(),
+                "hits": 0,
+                "etag": headers.get("ETag"),
+                "lastModified": headers.get("Last-Modified")
+            }
+            self.change("add", name, dict(self.entries[name]))
+        self.flush()
+
+    def evict(self, entries: dict, stats: dict, keep=()):
+        # called with the merged index, under the file lock
+        if self.budget is None:
+            return
+        total = sum(entry["size"] for entry in entries.values())
+        if total <= self.budget:
+            return
+
+        if self.policy == 'lfu':
+            order = lambda item: (item[1]["hits"], item[1]["atime"])
+        else:
+            order = lambda item: item[1]["atime"]
+
+        for name, entry in sorted(entries.items(), key=order):
+            if total <= self.budget:
+                break
+            if name in keep:
+                continue
+            try:
+                (self.directory / name).unlink()
+            except FileNotFoundError:
+                pass
+            del entries[name]
+            total -= entry["size"]
+            stats["filesEvicted"] += 1
+            stats["bytesEvicted"] += entry["size"]
+
+    def clear(self):
+        with fileLock(self.lockFile):
+            entries, totals = self.readIndex()
+            with self.lock:
+                for name in set(entries) | set(self.entries):
+                    try:
+                        (self.directory / name).unlink()
+                    except FileNotFoundError:
+                        pass
+                self.entries = {}
+                self.changes = []
+            atomicWrite(
+                self.indexFile,
+                json.dumps({
+                    "entries": {},
+                    "stats": totals
+                }).encode('utf-8'))
+
+    def metrics(self) -> dict:
+        """Counters of all processes, including the unmerged ones of this
+        process."""
+        entries, result = self.readIndex()
+        with self.lock:
+            for stat, value in self.stats.items():
+                result[stat] += value
+        lookups = result["hits"] + result["misses"]
+        result["hitRate"] = result["hits"] / lookups if lookups else 0.0
+        result["files"] = len(entries)
+        result["bytes"] = sum(e["size"] for e in entries.values())
+        result["budget"] = self.budget
+        return result
+
+
+cache = DownloadCache(cachedir)
+
+
+def configureCache():
+    cache.budget = remoteConfig["cacheBudget"]
+    cache.policy = remoteConfig["cachePolicy"]
+    cache.flush(force=True)
+
 
 class CachedFile(URL):
     def is_file(self):
@@ -17,26 +328,106 @@ class CachedFile(URL):
     def resolve(self, strict=False):
         return self.filename.resolve(strict)
 
+
+def session() -> requests.Session:
+    # one keep-alive session per thread, requests.Session is not thread-safe
+    if not hasattr(_local, 'session'):
+        _local.session = requests.Session()
+    return _local.session
+
+
+def cacheName(url, suffix='.bin') -> str:
+    return hashlib.sha1(str(url).encode('utf-8')).hexdigest() + suffix
+
+
+def cachedCopy(url, suffix='.bin'):
+    """Path of the downloaded copy of url if the cache holds one, without
+    fetching it or counting a cache access."""
+    path = cache.directory / cacheName(url, suffix)
+    return path if path.is_file() else None
+
+
 def fetch(url, suffix='.bin', force=False):
-    print("FETCHING " + str(url), end="")
-    hash = hashlib.sha1(str(url).encode('utf-8')).hexdigest()
-    filename = cachedir / (hash + suffix)
+    start = time.perf_counter()
+    name = cacheName(url, suffix)
     # print()
-    # print(filename, end="")
+    # print(name, end="")
 
-    if not filename.is_file() or force:
-        print(' [Loading=', end="")
-        with url.get() as response:
-            print(str(response.status_code) + ']')
+    filename = None if force else cache.lookup(name)
+    if filename is not None and remoteConfig["cacheRevalidate"]:
+        headers = cache.validators(name)
+        with session().get(str(url),
+                           headers=headers,
+                           timeout=remoteConfig["fetchTimeout"]) as response:
+            if response.status_code == 304:
+                cache.count("revalidated")
+                status = ' [' + name[:11] + ', not modified]'
+            elif response.status_code == 200:
+                filename = cache.store(name, response.content,
+                                       response.headers)
+                status = ' [' + name[:11] + ', modified]'
+            else:
+                status = ' [' + name[:11] + ', revalidation=' + str(
+                    response.status_code) + ']'
+    elif filename is None:
+        with session().get(str(url),
+                           timeout=remoteConfig["fetchTimeout"]) as response:
+            status = ' [Loading=' + str(response.status_code) + ']'
             # info = response.info()
             # print(info.get_content_type())
             if response.status_code == 200:
-                filename.write_bytes(response.content)
+                filename = cache.store(name, response.content,
+                                       response.headers)
             else:
+                print("FETCHING " + str(url) + status)
                 return None
     else:
-        print(' [' + hash[:11] + ']')
+        status = ' [' + name[:11] + ']'
 
     cf = CachedFile(url)
     cf.filename = filename
+    cf.elapsed = time.perf_counter() - start
+    print("FETCHING " + str(url) + status +
+          ' {:.3f}s'.format(cf.elapsed))
     return cf
+
+
+def fetchPool(workers=None) -> ThreadPoolExecutor:
+    """Download threads shared by all fetchAll calls; their keep-alive
+    sessions stay open from one scene to the next."""
+    global _pool, _poolWorkers
+    workers = max(1, workers or remoteConfig["fetchWorkers"])
+    with _poolLock:
+        if _pool is None or _poolWorkers != workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            _pool = ThreadPoolExecutor(max_workers=workers,
+                                       thread_name_prefix='fetch')
+            _poolWorkers = workers
+        return _pool
+
+
+def fetchAll(entries: dict, workers=None) -> dict:
+    """Fetches all {key: (url, suffix)} entries concurrently.
+
+    Returns {key: CachedFile or None}. The first failing download raises
+    its exception after all others have finished.
+    """
+    if len(entries) == 0:
+        return {}
+
+    start = time.perf_counter()
+    pool = fetchPool(workers)
+    futures = {
+        key: pool.submit(fetch, url, suffix)
+        for key, (url, suffix) in entries.items()
+    }
+    wait(futures.values())
+    cache.flush()
+    result = {key: future.result() for key, future in futures.items()}
+
+    elapsed = time.perf_counter() - start
+    total = sum(cf.elapsed for cf in result.values() if cf is not None)
+    print('fetched {} files in {:.3f}s ({:.3f}s sequential)'.format(
+        len(result), elapsed, total))
+    return result
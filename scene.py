@@ -20,6 +20,18 @@ class Group(SceneNode):
     def add(self, node):
         self.children.append(node)
 
+    def instance(self, parent=None):
+        """Returns a new group sharing the children of this group.
+
+        The children keep their original parent, so visitors have to rely
+        on the traversal order rather than parent links for instances.
+        """
+        group = Group(self.name)
+        group.parent = parent
+        group.transform = self.transform
+        group.children = list(self.children)
+        return group
+
     def accept(self, visitor):
         visitor.visit_Group(self, 'forward')
         for child in self.children:
@@ -51,18 +63,95 @@ class Mesh(SceneNode):
     def add(self, prim):
         self.triangles.append(prim)
 
+    def triangleCount(self):
+        return len(self.triangles)
+
     def accept(self, visitor):
         # self.name = self.parent.parent.name
         visitor.visit_Mesh(self, 'forward')
         visitor.visit_Mesh(self, 'backward')
 
     def __repr__(self):
-        result = "Mesh (%s) with %d triangles" % (self.name, len(
-            self.triangles))
+        result = "Mesh (%s) with %d triangles" % (self.name,
+                                                  self.triangleCount())
         if self.parent is not None:
             result = "Mesh (%s, parent %s, grandparent %s) with %d triangles" % (
                 self.name, self.parent.name, self.parent.parent.name,
-                len(self.triangles))
+                self.triangleCount())
+        return result
+
+
+class ArrayMesh(Mesh):
+    """Mesh storing its triangles as NumPy arrays instead of Triangle objects.
+
+    Without indices, vertices and normals are (n, 3, 3), texcoords and
+    globalUVs (n, 3, 2) float32 arrays with one row per triangle corner.
+    With an (n, 3) index buffer, the attribute arrays hold one row per
+    shared vertex instead. Missing attributes are None. The arrays are
+    made read-only, since instanced geometry shares them between groups.
+    """
+    def __init__(self,
+                 name,
+                 vertices,
+                 normals=None,
+                 texcoords=None,
+                 globalUVs=None,
+                 indices=None):
+        SceneNode.__init__(self, name)
+        self.vertices = vertices
+        self.normals = normals
+        self.texcoords = texcoords
+        self.globalUVs = globalUVs
+        self.indices = indices
+
+        for array in (vertices, normals, texcoords, globalUVs, indices):
+            if array is not None:
+                array.flags.writeable = False
+
+    def add(self, prim):
+        raise TypeError("ArrayMesh does not support adding triangles")
+
+    def triangleCount(self):
+        if self.indices is not None:
+            return len(self.indices)
+        return len(self.vertices)
+
+    def corners(self, attribute):
+        """Returns the (n, 3, k) per-corner array of the given attribute."""
+        array = getattr(self, attribute)
+        if array is None or self.indices is None:
+            return array
+        return array[self.indices]
+
+    def nbytes(self):
+        arrays = (self.vertices, self.normals, self.texcoords, self.globalUVs,
+                  self.indices)
+        return sum(a.nbytes for a in arrays if a is not None)
+
+    @property
+    def triangles(self):
+        # compatibility view for visitors written against Mesh.triangles
+        def vec3s(array, i):
+            return tuple(glm.vec3(*map(float, v)) for v in array[i])
+
+        def vec2s(array, i):
+            return tuple(glm.vec2(*map(float, v)) for v in array[i])
+
+        vertices = self.corners('vertices')
+        normals = self.corners('normals')
+        texcoords = self.corners('texcoords')
+        globalUVs = self.corners('globalUVs')
+
+        result = []
+        for i in range(self.triangleCount()):
+            tri = Triangle(*vec3s(vertices, i))
+            if normals is not None:
+                tri.normals = vec3s(normals, i)
+            if texcoords is not None:
+                tri.texcoords = vec2s(texcoords, i)
+            if globalUVs is not None:
+                tri.globalUVs = vec2s(globalUVs, i)
+            result.append(tri)
         return result
 
 
@@ -1,32 +1,325 @@
+import gzip
+import hashlib
 import json
+import multiprocessing
 import os
+import threading
+import urllib.parse
+import zlib
+from collections import OrderedDict
 from pprint import pprint
 
 from pathlib import Path
 from bottle import Bottle, run, PasteServer, response, request, static_file
-from service import default_out, aoConfig
-from bakerman import BakingMan, BakingJob
+from service import default_out, aoConfig, outFilenameFor, cachedResult, \
+    budgetError, qualityPresets
+from bakerman import BakingMan, BakingJob, bakingConfig
 from util import colorprint, prepareOutFilename, default_out_dir
-from remote import cachedir
+from remote import cache, configureCache, remoteConfig, atomicWrite
+from util import joinOutputPath
+import bakestate
 
 app = Bottle()
 
 bakingMan = BakingMan()
-bakingMan.start()
+
+# request bodies are read and decompressed in chunks of this size
+bodyChunk = 1 << 20
+
+# output names of recently posted bodies, by body hash, resolution and
+# quality; repeated posts of a configuration skip hashing it again
+recentNames = OrderedDict()
+recentNamesLock = threading.Lock()
+maxRecentNames = 1024
+
+
+class BodyTooLarge(ValueError):
+    pass
+
+
+class BodyDecoder(object):
+    """Collects a request body fed chunk by chunk.
+
+    gzip compressed bodies are decompressed on the fly, at most
+    maxRequestSize decoded bytes are accepted. The decoded bytes are
+    hashed while they arrive.
+    """
+    def __init__(self, compressed: bool):
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) \
+            if compressed else None
+        self.hash = hashlib.md5()
+        self.parts = []
+        self.size = 0
+
+    def add(self, data: bytes):
+        self.size += len(data)
+        if self.size > serverConfig["maxRequestSize"]:
+            raise BodyTooLarge("request body larger than {} bytes".format(
+                serverConfig["maxRequestSize"]))
+        self.hash.update(data)
+        self.parts.append(data)
+
+    def feed(self, chunk: bytes):
+        if self.decompressor is None:
+            self.add(chunk)
+            return
+        # bounded output, a small compressed body may expand a lot
+        while chunk:
+            self.add(self.decompressor.decompress(chunk, bodyChunk))
+            chunk = self.decompressor.unconsumed_tail
+
+    def finish(self) -> bytes:
+        if self.decompressor is not None:
+            self.add(self.decompressor.flush())
+            if not self.decompressor.eof:
+                raise ValueError("truncated gzip body")
+        return b''.join(self.parts)
+
+    def digest(self) -> str:
+        return self.hash.hexdigest()
+
+
+def bodyError(e: Exception):
+    """Response and status for a request body that could not be read."""
+    if isinstance(e, BodyTooLarge):
+        return {"error": str(e)}, 413
+    return {"error": "request body not readable ({})".format(e)}, 400
+
+
+def parseBody(body: bytes, contentType: str):
+    """Parameters of a decoded JSON or url-encoded request body."""
+    if contentType.startswith('application/json'):
+        try:
+            return json.loads(body)
+        except ValueError as e:
+            print("bakeDirect: json couldn't be parsed")
+            print(e)
+            return {}
+    return dict(
+        urllib.parse.parse_qsl(body.decode('utf-8'), keep_blank_values=True))
 
 
 def extractPostParams(requestParam):
-    jobSource = request.POST
+    """Parameters of a POST request and the hash of its body, None for
+    multipart forms, which are left to Bottle."""
+    if request.content_type.startswith('multipart/'):
+        return request.POST, None
+
+    decoder = BodyDecoder(request.headers.get('Content-Encoding') == 'gzip')
+    body = request.body
+    for chunk in iter(lambda: body.read(bodyChunk), b''):
+        decoder.feed(chunk)
+    jobSource = parseBody(decoder.finish(), request.content_type)
+    # print(jobSource)
+    return jobSource, decoder.digest()
+
+
+def qualityFor(jobSource) -> str:
+    """Sampling preset requested by a job, None if it is unknown."""
+    quality = jobSource.get("quality") or aoConfig["quality"]
+    if quality not in qualityPresets:
+        colorprint("unknown quality '{}'".format(quality), 31)
+        return None
+    return quality
+
+
+# job submission and status shared by the Bottle routes and asyncserver,
+# the results are the JSON responses
+def submitFile(fileParam: str, query) -> dict:
+    quality = qualityFor(query)
+    if quality is None:
+        return {"error": "unknown quality"}
+
+    jobParams = {
+        "file": fileParam,
+        "resolution": aoConfig["resolution"],
+        "quality": quality
+    }
+    # print(jobParams)
+    jobKey = "file:{}:{}:{}".format(fileParam, jobParams["resolution"],
+                                    quality)
+    jobId = bakingMan.addJob(jobParams, key=jobKey)
+    return {"jobId": jobId}
+
+
+def submitUrl(jobSource) -> dict:
+    urlParam = jobSource["url"]
+    # print(urlParam)
+
+    resolutionParam = jobSource["resolution"]
+    resolutionValue = aoConfig["resolution"]
+    if resolutionParam is not None:
+        resolutionValue = int(resolutionParam)
+
+    quality = qualityFor(jobSource)
+    if quality is None:
+        return {"error": "unknown quality"}
+
+    args = {"url": urlParam, "resolution": resolutionValue, "quality": quality}
+    # print(args)
+
+    # the output name depends on the igxc behind the url, which is only
+    # fetched by the job, so identical urls are coalesced instead
+    jobKey = "url:{}:{}:{}".format(urlParam, resolutionValue, quality)
+    jobId = bakingMan.addJob(args, key=jobKey)
+    return {"jobId": jobId}
+
+
+def recentName(key, name=None):
+    """Output name remembered for key, or remembers name for it."""
+    with recentNamesLock:
+        if name is None:
+            name = recentNames.get(key)
+            if name is not None:
+                recentNames.move_to_end(key)
+            return name
+        recentNames[key] = name
+        while len(recentNames) > maxRecentNames:
+            recentNames.popitem(last=False)
+        return name
+
+
+def submitDirect(jobSource, bodyDigest=None) -> dict:
+    """Submits a posted igxc; bodyDigest identifies the request body, so
+    that the output name of a repeated post is known without hashing the
+    configuration again."""
+    igxcString = jobSource["igxcContent"]
+    # print(igxcString)
+    if not igxcString or igxcString == "null":
+        colorprint("No igxcContent found in POST request in bakeDirect/", 31)
+        return {"error": "No igxcContent found in POST request in bakeDirect/"}
+
     try:
-        # check if json entry is available
-        jsonSource = request.json
-        if jsonSource is not None:
-            jobSource = jsonSource
+        if isinstance(igxcString, str):
+            igxcContent = json.loads(igxcString)
+        else:
+            igxcContent = igxcString
     except Exception as e:
-        print("bakeDirect: json couldn't be parsed")
+        colorprint("Exception in bakeDirect/", 31)
         print(e)
-    # print(jobSource)
-    return jobSource
+        return {"error": "igxcContent couldn't be parsed"}
+    # print(igxcContent)
+
+    basePath = jobSource["basePath"]
+    # print(basepath)
+
+    resolutionValue = aoConfig["resolution"]
+    resolutionParam = jobSource["resolution"]
+    if resolutionParam is not None:
+        resolutionValue = int(resolutionParam)
+
+    quality = qualityFor(jobSource)
+    if quality is None:
+        return {"error": "unknown quality"}
+
+    nameKey = (bodyDigest, resolutionValue, quality)
+    outFileNameBase = recentName(nameKey) if bodyDigest else None
+    if outFileNameBase is None:
+        outFileNameBase = outFilenameFor(igxcContent, None, resolutionValue,
+                                         quality)
+        if bodyDigest:
+            recentName(nameKey, outFileNameBase)
+    args = {
+        "basePath": basePath,
+        "igxcContent": igxcContent,
+        "resolution": resolutionValue,
+        "quality": quality,
+        "outFileNameBase": outFileNameBase
+    }
+    # print(args)
+
+    output = cachedResult(outFileNameBase, igxcContent)
+    if output is not None:
+        colorprint("Taking from cache ({})".format(outFileNameBase), 32)
+        jobId = bakingMan.addFinishedJob(args, output,
+                                         key=outFileNameBase)
+    else:
+        error = budgetError(igxcContent, basePath, resolutionValue)
+        if error is not None:
+            colorprint("Rejecting bakeDirect/: " + error, 31)
+            return {"error": error}
+        if isinstance(igxcString, str):
+            # keep the igxc as posted, the job would have to encode it
+            atomicWrite(joinOutputPath(outFileNameBase + "_original", 'igxc'),
+                        igxcString.encode('utf-8'))
+        jobId = bakingMan.addJob(args, key=outFileNameBase)
+    return {"jobId": jobId}
+
+
+def deletedJob(jobId: str):
+    """Cancels a queued or running job, the response and its status."""
+    if bakingMan.cancelJob(jobId):
+        return {"jobId": jobId, "cancelled": True}, 200
+    return {"error": "no queued or running job {}".format(jobId)}, 404
+
+
+def resultOf(jobId: str) -> dict:
+    """Finished job record with the heavy fields (jobArgs, transforms,
+    igxcModified) left out of the status responses."""
+    if not bakingMan.isJobFinished(jobId):
+        status = bakingMan.getJobStatus(jobId) or {"state": "undefined"}
+        return {
+            "error": "no result for jobId {}".format(jobId),
+            "state": status["state"]
+        }
+    return bakingMan.getJob(jobId)
+
+
+def filterJobs(jobs: list, query):
+    """Page of the job statuses selected by the query parameters and the
+    number of selected jobs.
+
+    state: comma separated states to keep
+    after, before: bounds of timeCreated in seconds since the epoch
+    offset, limit: page of the selected jobs, limit defaults to pageSize
+    """
+    states = query.get("state")
+    if states:
+        states = set(states.split(','))
+        jobs = [job for job in jobs if job["state"] in states]
+    if query.get("after"):
+        after = float(query.get("after"))
+        jobs = [job for job in jobs if job.get("timeCreated", 0) >= after]
+    if query.get("before"):
+        before = float(query.get("before"))
+        jobs = [job for job in jobs if job.get("timeCreated", 0) < before]
+
+    offset = int(query.get("offset") or 0)
+    limit = int(query.get("limit") or serverConfig["pageSize"])
+    if offset < 0 or limit < 0:
+        raise ValueError("offset and limit must not be negative")
+    return jobs[offset:offset + limit], len(jobs)
+
+
+def jsonBody(result, requestHeaders, status=200):
+    """Compact JSON response of result as (status, body, headers).
+
+    Unchanged responses (If-None-Match matching the ETag) are answered with
+    304 and no body, bodies of at least gzipMinSize bytes are compressed
+    for clients accepting gzip.
+    """
+    body = json.dumps(result, sort_keys=True,
+                      separators=(',', ':')).encode('utf-8')
+    # weak, the same ETag is sent for the compressed and plain body
+    etag = 'W/"{}"'.format(hashlib.md5(body).hexdigest())
+    headers = {
+        "Content-Type": "application/json",
+        "Cache-Control": "no-cache",
+        "ETag": etag,
+        "Vary": "Accept-Encoding"
+    }
+
+    known = requestHeaders.get('If-None-Match') or ''
+    if status == 200 and etag[2:] in [
+            tag.strip().replace('W/', '') for tag in known.split(',')
+    ]:
+        return 304, b'', headers
+
+    if len(body) >= serverConfig["gzipMinSize"] and \
+            'gzip' in (requestHeaders.get('Accept-Encoding') or ''):
+        body = gzip.compress(body, compresslevel=5)
+        headers["Content-Encoding"] = "gzip"
+    return status, body, headers
 
 
 def staticFileWithCors(filename, root, **params):
@@ -83,13 +376,7 @@ def enable_cors():
 
 @routeWithOptions(path='/bakeFile/<fileParam:path>', method="GET")
 def bakeFile(fileParam: str):
-    global bakingMan
-
-    jobParams = {"file": fileParam, "resolution": aoConfig["resolution"]}
-    # print(jobParams)
-    jobId = bakingMan.addJob(jobParams)
-    response.content_type = "application/json"
-    return {"jobId": jobId}
+    return jsonResponse(submitFile(fileParam, request.query))
 
 
 @routeWithOptions(path='/getFile/<filename:path>', method="GET")
@@ -112,122 +399,80 @@ def removeResults():
             print(e)
 
     print("remove cache files")
-    folder = cachedir
-    for the_file in os.listdir(folder):
-        file_path = os.path.join(folder, the_file)
-        try:
-            if os.path.isfile(file_path):
-                print("   remove", the_file)
-                os.unlink(file_path)
-        except Exception as e:
-            print(e)
+    cache.clear()
+
+    print("remove incremental bake states")
+    bakestate.clear()
+
+
+@routeWithOptions(path='/cacheStats/', method="GET")
+def cacheStats():
+    response.content_type = "application/json"
+    return json.dumps(cache.metrics())
 
 
 @routeWithOptions(path="/bakeUrl/", method="POST")
 def bakeUrl():
-    global bakingMan
     # print(request)
     # print(request.POST)
     # print(request.POST.__dict__)
     # print(request.headers.__dict__)
     # print(request.method)
 
-    jobSource = extractPostParams(request)
-
-    urlParam = jobSource["url"]
-    # print(urlParam)
-
-    resolutionParam = jobSource["resolution"]
-    resolutionValue = aoConfig["resolution"]
-    if resolutionParam is not None:
-        resolutionValue = int(resolutionParam)
-
-    args = {"url": urlParam, "resolution": resolutionValue}
-    # print(args)
-
-    jobId = bakingMan.addJob(args)
-    response.content_type = "application/json"
-    return {"jobId": jobId}
+    try:
+        jobSource, _ = extractPostParams(request)
+    except (ValueError, zlib.error) as e:
+        return jsonResponse(*bodyError(e))
+    return jsonResponse(submitUrl(jobSource))
 
 
 @routeWithOptions(path="/bakeDirect/", method="POST")
 def bakeDirect():
-    global bakingMan
     # print(request)
     # print(request.POST)
     # print(request.POST.__dict__)
     # print(request.headers.__dict__)
     # print(request.method)
 
-    jobSource = extractPostParams(request)
-
-    igxcString = jobSource["igxcContent"]
-    # print(igxcString)
-    if not igxcString or igxcString == "null":
-        colorprint("No igxcContent found in POST request in bakeDirect/", 31)
-        return {"error": "No igxcContent found in POST request in bakeDirect/"}
-
     try:
-        if isinstance(igxcString, str):
-            igxcContent = json.loads(igxcString)
-        else:
-            igxcContent = igxcString
-    except Exception as e:
-        colorprint("Exception in bakeDirect/", 31)
-        print(e)
-        return {"error": "igxcContent couldn't be parsed"}
-    # print(igxcContent)
+        jobSource, bodyDigest = extractPostParams(request)
+    except (ValueError, zlib.error) as e:
+        return jsonResponse(*bodyError(e))
+    return jsonResponse(submitDirect(jobSource, bodyDigest))
 
-    basePath = jobSource["basePath"]
-    # print(basepath)
 
-    resolutionValue = aoConfig["resolution"]
-    resolutionParam = jobSource["resolution"]
-    if resolutionParam is not None:
-        resolutionValue = int(resolutionParam)
-
-    args = {
-        "basePath": basePath,
-        "igxcContent": igxcContent,
-        "resolution": resolutionValue
-    }
-    # print(args)
-
-    jobId = bakingMan.addJob(args)
-    response.content_type = "application/json"
-    return {"jobId": jobId}
+def jsonResponse(result, status=200):
+    status, body, headers = jsonBody(result, request.headers, status)
+    response.status = status
+    for name, value in headers.items():
+        response.set_header(name, value)
+    return body
 
 
 @routeWithOptions(path='/pullState/<jobId>', method="GET")
 def pullState(jobId: str):
-    global bakingMan
     colorprint("pullState id {}".format(jobId), 33)
 
-    result = {"state": "undefined"}
-    if bakingMan.hasJob(jobId):
-        result = bakingMan.getJob(jobId)
+    result = bakingMan.getJobStatus(jobId) or {"state": "undefined"}
+    return jsonResponse(result)
 
-    # print(result)
-    jsonResult = json.dumps(result,
-                            sort_keys=True,
-                            indent=4,
-                            separators=(',', ': '))
-    response.content_type = "application/json"
-    return jsonResult
+
+@routeWithOptions(path='/getResult/<jobId>', method="GET")
+def getResult(jobId: str):
+    colorprint("getResult id {}".format(jobId), 33)
+    result = resultOf(jobId)
+    return jsonResponse(result, 200 if "error" not in result else 404)
 
 
 @routeWithOptions(path='/pullAll/', method="GET")
 def pullAll():
-    global bakingMan
     colorprint("pullAll", 33)
-    result = bakingMan.getAllJobs()
-    # print(result)
-    jsonResult = json.dumps(result,
-                            sort_keys=True,
-                            indent=4,
-                            separators=(',', ': '))
-    response.content_type = "application/json"
-    return jsonResult
+    try:
+        page, total = filterJobs(bakingMan.getAllJobs(), request.query)
+    except ValueError as e:
+        return jsonResponse({"error": str(e)}, 400)
+    response.set_header('X-Total-Count', str(total))
+    return jsonResponse(page)
 
 
 @routeWithOptions(path='/getImage/<jobId>', method="GET")
@@ -235,34 +480,80 @@ def getImage(jobId: str):
     global bakingMan
     absPath = os.path.join(os.path.abspath("."), default_out_dir)
     print(absPath)
-    if bakingMan.isJobFinished(jobId):
-        job = bakingMan.getJob(jobId)
-        fileName = job["jobArgs"]["out"] + ".png"
-        return staticFileWithCors(fileName, absPath)
-
-
-serverConfig = {"port": 8080, "host": "0.0.0.0"}
-
-try:
-    with open("config.json", "r") as f:
-        configContent = json.load(f)
-        if "port" in configContent:
-            serverConfig["port"] = configContent["port"]
-        if "host" in configContent:
-            serverConfig["host"] = configContent["host"]
-        if "resolution" in configContent:
-            aoConfig["resolution"] = configContent["resolution"]
-        print(serverConfig)
-        print(aoConfig)
-except FileNotFoundError:
-    print("Config file not found, using standard port", serverConfig["port"])
-
-try:
-    app.run(host=serverConfig["host"],
-            port=serverConfig["port"],
-            debug=True,
-            server=PasteServer)
-except KeyboardInterrupt:
-    pass
-finally:
-    bakingMan.stop()
+    job = bakingMan.getJob(jobId) if bakingMan.hasJob(jobId) else None
+    fileName = None
+    if job is not None and job["state"] == "finished":
+        fileName = job["urlAoMapImage"]
+    elif job is not None and request.query.get("partial") == "1":
+        # preview of a running bake, written after some of its tiles
+        fileName = job.get("urlAoMapPartial")
+
+    if fileName is None:
+        response.status = 404
+        return {"error": "no image for jobId {}".format(jobId)}
+    httpResponse = staticFileWithCors(fileName, absPath)
+    httpResponse.headers['Cache-Control'] = 'no-cache'
+    return httpResponse
+
+
+@routeWithOptions(path='/job/<jobId>', method="DELETE")
+def deleteJob(jobId: str):
+    colorprint("deleteJob id {}".format(jobId), 33)
+    return jsonResponse(*deletedJob(jobId))
+
+
+# longPollTimeout: seconds asyncserver holds a status request without changes
+# maxRequestSize: largest (decompressed) request body accepted, in bytes
+# pageSize: jobs per /pullAll/ response without a limit parameter
+# gzipMinSize: smallest JSON response compressed for clients accepting gzip
+serverConfig = {
+    "port": 8080,
+    "host": "0.0.0.0",
+    "longPollTimeout": 30.0,
+    "maxRequestSize": 256 * 1024 * 1024,
+    "pageSize": 100,
+    "gzipMinSize": 1024
+}
+
+
+def loadConfig():
+    try:
+        with open("config.json", "r") as f:
+            configContent = json.load(f)
+            for key in serverConfig:
+                if key in configContent:
+                    serverConfig[key] = configContent[key]
+            for key in aoConfig:
+                if key in configContent:
+                    aoConfig[key] = configContent[key]
+            for key in remoteConfig:
+                if key in configContent:
+                    remoteConfig[key] = configContent[key]
+            for key in bakingConfig:
+                if key in configContent:
+                    bakingConfig[key] = configContent[key]
+            configureCache()
+            print(serverConfig)
+            print(aoConfig)
+            print(remoteConfig)
+            print(bakingConfig)
+    except FileNotFoundError:
+        print("Config file not found, using standard port",
+              serverConfig["port"])
+
+
+if __name__ == '__main__':
+    # baking runs in spawned processes, which must not start the server
+    multiprocessing.freeze_support()
+    loadConfig()
+    bakingMan.start()
+
+    try:
+        app.run(host=serverConfig["host"],
+                port=serverConfig["port"],
+                debug=True,
+                server=PasteServer)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        bakingMan.stop()
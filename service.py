@@ -1,3 +1,4 @@
+import hashlib
 import json
 import numpy
 import math
@@ -5,6 +6,8 @@ import os
 import argparse
 import sys
 import random
+import struct
+import time
 
 # add dependencies for auto-py-to-exe
 # https://github.com/pyinstaller/pyinstaller/issues/4363#issuecomment-522350024
@@ -16,9 +19,12 @@ from PIL import Image
 from remote import fetch
 from pathlib import Path
 from urlpath import URL
-from util import colorprint, prepareOutFilename, test_scene, joinOutputPath
-from remote import CachedFile
+from util import colorprint, prepareOutFilename, prepareOutFilenameFromParts, \
+    test_scene, joinOutputPath
+from remote import CachedFile, cache
 
+import bakestate
+import dilate
 import igxc
 import scene
 import visitor
@@ -27,23 +33,280 @@ default_url = 'default/igcx/test-url'
 default_file = 'default/igcx/test-file'
 default_out = "test"
 
-aoConfig = {"resolution": 1024}
+# backend: "native" (ig_rendering_support), "numpy" (numpybake) or "auto";
+# numpy until a native build passes the agreement test of
+# tests/test_numpybake.py
+# cacheBvh: keep scene BVHs in the download cache for later bakes
+# tileTriangles: largest tile of a progressive bake, in triangles
+# partialInterval: seconds between previews of a running bake
+# dilation: texels the charts are grown by, None fills the whole atlas
+# mipLevels: downsampled AO maps written next to the full resolution one
+# packer: "area" sizes the atlas tiles by mesh surface, "grid" gives every
+# mesh the same square
+# bakeBudget: largest triangles x resolution^2 of a scene, larger ones are
+# rejected before baking; 0 for no limit
+# stateBudget, stateTTL: bytes and seconds since their last use the states
+# of incremental bakes are kept for; None for no limit
+aoConfig = {
+    "resolution": 1024,
+    "incremental": True,
+    "backend": "numpy",
+    "cacheBvh": True,
+    "tileTriangles": 65536,
+    "partialInterval": 5.0,
+    "quality": "final",
+    "dilation": None,
+    "mipLevels": 0,
+    "packer": "area",
+    "bakeBudget": 2000000 * 4096 * 4096,
+    "stateBudget": 4 * 1024 * 1024 * 1024,
+    "stateTTL": 7 * 24 * 60 * 60
+}
+
+# rays per texel: batches of rays are fired until the standard error of the
+# AO value is below maxError, within minSamples..maxSamples; "reference" is
+# the fixed 16x16 sampling of the original baker
+qualityPresets = {
+    "preview": {
+        "minSamples": 16,
+        "maxSamples": 128,
+        "batch": 16,
+        "maxError": 0.06
+    },
+    "final": {
+        "minSamples": 32,
+        "maxSamples": 512,
+        "batch": 16,
+        "maxError": 0.03
+    },
+    "reference": {
+        "minSamples": 256,
+        "maxSamples": 256,
+        "batch": 16,
+        "maxError": 0.0
+    }
+}
+
+backends = ("native", "numpy", "auto")
+
+# normals argument of bakeAO for face normals
+noNormals = numpy.zeros((0, 3, 3), dtype=numpy.float32)
+noNormals.flags.writeable = False
+
+
+def bakingBackend(name=None):
+    """Module providing bakeAO for the backend name."""
+    name = name or aoConfig["backend"]
+    if name not in backends:
+        raise ValueError("unknown baking backend '{}'".format(name))
+    if name != "numpy":
+        try:
+            import ig_rendering_support
+            return ig_rendering_support
+        except ImportError:
+            if name == "native":
+                raise
+            colorprint("ig_rendering_support not available, using numpy", 33)
+    import numpybake
+    return numpybake
+
+
+def samplingFor(quality=None) -> dict:
+    quality = quality or aoConfig["quality"]
+    if quality not in qualityPresets:
+        raise ValueError("unknown quality '{}'".format(quality))
+    return qualityPresets[quality]
+
+
+def sceneBvh(vertices, backend=None):
+    """BVH of the vertices, kept in the download cache and reused by bakes
+    of the same geometry (other resolutions, changed UV layouts)."""
+    module = bakingBackend(backend)
+    key = hashlib.sha1(
+        numpy.ascontiguousarray(vertices, dtype=numpy.float32)).hexdigest()
+    name = '{}.{}.bvh'.format(key, module.__name__)
+
+    filename = cache.lookup(name)
+    if filename is not None:
+        try:
+            bvh = module.BVH.load(str(filename))
+            colorprint("BVH from cache ({})".format(name), 32)
+            return bvh
+        except (RuntimeError, ValueError, OSError) as e:
+            colorprint("Discarding cached BVH {} ({})".format(name, e), 33)
+
+    start = time.perf_counter()
+    bvh = module.BVH(vertices)
+    colorprint(
+        "BVH of {} triangles built in {:.3f}s".format(
+            len(vertices),
+            time.perf_counter() - start), 36)
+    cache.storeWith(name, bvh.save)
+    return bvh
+
+
+def tilesFor(ranges, limit=None) -> list:
+    """Draw ranges (start, end, weight) of a tiled bake.
+
+    Every triangle range of a packer bucket is one tile, split into parts of
+    at most limit triangles; the parts share the weight of their bucket.
+    """
+    limit = limit or aoConfig["tileTriangles"]
+    tiles = []
+    for start, end in sorted(ranges):
+        if end <= start:
+            continue
+        parts = math.ceil((end - start) / limit)
+        bounds = numpy.linspace(start, end, parts + 1).astype(int)
+        for first, last in zip(bounds[:-1], bounds[1:]):
+            tiles.append((int(first), int(last), 1.0 / parts))
+    return tiles
+
+
+def bakeBuffer(vertices,
+               normals,
+               texcoord,
+               size=(aoConfig["resolution"], aoConfig["resolution"]),
+               threads=0,
+               backend=None,
+               bvh=None,
+               tiles=None,
+               buff=None,
+               progress=None,
+               sampling=None,
+               rays=None):
+    """Bakes the tiles (all triangles by default) into buff.
+
+    progress(fraction, buff) is called after every tile and may raise to
+    stop the bake. sampling is one of the qualityPresets, the rays fired per
+    texel are written to rays if given.
+    """
+    module = bakingBackend(backend)
+    if buff is None:
+        w, h = size
+        buff = numpy.zeros((w, h, 4), dtype=numpy.uint8)
+    if tiles is None:
+        tiles = [(0, len(texcoord), 1.0)]
+    gbuffer = None
+    if len(tiles) > 1:
+        if bvh is None:
+            bvh = module.BVH(vertices)
+        # the atlas is rasterized once, seams between tiles are shaded once
+        gbuffer = module.GBuffer(texcoord, buff.shape[0], buff.shape[1])
+
+    total = sum(weight for _, _, weight in tiles)
+    done = 0.0
+    for start, end, weight in tiles:
+        # threads == 0 lets the runtime use all cores
+        module.bakeAO(buff,
+                      vertices,
+                      normals,
+                      texcoord,
+                      threads,
+                      bvh,
+                      start,
+                      end,
+                      rays=rays,
+                      gbuffer=gbuffer,
+                      **(sampling or samplingFor()))
+        done += weight
+        if progress is not None:
+            progress(done / total, buff)
+    return buff
+
+
+def bufferToImages(buff, mipLevels=0) -> list:
+    """Dilated AO map followed by mipLevels downsampled levels."""
+    w, h = buff.shape[0], buff.shape[1]
+    # the buffer is laid out row by row, see out_fun in mapping_cpu.impala
+    levels = dilate.dilate(buff.reshape(h, w, 4), aoConfig["dilation"],
+                           mipLevels)
+    return [Image.fromarray(level) for level in levels]
+
+
+def bufferToImage(buff):
+    return bufferToImages(buff)[0]
 
 
 def generateMap(vertices,
                 normals,
                 texcoord,
-                size=(aoConfig["resolution"], aoConfig["resolution"])):
-    import ig_rendering_support
-
-    w, h = size
-    buff = numpy.zeros((w, h, 4), dtype=numpy.uint8)
-
-    ig_rendering_support.bakeAO(buff, vertices, normals, texcoord)
-
-    blurred = ig_rendering_support.alphaBlur(buff, w, h)
-
-    return Image.frombuffer('RGBA', (w, h), blurred, 'raw', 'RGBA', 0, 1)
+                size=(aoConfig["resolution"], aoConfig["resolution"]),
+                threads=0,
+                backend=None,
+                bvh=None,
+                tiles=None,
+                progress=None,
+                sampling=None,
+                rays=None):
+    return bufferToImage(
+        bakeBuffer(vertices,
+                   normals,
+                   texcoord,
+                   size,
+                   threads,
+                   backend,
+                   bvh,
+                   tiles,
+                   progress=progress,
+                   sampling=sampling,
+                   rays=rays))
+
+
+def bakeIncremental(stateKey,
+                    state,
+                    vertices,
+                    normals,
+                    texcoord,
+                    ranges,
+                    size,
+                    threads,
+                    backend=None,
+                    bvh=None,
+                    progress=None,
+                    sampling=None,
+                    rays=None):
+    """Bakes only the tiles affected by changes since the last bake of
+    the same scene and reuses the other tiles of the stored AO buffer."""
+    previousState, previousBuff = bakestate.load(stateKey)
+    affected = bakestate.affectedObjects(previousState, state)
+    if affected is None or previousBuff.shape[:2] != size:
+        tiles = tilesFor([r for objectRanges in ranges.values()
+                          for r in objectRanges])
+        buff = bakeBuffer(vertices,
+                          normals,
+                          texcoord,
+                          size,
+                          threads,
+                          backend,
+                          bvh,
+                          tiles,
+                          progress=progress,
+                          sampling=sampling,
+                          rays=rays)
+    else:
+        # old tiles of removed and moved objects would be dilated into
+        # their neighbours
+        stale = affected | (set(previousState["tiles"]) - set(state["tiles"]))
+        buff = bakestate.clearTiles(previousBuff, previousState["tiles"],
+                                    stale)
+        if len(affected) == 0:
+            colorprint("Reusing previous AO map, no affected objects", 32)
+        else:
+            colorprint(
+                "Incremental bake of {} of {} objects".format(
+                    len(affected), len(state["mapping"])), 32)
+            # only the affected objects are drawn, all triangles occlude
+            tiles = tilesFor(
+                [r for path in affected for r in ranges.get(path, [])])
+            buff = bakestate.clearTiles(buff, state["tiles"], affected)
+            buff = bakeBuffer(vertices, normals, texcoord, size, threads,
+                              backend, bvh, tiles, buff, progress, sampling,
+                              rays)
+
+    bakestate.save(stateKey, state, buff)
+    bakestate.expire(aoConfig["stateBudget"], aoConfig["stateTTL"], stateKey)
+    return buff
 
 
 def start():
@@ -75,6 +338,16 @@ def start():
     parser.add_argument('--face-normals',
                         help='use computed face normals',
                         action='store_true')
+    parser.add_argument('--threads',
+                        help='number of baking threads (0 for all cores)',
+                        type=int,
+                        default=0)
+    parser.add_argument('--backend',
+                        help='baking backend (default from config)',
+                        choices=backends)
+    parser.add_argument('--quality',
+                        help='AO sampling preset (default from config)',
+                        choices=sorted(qualityPresets))
     args = parser.parse_args()
     dictArgs = vars(args)
     # print(args)
@@ -91,19 +364,134 @@ def modifyIgxc(igxcJson, outFileName, mapping):
             tObject["AOTransform"] = mapping[nodeName]
 
 
-def startWithDirectArgs(args: dict):
+def outFilenameFor(igxcContent: dict,
+                   urlArgument,
+                   resolutionValue: int,
+                   quality=None) -> str:
+    """Output file name base identifying the baked configuration."""
+    # the serialized parts of multi-MB configurations are hashed one by
+    # one instead of being concatenated
+    parts = [
+        json.dumps(igxcContent[key], sort_keys=True)
+        for key in ("Objects", "Hashes") if igxcContent.get(key) is not None
+    ]
+    if len(parts) == 0 and urlArgument is not None:
+        parts = [str(urlArgument)]
+    # names of "final" bakes stay as before
+    if quality is not None and quality != "final":
+        parts.append(":" + quality)
+
+    return prepareOutFilenameFromParts(parts, resolutionValue)
+
+
+def packerFor(root: scene.SceneNode,
+              meshCount: int,
+              resolution: int,
+              placement=None):
+    """UV atlas packer configured by aoConfig["packer"]; the area packer
+    keeps the tiles of the given previous placement where it can."""
+    if aoConfig["packer"] == "area":
+        meshAreas = visitor.MeshAreas()
+        root.accept(meshAreas)
+        return visitor.AreaPacker(meshAreas.areas,
+                                  meshAreas.uvAreas,
+                                  meshAreas.uvBounds,
+                                  resolution,
+                                  names=meshAreas.names,
+                                  placement=placement)
+
+    amountBucketsX = math.ceil(math.sqrt(meshCount))
+    amountBucketsY = math.ceil(meshCount / amountBucketsX)
+    print('buckets: {}x{}'.format(amountBucketsX, amountBucketsY))
+    return visitor.SimplePacker(amountBucketsX, amountBucketsY, resolution)
+
+
+def mipNamesFor(outFileNameBase: str, mipLevels: int) -> list:
+    return [
+        outFileNameBase + '_mip{}'.format(level)
+        for level in range(1, mipLevels + 1)
+    ]
+
+
+def cachedResult(outFileNameBase: str, igxcContent: dict):
+    """Result of a previous bake with the same output name, or None."""
+    hasImage = os.path.isfile(joinOutputPath(outFileNameBase, 'png'))
+    hasMapping = os.path.isfile(joinOutputPath(outFileNameBase, 'json'))
+    if not hasImage or not hasMapping:
+        return None
+
+    mappingResult = None
+    with open(joinOutputPath(outFileNameBase, 'json'), 'r') as mappingInFile:
+        mappingResult = json.load(mappingInFile)
+    modifyIgxc(igxcContent, outFileNameBase + '.png', mappingResult)
+    mipNames = mipNamesFor(outFileNameBase, aoConfig["mipLevels"])
+    mipNames = [
+        name for name in mipNames
+        if os.path.isfile(joinOutputPath(name, 'png'))
+    ]
+    result = {
+        "urlAoMapImage": outFileNameBase + '.png',
+        "urlAoMappingJson": outFileNameBase + '.json',
+        "urlIgxcModified": outFileNameBase + '.igxc',
+        "urlIgxcOriginal": outFileNameBase + '_original.igxc',
+        "urlAoMapMips": [name + '.png' for name in mipNames],
+        "transforms": mappingResult,
+        "igxcModified": igxcContent
+    }
+    return result
+
+
+class BakeCancelled(Exception):
+    pass
+
+
+def triangleLimit(resolution: int):
+    # most triangles of a scene baked at resolution within the budget
+    if not aoConfig["bakeBudget"]:
+        return None
+    return aoConfig["bakeBudget"] // (resolution * resolution)
+
+
+def tooLargeError(triangles: int, limit: int) -> str:
+    return "scene too large ({} triangles, at most {} at this " \
+        "resolution)".format(triangles, limit)
+
+
+def budgetError(igxcContent: dict, basePath, resolution: int):
+    """Error message if the geometry of the igxc available without
+    downloading exceeds the bake budget, None otherwise."""
+    limit = triangleLimit(resolution)
+    if limit is None:
+        return None
+    basePath = CachedFile(basePath) if basePath else None
+    try:
+        triangles = igxc.sceneTriangles(
+            igxcContent, igxc.availableGeometries(igxcContent, basePath))
+    except (IOError, struct.error, TypeError, AttributeError) as e:
+        # the job reports broken files
+        print(e)
+        return None
+    if triangles > limit:
+        return tooLargeError(triangles, limit)
+    return None
+
+
+def startWithDirectArgs(args: dict, progress=None):
+    """Runs a bake job; progress(fraction, urlAoMapPartial) is called after
+    every baked tile and may raise BakeCancelled to stop the job."""
     root = None
     igxcFile = None
     igxcContent = None
     urlArgument = None
     basePath = None
     result = None
-    outFileHashBase = ""
     outFileNameBase = "AO_result"
 
     resolutionValue = aoConfig["resolution"]
     if "resolution" in args and args["resolution"] is not None:
         resolutionValue = int(args["resolution"])
+    quality = args.get("quality") or aoConfig["quality"]
+    sampling = samplingFor(quality)
 
     if "url" in args and args["url"] is not None:
         print('fetch url', args["url"])
@@ -145,50 +533,36 @@ def startWithDirectArgs(args: dict):
         print("No content in igxc")
 
     # check if configuration is already done
-    if "Objects" in igxcContent and igxcContent["Objects"] is not None:
-        outFileHashBase = outFileHashBase + json.dumps(igxcContent["Objects"],
-                                                       sort_keys=True)
-    if "Hashes" in igxcContent and igxcContent["Hashes"] is not None:
-        outFileHashBase = outFileHashBase + json.dumps(igxcContent["Hashes"],
-                                                       sort_keys=True)
-    if outFileHashBase == "" and urlArgument is not None:
-        outFileHashBase = urlArgument
-
-    outFileNameBase = prepareOutFilename(outFileHashBase, resolutionValue)
-
-    hasImage = os.path.isfile(joinOutputPath(outFileNameBase, 'png'))
-    hasMapping = os.path.isfile(joinOutputPath(outFileNameBase, 'json'))
-    if hasImage and hasMapping and not debug:
-        colorprint("Taking from cache ({})".format(outFileNameBase), 32)
-        mappingResult = None
-        with open(joinOutputPath(outFileNameBase, 'json'),
-                  'r') as mappingInFile:
-            mappingResult = json.load(mappingInFile)
-        modifyIgxc(igxcContent, outFileNameBase + '.png', mappingResult)
-        result = {
-            "urlAoMapImage": outFileNameBase + '.png',
-            "urlAoMappingJson": outFileNameBase + '.json',
-            "urlIgxcModified": outFileNameBase + '.igxc',
-            "urlIgxcOriginal": outFileNameBase + '_original.igxc',
-            "transforms": mappingResult,
-            "igxcModified": igxcContent
-        }
-        return result
-
-    # save unmodified version of igxc
     if igxcContent is not None:
-        igxcOutfileName = joinOutputPath(outFileNameBase + "_original", 'igxc')
+        outFileNameBase = args.get("outFileNameBase") or outFilenameFor(
+            igxcContent, urlArgument, resolutionValue, quality)
+
+        result = None if debug else cachedResult(outFileNameBase,
+                                                 igxcContent)
+        if result is not None:
+            colorprint("Taking from cache ({})".format(outFileNameBase), 32)
+            return result
+
+    # save unmodified version of igxc, unless the server stored it as it
+    # was posted; compact, indenting large configurations takes seconds
+    igxcOutfileName = joinOutputPath(outFileNameBase + "_original", 'igxc')
+    if igxcContent is not None and not os.path.isfile(igxcOutfileName):
         with open(igxcOutfileName, 'w') as igxcOutfile:
-            json.dump(igxcContent,
-                      igxcOutfile,
-                      indent=4,
-                      separators=(',', ': '),
-                      sort_keys=False)
+            igxcOutfile.write(json.dumps(igxcContent))
 
     # result not in cache? proceed with baking
-    root = None
     try:
-        root = igxc.load(igxcContent, basePath)
+        if root is None:
+            root = igxc.load(igxcContent, basePath,
+                             triangleLimit(resolutionValue))
+    except igxc.SceneTooLarge as e:
+        errorMsg = tooLargeError(*e.args)
+        colorprint("startWithDirectArgs: " + errorMsg, 31)
+        result = {
+            "error": errorMsg,
+            "urlIgxcOriginal": outFileNameBase + '_original.igxc'
+        }
+        return result
     except AttributeError as e:
         errorMsg = "attributes missing in igxc ({})".format(" ".join(e.args))
         colorprint("startWithDirectArgs: " + errorMsg, 31)
@@ -223,41 +597,112 @@ def startWithDirectArgs(args: dict):
     root.accept(triCounter)
     print('total triangles', triCounter.count)
 
-    vertices = numpy.ndarray((triCounter.count, 3, 3), dtype=numpy.float)
-    normals = numpy.ndarray((triCounter.count, 3, 3), dtype=numpy.float)
-    texcoord = numpy.ndarray((triCounter.count, 3, 2), dtype=numpy.float)
+    # float32 C-contiguous, as bakeAO takes them without copies; the
+    # normals are not extracted at all for face normals
+    faceNormals = bool(args.get("face_normals"))
+    vertices = numpy.empty((triCounter.count, 3, 3), dtype=numpy.float32)
+    normals = None if faceNormals else numpy.empty(
+        (triCounter.count, 3, 3), dtype=numpy.float32)
+    texcoord = numpy.empty((triCounter.count, 3, 2), dtype=numpy.float32)
 
     meshCounter = visitor.MeshCounter()
     root.accept(meshCounter)
     print('total meshes', meshCounter.count)
 
-    amountBucketsX = math.ceil(math.sqrt(meshCounter.count))
-    amountBucketsY = math.ceil(meshCounter.count / amountBucketsX)
-    print('buckets: {}x{}'.format(amountBucketsX, amountBucketsY))
-    uvPacker = visitor.SimplePacker(amountBucketsX, amountBucketsY,
-                                    resolutionValue)
+    incremental = aoConfig["incremental"] and igxcContent is not None \
+        and not debug
+    placement = None
+    if incremental:
+        stateKey = bakestate.sceneKey(igxcContent, basePath, resolutionValue,
+                                      quality)
+        placement = bakestate.placementOf(stateKey)
+
+    uvPacker = packerFor(root, meshCounter.count, resolutionValue, placement)
     triExtractor = visitor.TransformedTriExtractor(vertices,
                                                    normals,
                                                    texcoord,
                                                    packer=uvPacker)
     root.accept(triExtractor)
 
-    # if face normals should be used, empty normals array
-    if "face_normals" in args and args["face_normals"] == True:
-        normals = numpy.zeros((0, 3, 3), dtype=numpy.float)
+    if faceNormals:
+        normals = noNormals
 
     # print(vertices)
     # print(texcoord)
     # print(triExtractor.mapping)
     # print("Packer:", uvPacker.i)
 
-    img = generateMap(vertices, normals, texcoord,
-                      (resolutionValue, resolutionValue))
+    threads = 0
+    if "threads" in args and args["threads"] is not None:
+        threads = int(args["threads"])
+    backend = args.get("backend") or aoConfig["backend"]
+    bvh = sceneBvh(vertices, backend) if aoConfig["cacheBvh"] else None
+
+    partialName = outFileNameBase + '_partial'
+    lastPartial = time.perf_counter()
+
+    def tileDone(fraction, buff):
+        # preview of the partially baked map every partialInterval seconds
+        nonlocal lastPartial
+        urlPartial = None
+        now = time.perf_counter()
+        if fraction < 1.0 and \
+                now - lastPartial >= aoConfig["partialInterval"]:
+            bufferToImage(buff).save(
+                joinOutputPath(partialName, 'png'))
+            lastPartial = now
+            urlPartial = partialName + '.png'
+        if progress is not None:
+            progress(fraction, urlPartial)
+
+    size = (resolutionValue, resolutionValue)
+    rays = numpy.zeros(size, dtype=numpy.int32)
+    if incremental:
+        state = {
+            "objects": bakestate.objectHashes(igxcContent),
+            "hashes": bakestate.jsonHash(igxcContent.get("Hashes")),
+            "mapping": triExtractor.mapping,
+            "tiles": triExtractor.tiles,
+            "bounds": bakestate.objectBounds(vertices, triExtractor.ranges)
+        }
+        if isinstance(uvPacker, visitor.AreaPacker):
+            state["placement"] = uvPacker.placement()
+        buff = bakeIncremental(stateKey, state, vertices, normals, texcoord,
+                               triExtractor.ranges, size, threads, backend,
+                               bvh, tileDone, sampling, rays)
+    else:
+        tiles = tilesFor([
+            r for objectRanges in triExtractor.ranges.values()
+            for r in objectRanges
+        ])
+        buff = bakeBuffer(vertices,
+                          normals,
+                          texcoord,
+                          size,
+                          threads,
+                          backend,
+                          bvh,
+                          tiles,
+                          progress=tileDone,
+                          sampling=sampling,
+                          rays=rays)
+    images = bufferToImages(buff, aoConfig["mipLevels"])
+    img = images[0]
+
+    # average over the texels traced by this bake
+    traced = numpy.count_nonzero(rays)
+    raysPerTexel = float(rays.sum()) / traced if traced > 0 else 0.0
+    print('{} quality: {:.1f} rays per texel'.format(quality, raysPerTexel))
 
     # save AO map image
     output = joinOutputPath(outFileNameBase, 'png')
     print("Save output at", joinOutputPath(outFileNameBase, 'png'))
     img.save(output)
+    mipNames = mipNamesFor(outFileNameBase, len(images) - 1)
+    for name, mip in zip(mipNames, images[1:]):
+        mip.save(joinOutputPath(name, 'png'))
+    if os.path.isfile(joinOutputPath(partialName, 'png')):
+        os.unlink(joinOutputPath(partialName, 'png'))
 
     # save AO mapping
     mappingOutfileName = joinOutputPath(outFileNameBase, 'json')
@@ -288,8 +733,11 @@ def startWithDirectArgs(args: dict):
         "urlAoMappingJson": outFileNameBase + '.json',
         "urlIgxcModified": outFileNameBase + '.igxc',
         "urlIgxcOriginal": outFileNameBase + '_original.igxc',
+        "urlAoMapMips": [name + '.png' for name in mipNames],
         "transforms": triExtractor.mapping,
-        "igxcModified": igxcContent
+        "igxcModified": igxcContent,
+        "quality": quality,
+        "raysPerTexel": raysPerTexel
     }
     return result
 
@@ -1,7 +1,15 @@
 #include <pybind11/pybind11.h>
 #include <pybind11/numpy.h>
 
+#include <cstdint>
+#include <cstring>
+#include <fstream>
 #include <iostream>
+#include <memory>
+#include <numeric>
+#include <stdexcept>
+#include <string>
+#include <vector>
 
 #include "interface.h"
 #include "bvh.h"
@@ -180,6 +188,155 @@ namespace py = pybind11;
 static constexpr size_t N = 8;
 static constexpr size_t M = 4;
 
+// BVH of a scene, built once and reused by several bakeAO calls
+struct SceneBvh {
+    std::vector<typename BvhNTriM<N, M>::Node> nodes;
+    std::vector<typename BvhNTriM<N, M>::Tri> tris;
+    uint64_t num_tris = 0;
+};
+
+static const char bvh_magic[8] = {'I', 'G', 'B', 'V', 'H', '8', '4', '\0'};
+
+struct BvhHeader {
+    char magic[8];
+    uint64_t num_tris;
+    uint64_t num_nodes;
+    uint64_t num_packets;
+    uint32_t node_size;
+    uint32_t tri_size;
+};
+
+// Float arrays are taken as they are: the arguments are declared noconvert,
+// so arrays of another dtype or layout are rejected instead of being copied.
+using FloatArray = py::array_t<float, py::array::c_style>;
+
+static void check_triangles(const char* name, const FloatArray& array, py::ssize_t width) {
+    if (array.ndim() != 3 || array.shape(1) != 3 || array.shape(2) != width)
+        throw std::invalid_argument(std::string(name) + " must have shape (n, 3, " +
+                                    std::to_string(width) + ")");
+}
+
+static std::unique_ptr<SceneBvh> make_bvh(FloatArray vertices) {
+    check_triangles("vertices", vertices, 3);
+    auto bvh = std::make_unique<SceneBvh>();
+    py::buffer_info v = vertices.request();
+    auto vptr = reinterpret_cast<const float3*>(v.ptr);
+    bvh->num_tris = numeric_cast<uint64_t>(vertices.shape(0));
+
+    /* vertices stays referenced, so the buffer is valid without the GIL */
+    py::gil_scoped_release release;
+    build_bvh<N, M>(vptr, bvh->num_tris, bvh->nodes, bvh->tris);
+    return bvh;
+}
+
+static void save_bvh(const SceneBvh& bvh, const std::string& path) {
+    py::gil_scoped_release release;
+
+    BvhHeader header;
+    std::memcpy(header.magic, bvh_magic, sizeof(bvh_magic));
+    header.num_tris = bvh.num_tris;
+    header.num_nodes = bvh.nodes.size();
+    header.num_packets = bvh.tris.size();
+    header.node_size = sizeof(typename BvhNTriM<N, M>::Node);
+    header.tri_size = sizeof(typename BvhNTriM<N, M>::Tri);
+
+    std::ofstream out(path, std::ios::binary);
+    out.write(reinterpret_cast<const char*>(&header), sizeof(header));
+    out.write(reinterpret_cast<const char*>(bvh.nodes.data()), header.num_nodes * header.node_size);
+    out.write(reinterpret_cast<const char*>(bvh.tris.data()), header.num_packets * header.tri_size);
+    if (!out)
+        throw std::runtime_error("could not write BVH to " + path);
+}
+
+static std::unique_ptr<SceneBvh> load_bvh(const std::string& path) {
+    py::gil_scoped_release release;
+
+    std::ifstream in(path, std::ios::binary);
+    BvhHeader header;
+    in.read(reinterpret_cast<char*>(&header), sizeof(header));
+    if (!in || std::memcmp(header.magic, bvh_magic, sizeof(bvh_magic)) != 0 ||
+        header.node_size != sizeof(typename BvhNTriM<N, M>::Node) ||
+        header.tri_size != sizeof(typename BvhNTriM<N, M>::Tri))
+        throw std::runtime_error("not a compatible BVH file: " + path);
+
+    auto bvh = std::make_unique<SceneBvh>();
+    bvh->num_tris = header.num_tris;
+    bvh->nodes.resize(header.num_nodes);
+    bvh->tris.resize(header.num_packets);
+    in.read(reinterpret_cast<char*>(bvh->nodes.data()), header.num_nodes * header.node_size);
+    in.read(reinterpret_cast<char*>(bvh->tris.data()), header.num_packets * header.tri_size);
+    if (!in)
+        throw std::runtime_error("truncated BVH file: " + path);
+    return bvh;
+}
+
+// Covered texels of an atlas, rasterized once and shared by the tiles of a
+// bake. Every texel is listed once, under the last triangle covering it;
+// the texels of triangle t are the entries firsts[t - begin]..firsts[t - begin + 1].
+struct AtlasGBuffer {
+    py::ssize_t width = 0;
+    py::ssize_t height = 0;
+    py::ssize_t begin = 0;
+    std::vector<int32_t> firsts;
+    std::vector<int32_t> texels;
+    std::vector<int32_t> tris;
+    std::vector<float> bcs;  // weights of v0 and v1
+
+    py::ssize_t num_tris() const { return numeric_cast<py::ssize_t>(firsts.size()) - 1; }
+};
+
+static std::unique_ptr<AtlasGBuffer> rasterize_atlas(float* tptr, py::ssize_t w, py::ssize_t h,
+                                                     py::ssize_t begin, py::ssize_t end) {
+    auto gbuffer = std::make_unique<AtlasGBuffer>();
+    gbuffer->width = w;
+    gbuffer->height = h;
+    gbuffer->begin = begin;
+
+    // triangle (-1 where empty) and barycentric weights per texel, only
+    // needed until the covered texels are sorted by triangle
+    std::vector<int32_t> tri(w * h, -1);
+    std::vector<float> bc(2 * w * h);
+    aoraster(numeric_cast<int>(w), numeric_cast<int>(h), tptr,
+             numeric_cast<int>(begin), numeric_cast<int>(end),
+             tri.data(), bc.data());
+
+    auto& firsts = gbuffer->firsts;
+    firsts.assign(end - begin + 1, 0);
+    for (auto t : tri) {
+        if (t >= 0)
+            firsts[t - begin + 1]++;
+    }
+    std::partial_sum(firsts.begin(), firsts.end(), firsts.begin());
+
+    auto count = firsts.back();
+    gbuffer->texels.resize(count);
+    gbuffer->tris.resize(count);
+    gbuffer->bcs.resize(2 * count);
+    std::vector<int32_t> next(firsts.begin(), firsts.end() - 1);
+    for (py::ssize_t i = 0; i < w * h; i++) {
+        if (tri[i] < 0)
+            continue;
+        auto k = next[tri[i] - begin]++;
+        gbuffer->texels[k] = numeric_cast<int32_t>(i);
+        gbuffer->tris[k] = tri[i];
+        gbuffer->bcs[2 * k] = bc[2 * i];
+        gbuffer->bcs[2 * k + 1] = bc[2 * i + 1];
+    }
+    return gbuffer;
+}
+
+static std::unique_ptr<AtlasGBuffer> make_gbuffer(FloatArray texcoord, py::ssize_t width, py::ssize_t height) {
+    check_triangles("texcoord", texcoord, 2);
+    if (width <= 0 || height <= 0)
+        throw std::invalid_argument("width and height must be positive");
+    py::buffer_info t = texcoord.request();
+    auto tptr = reinterpret_cast<float*>(t.ptr);
+
+    /* texcoord stays referenced, so the buffer is valid without the GIL */
+    py::gil_scoped_release release;
+    return rasterize_atlas(tptr, width, height, 0, texcoord.shape(0));
+}
+
 PYBIND11_MODULE(ig_rendering_support, m) {
     m.doc() = R"pbdoc(
         Pybind11 example plugin
@@ -194,17 +351,73 @@ PYBIND11_MODULE(ig_rendering_support, m) {
            subtract
     )pbdoc";
 
+    py::class_<SceneBvh>(m, "BVH", R"pbdoc(
+        BVH of a triangle array for bakeAO
+
+        Built from vertices of shape (n, 3, 3) without holding the GIL.
+    )pbdoc")
+        .def(py::init(&make_bvh), py::arg("vertices").noconvert())
+        .def_static("load", &load_bvh, py::arg("path"),
+            "Loads a BVH written by save")
+        .def("save", &save_bvh, py::arg("path"),
+            "Writes the BVH to a file")
+        .def_property_readonly("triangleCount", [](const SceneBvh& bvh) {
+            return bvh.num_tris;
+        })
+        .def_property_readonly("nbytes", [](const SceneBvh& bvh) {
+            return bvh.nodes.size() * sizeof(typename BvhNTriM<N, M>::Node) +
+                   bvh.tris.size() * sizeof(typename BvhNTriM<N, M>::Tri);
+        });
+
+    py::class_<AtlasGBuffer>(m, "GBuffer", R"pbdoc(
+        Rasterized atlas of a texcoord array for bakeAO
+
+        Built from texcoord of shape (n, 3, 2) for a width x height map
+        without holding the GIL. Passed to the bakeAO calls of a tiled bake,
+        the atlas is rasterized once and every covered texel is shaded by
+        the one tile drawing the last triangle covering it.
+    )pbdoc")
+        .def(py::init(&make_gbuffer), py::arg("texcoord").noconvert(),
+             py::arg("width"), py::arg("height"))
+        .def_property_readonly("triangleCount", &AtlasGBuffer::num_tris)
+        .def_property_readonly("texelCount", [](const AtlasGBuffer& gbuffer) {
+            return gbuffer.texels.size();
+        })
+        .def_property_readonly("nbytes", [](const AtlasGBuffer& gbuffer) {
+            return (gbuffer.firsts.size() + gbuffer.texels.size() + gbuffer.tris.size()) * sizeof(int32_t) +
+                   gbuffer.bcs.size() * sizeof(float);
+        });
+
 	m.def("bakeAO", [](
-        py::array_t<uint8_t, py::array::c_style | py::array::forcecast> data,
-        py::array_t<float, py::array::c_style | py::array::forcecast> vertices,
-        py::array_t<float, py::array::c_style | py::array::forcecast> normals,
-        py::array_t<float, py::array::c_style | py::array::forcecast> texcoord
+        py::array_t<uint8_t, py::array::c_style> data,
+        FloatArray vertices,
+        FloatArray normals,
+        FloatArray texcoord,
+        int num_threads,
+        const SceneBvh* bvh,
+        py::ssize_t begin,
+        py::ssize_t end,
+        int min_samples,
+        int max_samples,
+        int batch,
+        float max_error,
+        py::object rays,
+        const AtlasGBuffer* gbuffer
 	) {
 		std::cout << "bakeAO called" << std::endl;
 
+        if (data.ndim() != 3 || data.shape(2) != 4)
+            throw std::invalid_argument("data must have shape (w, h, 4)");
+        check_triangles("vertices", vertices, 3);
+        check_triangles("normals", normals, 3);
+        check_triangles("texcoord", texcoord, 2);
+        if (normals.shape(0) != 0 && normals.shape(0) != vertices.shape(0))
+            throw std::invalid_argument("normals must be empty or given for every triangle");
+        if (texcoord.shape(0) != vertices.shape(0))
+            throw std::invalid_argument("texcoord must be given for every triangle");
+
 		py::ssize_t w = data.shape(0);
 		py::ssize_t h = data.shape(1);
-        assert(data.shape(2) == 4);
 		py::buffer_info d = data.request(true);
 		char* dptr = reinterpret_cast<char*>(d.ptr);
 		std::cout << "image(" << w << "x" << h << ")" << std::endl;
@@ -224,26 +437,97 @@ PYBIND11_MODULE(ig_rendering_support, m) {
 		auto tptr = reinterpret_cast<float*>(t.ptr);
 		std::cout << "texcoord for " << numt << " triangles" << std::endl;
 
-        std::vector<typename BvhNTriM<N, M>::Node> nodes;
-        std::vector<typename BvhNTriM<N, M>::Tri> tris;
-        build_bvh<N, M>(vptr, numv, nodes, tris);
-        
+        if (bvh != nullptr && bvh->num_tris != numeric_cast<uint64_t>(numv))
+            throw std::invalid_argument("BVH was built for a different number of triangles");
+        if (gbuffer != nullptr && (gbuffer->width != w || gbuffer->height != h ||
+                                   gbuffer->num_tris() != numt))
+            throw std::invalid_argument("GBuffer was built for a different map or number of triangles");
+
+        // triangles begin..end of texcoord are drawn, end < 0 draws up to the last one
+        if (end < 0 || end > numt)
+            end = numt;
+        begin = std::max<py::ssize_t>(0, std::min(begin, end));
+
+        // rays fired per drawn texel, written to rays if given
+        using RayCounts = py::array_t<int32_t, py::array::c_style>;
+        int32_t* rptr = nullptr;
+        if (!rays.is_none()) {
+            if (!py::isinstance<RayCounts>(rays) || rays.cast<RayCounts>().size() < w * h)
+                throw std::invalid_argument("rays must be a contiguous int32 array with one entry per texel");
+            rptr = rays.cast<RayCounts>().mutable_data();
+        }
+        max_samples = std::max(max_samples, 1);
+        min_samples = std::max(1, std::min(min_samples, max_samples));
+
         /* Release GIL before calling into (potentially long-running) C++ code */
         py::gil_scoped_release release;
-        
+
+        SceneBvh scene;
+        if (bvh == nullptr) {
+            build_bvh<N, M>(vptr, numv, scene.nodes, scene.tris);
+            bvh = &scene;
+        }
+
+        // without a shared G-buffer only the drawn triangles are rasterized
+        std::unique_ptr<AtlasGBuffer> own;
+        if (gbuffer == nullptr) {
+            own = rasterize_atlas(tptr, w, h, begin, end);
+            gbuffer = own.get();
+        }
+        auto first = gbuffer->firsts[begin - gbuffer->begin];
+        auto count = gbuffer->firsts[end - gbuffer->begin] - first;
+        if (count == 0)
+            return;
+        std::vector<int32_t> samples(count);
+
 		aomap(
             numeric_cast<int>(w), numeric_cast<int>(h), dptr,
             numeric_cast<int>(numv), reinterpret_cast<float*>(vptr),
             numeric_cast<int>(numn), reinterpret_cast<float*>(nptr),
             numeric_cast<int>(numt), tptr,
-            nodes.data(), tris.data());
-
-        /* Acquire GIL before calling Python code */
-        py::gil_scoped_acquire acquire;
-    }, R"pbdoc(
+            const_cast<typename BvhNTriM<N, M>::Node*>(bvh->nodes.data()),
+            const_cast<typename BvhNTriM<N, M>::Tri*>(bvh->tris.data()),
+            num_threads,
+            min_samples, max_samples, batch, max_error,
+            const_cast<int32_t*>(gbuffer->texels.data() + first),
+            const_cast<int32_t*>(gbuffer->tris.data() + first),
+            const_cast<float*>(gbuffer->bcs.data() + 2 * first),
+            count, samples.data());
+
+        if (rptr != nullptr) {
+            for (int32_t k = 0; k < count; k++)
+                rptr[gbuffer->texels[first + k]] = samples[k];
+        }
+    }, py::arg("data").noconvert(), py::arg("vertices").noconvert(),
+       py::arg("normals").noconvert(), py::arg("texcoord").noconvert(),
+       py::arg("threads") = 0, py::arg("bvh") = static_cast<const SceneBvh*>(nullptr),
+       py::arg("begin") = 0, py::arg("end") = -1,
+       py::arg("minSamples") = 256, py::arg("maxSamples") = 256,
+       py::arg("batch") = 16, py::arg("maxError") = 0.0f,
+       py::arg("rays") = py::none(),
+       py::arg("gbuffer") = static_cast<const AtlasGBuffer*>(nullptr),
+    R"pbdoc(
         Run bakeAO
 
-        Some other explanation about the bakeAO function.
+        Bakes ambient occlusion into data using the given number of threads
+        (0 lets the runtime use all cores). A BVH of the vertices can be
+        passed to skip building it; only occlusion is looked up in it, so
+        any triangle order of the same geometry is fine. Only the triangles
+        begin..end are drawn, which lets a bake be split into tiles. The
+        triangles are rasterized first, then every covered texel is shaded
+        once, by the last triangle covering it. The tiles of a bake should
+        share a GBuffer of the texcoord: the atlas is then rasterized once,
+        and texels on seams between tiles are shaded by one tile only.
+
+        Every texel fires batches of rays until the standard error of its
+        AO value is below maxError, within minSamples..maxSamples rays; the
+        defaults sample 256 rays like the original fixed sampling. The ray
+        count of every drawn texel is written to the int32 array rays.
+
+        vertices, normals and texcoord must be C-contiguous float32 arrays
+        of shape (n, 3, 3), (n or 0, 3, 3) and (n, 3, 2), data a
+        C-contiguous uint8 array; other arrays are rejected with a
+        TypeError instead of being copied.
     )pbdoc");
 
 
@@ -0,0 +1,169 @@
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import bakerman
+
+
+def failToLoad():
+    raise RuntimeError("cannot load")
+
+
+class Unreadable(object):
+    def __reduce__(self):
+        return (failToLoad, ())
+
+
+def sendUnreadable(jobId, args, config, connection, cancelled):
+    # a result the server process cannot unpickle, the process keeps running
+    connection.send(("result", Unreadable()))
+    time.sleep(60)
+
+
+def bakedOutput(name):
+    return {
+        "urlAoMapImage": name + ".png",
+        "urlAoMappingJson": name + ".json",
+        "urlIgxcModified": name + ".igxc",
+        "urlIgxcOriginal": name + "_original.igxc",
+        "transforms": {},
+        "igxcModified": {}
+    }
+
+
+class BakingManTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.config = mock.patch.dict(bakerman.bakingConfig,
+                                      persistJobs=False)
+        self.config.start()
+        self.man = bakerman.BakingMan(workers=1)
+        self.man.results = bakerman.ResultStore(Path(self.directory.name))
+
+    def tearDown(self):
+        self.man.stop()
+        self.config.stop()
+        self.directory.cleanup()
+
+    def waitFor(self, jobId, timeout=60.0):
+        deadline = time.monotonic() + timeout
+        while self.man.getJobVersion(jobId)[1] is not None:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.05)
+        return self.man.getJob(jobId)
+
+    def testUnreadableResultFinishesTheJob(self):
+        with mock.patch.object(bakerman, "runInProcess", sendUnreadable):
+            self.man.start()
+            jobId = str(self.man.addJob({"test": True}))
+            job = self.waitFor(jobId)
+        self.assertEqual(job["state"], "error")
+        self.assertIn("lost the baking process", job["error"])
+        self.assertTrue(all(worker.is_alive() for worker in self.man.threads))
+
+    def testConcurrentCancelFinishesOnce(self):
+        jobId = str(self.man.addJob({"test": True}))
+        finish = self.man.finishJob
+        seconds = []
+
+        def finishJob(result):
+            # a second DELETE arriving while the first one finishes the job
+            seconds.append(self.man.cancelJob(jobId))
+            finish(result)
+
+        self.man.finishJob = finishJob
+        self.assertTrue(self.man.cancelJob(jobId))
+        self.assertEqual(seconds, [False])
+        self.assertEqual(self.man.getJobStatus(jobId)["state"], "cancelled")
+        self.assertFalse(self.man.cancelJob(jobId))
+
+    def testPendingRequestsAreCoalesced(self):
+        first = self.man.addJob({"test": True}, key="scene")
+        self.assertEqual(self.man.addJob({"test": True}, key="scene"), first)
+        other = self.man.addJob({"test": True}, key="other")
+        self.assertNotEqual(other, first)
+        self.assertNotEqual(self.man.addJob({"test": True}), first)
+        self.assertEqual(len(self.man.queue), 3)
+
+    def testFinishedJobsReleaseTheirKey(self):
+        first = self.man.addJob({"test": True}, key="scene")
+        self.man.cancelJob(str(first))
+        second = self.man.addJob({"test": True}, key="scene")
+        self.assertNotEqual(second, first)
+        self.assertEqual(self.man.getJobStatus(str(second))["state"],
+                         "pending")
+
+    def testSuccessfulResultsAreReusedByKey(self):
+        first = self.man.addFinishedJob({}, bakedOutput("scene"), key="scene")
+        self.assertEqual(
+            self.man.addFinishedJob({}, bakedOutput("scene"), key="scene"),
+            first)
+        failed = self.man.addFinishedJob({}, {"error": "failed"}, key="bad")
+        self.assertNotEqual(
+            self.man.addFinishedJob({}, {"error": "failed"}, key="bad"),
+            failed)
+
+    def testFinishedJobsAreReadBack(self):
+        jobId = str(self.man.addFinishedJob({"resolution": 64},
+                                            bakedOutput("scene")))
+        self.assertTrue(self.man.isJobFinished(jobId))
+        self.assertEqual(self.man.getJob(jobId)["jobArgs"],
+                         {"resolution": 64})
+        status = self.man.getJobStatus(jobId)
+        self.assertEqual(status["state"], "finished")
+        self.assertNotIn("jobArgs", status)
+        self.assertEqual([job["jobId"] for job in self.man.getAllJobs()],
+                         [jobId])
+
+
+class ResultStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = Path(self.directory.name)
+        self.store = bakerman.ResultStore(self.path)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def finish(self, jobId, timeFinished=None, key=None):
+        summary = self.store.spill({
+            "jobId": jobId,
+            "state": "finished",
+            "jobArgs": {"resolution": 64},
+            "transforms": {jobId: [1, 0, 0, 1]},
+            "igxcModified": {},
+            "timeFinished": timeFinished or time.time()
+        })
+        return self.store.add(summary, key)
+
+    def testHeavyFieldsAreSpilled(self):
+        self.finish("1")
+        summary = self.store.summaries["1"]
+        self.assertNotIn("transforms", summary)
+        self.assertEqual(
+            self.store.complete(summary)["transforms"], {"1": [1, 0, 0, 1]})
+        self.assertTrue(self.store.path("1").is_file())
+
+    def testStoreIsBoundedByCount(self):
+        with mock.patch.dict(bakerman.bakingConfig, maxResults=2):
+            self.finish("1", key="first")
+            self.finish("2")
+            self.assertEqual(self.finish("3"), ["1"])
+        self.assertEqual(list(self.store.summaries), ["2", "3"])
+        self.assertFalse(self.store.path("1").exists())
+        self.assertIsNone(self.store.find("first"))
+
+    def testStoreIsBoundedByAge(self):
+        with mock.patch.dict(bakerman.bakingConfig, resultTTL=60):
+            self.assertEqual(self.finish("1", time.time() - 30), [])
+            bakerman.bakingConfig["resultTTL"] = 10
+            self.assertEqual(self.finish("2"), ["1"])
+        self.assertNotIn("1", self.store)
+        self.assertIn("2", self.store)
+        self.assertEqual(len(self.store), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
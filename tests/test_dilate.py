@@ -0,0 +1,71 @@
+import unittest
+
+import numpy
+
+import dilate
+
+
+def atlas(h, w, charts):
+    """Transparent RGBA atlas with opaque rectangles (y0, x0, y1, x1,
+    value)."""
+    pixels = numpy.zeros((h, w, 4), dtype=numpy.uint8)
+    for y0, x0, y1, x1, value in charts:
+        pixels[y0:y1, x0:x1, :3] = value
+        pixels[y0:y1, x0:x1, 3] = 255
+    return pixels
+
+
+class DilateTest(unittest.TestCase):
+    sizes = [(1, 1), (7, 5), (5, 7), (33, 17), (31, 64)]
+
+    def testChartColorFillsOddSizes(self):
+        for h, w in self.sizes:
+            pixels = atlas(h, w, [(h // 2, w // 2, h // 2 + 1, w // 2 + 1,
+                                   40)])
+            result = dilate.dilate(pixels)[0]
+            self.assertEqual(result.shape, (h, w, 4))
+            self.assertTrue(numpy.all(result[..., :3] == 40), (h, w))
+            self.assertTrue(numpy.all(result[..., 3] == 255), (h, w))
+
+    def testChartsAreKept(self):
+        rng = numpy.random.default_rng(0)
+        pixels = atlas(33, 17, [(0, 0, 5, 5, 10), (20, 9, 33, 17, 200)])
+        pixels[pixels[..., 3] > 0, :3] = rng.integers(
+            0, 256, (pixels[..., 3] > 0).sum())[:, None]
+        result = dilate.dilate(pixels)[0]
+        covered = pixels[..., 3] > 0
+        numpy.testing.assert_array_equal(result[covered, :3],
+                                         pixels[covered, :3])
+
+    def testFillStaysBetweenNeighbouringCharts(self):
+        pixels = atlas(9, 31, [(0, 0, 9, 3, 0), (0, 28, 9, 31, 250)])
+        result = dilate.dilate(pixels)[0].astype(int)
+        # texels next to a chart take its color
+        self.assertTrue(numpy.all(result[:, 3, 0] < 64))
+        self.assertTrue(numpy.all(result[:, 27, 0] > 186))
+        self.assertTrue(numpy.all((result[..., 0] >= 0) &
+                                  (result[..., 0] <= 250)))
+
+    def testReachIsLimited(self):
+        pixels = atlas(17, 33, [(8, 0, 9, 1, 30)])
+        result = dilate.dilate(pixels, texels=2)[0]
+        self.assertTrue(numpy.all(result[6:11, 0:3, :3] == 30))
+        self.assertTrue(numpy.all(result[:, 4:, :3] == dilate.background))
+        self.assertTrue(numpy.all(result[:5, :, :3] == dilate.background))
+
+    def testEmptyAtlasIsBackground(self):
+        result = dilate.dilate(numpy.zeros((7, 5, 4), dtype=numpy.uint8))[0]
+        self.assertTrue(numpy.all(result == 255))
+
+    def testMipsHalveOddSizes(self):
+        pixels = atlas(33, 17, [(0, 0, 33, 17, 90)])
+        levels = dilate.dilate(pixels, mipLevels=3)
+        self.assertEqual([level.shape[:2] for level in levels],
+                         [(33, 17), (17, 9), (9, 5), (5, 3)])
+        for level in levels:
+            self.assertTrue(numpy.all(level[..., :3] == 90))
+            self.assertTrue(numpy.all(level[..., 3] == 255))
+
+
+if __name__ == '__main__':
+    unittest.main()
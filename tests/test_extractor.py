@@ -0,0 +1,81 @@
+import unittest
+
+import glm
+import numpy
+
+import benchmark
+import scene
+import visitor
+
+
+class TriangleMeshes(visitor.SceneVisitor):
+    """Replaces every ArrayMesh by a plain Mesh of the same triangles."""
+    def visit_Mesh(self, mesh, direction):
+        if direction == 'forward' and isinstance(mesh, scene.ArrayMesh):
+            reference = scene.Mesh(mesh.name)
+            reference.parent = mesh.parent
+            for tri in mesh.triangles:
+                reference.add(tri)
+            children = mesh.parent.children
+            children[children.index(mesh)] = reference
+
+
+def scaled(root: scene.Group) -> scene.Group:
+    # non-uniform scales, normals need the inverse-transpose
+    for i, comp in enumerate(root.children):
+        comp.transform = comp.transform * glm.scale(
+            glm.mat4(1), glm.vec3(1.0 + i, 0.5, 2.0))
+    return root
+
+
+class ExtractArraysTest(unittest.TestCase):
+    def assertPathsAgree(self, makeScene):
+        candidate = benchmark.extract(makeScene())
+        root = makeScene()
+        root.accept(TriangleMeshes())
+        reference = benchmark.extract(root)
+        for name, a, b in zip(('vertices', 'normals', 'texcoord'), reference,
+                              candidate):
+            numpy.testing.assert_allclose(b, a, atol=1e-5, err_msg=name)
+
+    def testIndexedMeshes(self):
+        self.assertPathsAgree(
+            lambda: scaled(benchmark.randomScene(400, 3, seed=1)))
+
+    def testTriangleSoup(self):
+        self.assertPathsAgree(
+            lambda: scaled(benchmark.soupScene(300, 3, 0.1, seed=2)))
+
+    def testMeshesWithoutNormals(self):
+        def makeScene():
+            root = scaled(benchmark.randomScene(200, 2, seed=3))
+            for comp in root.children:
+                geo = comp.children[0]
+                mesh = geo.children[0]
+                geo.children[0] = scene.ArrayMesh('random',
+                                                  mesh.vertices,
+                                                  globalUVs=mesh.globalUVs,
+                                                  indices=mesh.indices)
+                geo.children[0].parent = geo
+            return root
+
+        self.assertPathsAgree(makeScene)
+        _, normals, _ = benchmark.extract(makeScene())
+        lengths = numpy.linalg.norm(normals, axis=2)
+        self.assertTrue(numpy.all((numpy.abs(lengths - 1) < 1e-4) |
+                                  (lengths == 0)))
+
+    def testMissingGlobalUVs(self):
+        root = scene.Group('.')
+        mesh = scene.ArrayMesh(
+            'plain',
+            numpy.random.default_rng(4).random((5, 3, 3),
+                                               dtype=numpy.float32))
+        mesh.parent = root
+        root.add(mesh)
+        _, _, texcoord = benchmark.extract(root)
+        self.assertTrue(numpy.all(texcoord == 1.0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import numpy
+
+import geocache
+import remote
+import scene
+
+
+class GeometryCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = Path(self.directory.name)
+        (self.path / 'cache').mkdir()
+        self.file = self.path / 'geometry.ctm'
+        self.file.write_bytes(b'geometry')
+
+        rng = numpy.random.default_rng(0)
+        self.meshes = [
+            scene.ArrayMesh('indexed',
+                            rng.random((4, 3), dtype=numpy.float32),
+                            normals=rng.random((4, 3), dtype=numpy.float32),
+                            globalUVs=rng.random((4, 2),
+                                                 dtype=numpy.float32),
+                            indices=numpy.array([[0, 1, 2], [2, 3, 0]],
+                                                dtype=numpy.uint32)),
+            scene.ArrayMesh('empty', numpy.zeros((0, 3, 3), numpy.float32)),
+            scene.ArrayMesh('soup', rng.random((2, 3, 3),
+                                               dtype=numpy.float32))
+        ]
+        self.reads = 0
+
+        self.patches = [
+            mock.patch.object(geocache, 'cache',
+                              remote.DownloadCache(self.path / 'cache')),
+            mock.patch.dict(remote.remoteConfig, geometryCache=True)
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.directory.cleanup()
+
+    def reader(self, group, file):
+        self.reads += 1
+        for mesh in self.meshes:
+            copy = scene.ArrayMesh(
+                mesh.name,
+                **{a: getattr(mesh, a)
+                   for a in geocache.attributes})
+            copy.parent = group
+            group.add(copy)
+
+    def read(self) -> list:
+        group = scene.Group('geometry')
+        geocache.read(group, self.file, self.reader)
+        for mesh in group.children:
+            self.assertIs(mesh.parent, group)
+        return group.children
+
+    def testRoundTrip(self):
+        self.read()
+        meshes = self.read()
+        self.assertEqual(self.reads, 1)
+        # empty meshes are not kept
+        self.assertEqual([mesh.name for mesh in meshes], ['indexed', 'soup'])
+        for mesh, original in zip(meshes, self.meshes[::2]):
+            for attribute in geocache.attributes:
+                array = getattr(mesh, attribute)
+                expected = getattr(original, attribute)
+                if expected is None:
+                    self.assertIsNone(array)
+                    continue
+                self.assertIsInstance(array, numpy.memmap)
+                self.assertEqual(array.dtype, expected.dtype)
+                numpy.testing.assert_array_equal(array, expected)
+
+    def testOtherContentIsReadAgain(self):
+        self.read()
+        self.file.write_bytes(b'changed geometry')
+        self.read()
+        self.assertEqual(self.reads, 2)
+
+    def testLoaderVersionInvalidates(self):
+        self.read()
+        with mock.patch.object(geocache, 'loaderVersion',
+                               geocache.loaderVersion + 1):
+            self.read()
+            self.read()
+        self.assertEqual(self.reads, 2)
+
+    def testEvictedArraysAreReadAgain(self):
+        self.read()
+        key = geocache.contentKey(self.file, self.file.suffix)
+        (self.path / 'cache' / '{}.0.indices.npy'.format(key)).unlink()
+        meshes = self.read()
+        self.assertEqual(self.reads, 2)
+        self.assertEqual(len(meshes), 3)
+
+    def testDisabledCacheReadsEveryTime(self):
+        with mock.patch.dict(remote.remoteConfig, geometryCache=False):
+            self.read()
+            self.read()
+        self.assertEqual(self.reads, 2)
+        self.assertEqual(list((self.path / 'cache').glob('*.npy')), [])
+
+    def testFailedReadsAreNotCached(self):
+        self.meshes = []
+        self.read()
+        self.read()
+        self.assertEqual(self.reads, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import numpy
+
+import igxc
+import remote
+import visitor
+
+triangle = b'''v 0 0 0
+v 1 0 0
+v 0 1 0
+f 1 2 3
+'''
+
+
+def placed(path, geometry, x):
+    return {
+        "Path": path,
+        "Geometry": geometry,
+        "Transform": {
+            "Position": {
+                "X": x,
+                "Y": 0,
+                "Z": 0
+            }
+        }
+    }
+
+
+class InstancingTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = Path(self.directory.name)
+        (self.path / 'triangle.obj').write_bytes(triangle)
+        (self.path / 'other.obj').write_bytes(triangle)
+        self.igxc = {
+            "Geometries": {
+                "triangle": "triangle.obj",
+                "other": "other.obj"
+            },
+            "Objects": [
+                {"Path": "."},
+                placed(".a", "triangle", 0),
+                placed(".b", "triangle", 10),
+                placed(".c", "other", 20),
+                placed(".b.d", "triangle", 30)
+            ]
+        }
+        self.config = mock.patch.dict(remote.remoteConfig,
+                                      geometryCache=False)
+        self.config.start()
+
+    def tearDown(self):
+        self.config.stop()
+        self.directory.cleanup()
+
+    def testGeometryIsReadOnce(self):
+        with mock.patch.object(igxc.wavefront, "read",
+                               wraps=igxc.wavefront.read) as read:
+            root = igxc.load(self.igxc, self.path)
+        self.assertEqual(read.call_count, 2)
+
+        a, b, c = root.children
+        d = b.children[1]
+        self.assertIs(b.children[0].children[0],
+                      a.children[0].children[0])
+        self.assertIs(d.children[0].children[0],
+                      a.children[0].children[0])
+        self.assertIsNot(c.children[0].children[0],
+                         a.children[0].children[0])
+
+    def testInstancesTakeTheirObjectName(self):
+        root = igxc.load(self.igxc, self.path)
+        vertices = numpy.zeros((4, 3, 3), dtype=numpy.float32)
+        normals = numpy.zeros((4, 3, 3), dtype=numpy.float32)
+        texcoord = numpy.zeros((4, 3, 2), dtype=numpy.float32)
+        extractor = visitor.TransformedTriExtractor(
+            vertices,
+            normals,
+            texcoord,
+            packer=visitor.SimplePacker(2, 2, 64))
+        root.accept(extractor)
+
+        self.assertEqual(extractor.ranges, {
+            ".a": [(0, 1)],
+            ".b": [(1, 2)],
+            ".b.d": [(2, 3)],
+            ".c": [(3, 4)]
+        })
+        self.assertEqual(sorted(extractor.mapping),
+                         [".a", ".b", ".b.d", ".c"])
+        # every instance is placed by its own object transform
+        numpy.testing.assert_array_equal(vertices[:, 0, 0], [0, 10, 40, 20])
+
+    def testSceneTrianglesCountInstances(self):
+        files = igxc.availableGeometries(self.igxc, self.path)
+        self.assertEqual(igxc.sceneTriangles(self.igxc, files), 4)
+        with self.assertRaises(igxc.SceneTooLarge):
+            igxc.load(self.igxc, self.path, triangleLimit=3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+import unittest
+from unittest import mock
+
+import numpy
+
+import bakestate
+import scene
+import service
+import visitor
+
+
+def box(offset):
+    """ArrayMesh of a unit box at offset, with global UVs."""
+    corners = numpy.array([[x, y, z] for x in (0, 1) for y in (0, 1)
+                           for z in (0, 1)],
+                          dtype=numpy.float32) + offset
+    faces = [(0, 1, 3, 2), (4, 6, 7, 5), (0, 4, 5, 1), (2, 3, 7, 6),
+             (0, 2, 6, 4), (1, 5, 7, 3)]
+    tris = numpy.array([(f[0], f[1], f[2]) for f in faces] +
+                       [(f[0], f[2], f[3]) for f in faces])
+    quad = numpy.array([[0, 0], [1, 0], [1, 1], [0, 1]], dtype=numpy.float32)
+    uvs = numpy.concatenate([
+        (quad[[0, 1, 2]] + [i, 0]) / 6 for i in range(6)
+    ] + [(quad[[0, 2, 3]] + [i, 0]) / 6 for i in range(6)])
+    return scene.ArrayMesh('box',
+                           corners[tris],
+                           globalUVs=uvs.reshape(-1, 3, 2).astype(
+                               numpy.float32))
+
+
+def configuration(objects: dict) -> scene.Group:
+    # object group -> geometry group -> mesh, like igxc.load
+    root = scene.Group('.')
+    for path, offset in objects.items():
+        component = scene.Group(path)
+        component.parent = root
+        root.add(component)
+        geometry = scene.Group('box')
+        geometry.parent = component
+        component.add(geometry)
+        mesh = box(offset)
+        mesh.parent = geometry
+        geometry.add(mesh)
+    return root
+
+
+class IncrementalBakeTest(unittest.TestCase):
+    resolution = 64
+
+    def setUp(self):
+        self.key = 'test-incremental-{}'.format(id(self))
+        self.config = mock.patch.dict(service.aoConfig,
+                                      packer="area",
+                                      backend="numpy")
+        self.config.start()
+
+    def tearDown(self):
+        self.config.stop()
+        bakestate.remove(self.key)
+
+    def bake(self, objects: dict):
+        """Bakes the configuration incrementally; returns the AO buffer,
+        the extractor and the triangle ranges that were drawn."""
+        root = configuration(objects)
+        counter = visitor.TriCounter()
+        root.accept(counter)
+        vertices = numpy.empty((counter.count, 3, 3), dtype=numpy.float32)
+        normals = numpy.empty((counter.count, 3, 3), dtype=numpy.float32)
+        texcoord = numpy.empty((counter.count, 3, 2), dtype=numpy.float32)
+        packer = service.packerFor(root, len(objects), self.resolution,
+                                   bakestate.placementOf(self.key))
+        extractor = visitor.TransformedTriExtractor(vertices,
+                                                    normals,
+                                                    texcoord,
+                                                    packer=packer)
+        root.accept(extractor)
+
+        state = {
+            "objects": {path: str(offset)
+                        for path, offset in objects.items()},
+            "hashes": bakestate.jsonHash(None),
+            "mapping": extractor.mapping,
+            "tiles": extractor.tiles,
+            "bounds": bakestate.objectBounds(vertices, extractor.ranges),
+            "placement": packer.placement()
+        }
+        drawn = []
+        bakeBuffer = service.bakeBuffer
+
+        def recordTiles(*args, **kwargs):
+            drawn.extend((start, end) for start, end, _ in args[7])
+            return bakeBuffer(*args, **kwargs)
+
+        size = (self.resolution, self.resolution)
+        with mock.patch.object(service, "bakeBuffer", recordTiles):
+            buff = service.bakeIncremental(
+                self.key, state, vertices, normals, texcoord,
+                extractor.ranges, size, 1, "numpy",
+                sampling=service.samplingFor("preview"))
+        return buff, extractor, drawn
+
+    def rows(self, buff, extractor, path):
+        x0, y0, x1, y1 = bakestate.tileRect(extractor.tiles[path][0],
+                                            self.resolution, self.resolution)
+        return buff.reshape(self.resolution, self.resolution,
+                            4)[y0:y1, x0:x1]
+
+    def testToggleBakesOnlyTheToggledComponent(self):
+        # components further apart than the occlusion range
+        first, _, _ = self.bake({'.a': (0, 0, 0), '.b': (3, 0, 0),
+                                 '.c': (6, 0, 0)})
+        second, extractor, drawn = self.bake({'.a': (0, 0, 0),
+                                              '.b': (3, 0, 0),
+                                              '.d': (0, 3, 0)})
+
+        self.assertEqual(drawn, extractor.ranges['.d'])
+        for path in ('.a', '.b'):
+            previous = self.rows(first, extractor, path)
+            numpy.testing.assert_array_equal(
+                self.rows(second, extractor, path), previous)
+            self.assertTrue(previous[..., 3].any())
+        self.assertTrue(self.rows(second, extractor, '.d')[..., 3].any())
+
+    def testNeighboursOfAToggledComponentAreBakedAgain(self):
+        self.bake({'.a': (0, 0, 0), '.b': (3, 0, 0), '.c': (6, 0, 0)})
+        _, extractor, drawn = self.bake({'.a': (0, 0, 0), '.b': (3, 0, 0),
+                                         '.d': (1.2, 0, 0)})
+        self.assertEqual(sorted(drawn),
+                         sorted(extractor.ranges['.a'] +
+                                extractor.ranges['.d']))
+
+    def testRemovedComponentIsCleared(self):
+        first, before, _ = self.bake({'.a': (0, 0, 0), '.b': (3, 0, 0),
+                                      '.c': (6, 0, 0)})
+        second, _, drawn = self.bake({'.a': (0, 0, 0), '.b': (3, 0, 0)})
+        self.assertEqual(drawn, [])
+        self.assertTrue(self.rows(first, before, '.c')[..., 3].any())
+        self.assertFalse(self.rows(second, before, '.c')[..., 3].any())
+
+
+class AreaPackerPlacementTest(unittest.TestCase):
+    def testKeepsTilesOfUnchangedMeshes(self):
+        areas, uvAreas = [4.0, 1.0, 1.0], [1.0, 1.0, 1.0]
+        uvBounds = [[0, 0, 1, 1]] * 3
+        first = visitor.AreaPacker(areas, uvAreas, uvBounds, 64,
+                                   names=['.a', '.b', '.c'])
+        second = visitor.AreaPacker(areas[:2] + [0.5], uvAreas, uvBounds, 64,
+                                    names=['.a', '.b', '.d'],
+                                    placement=first.placement())
+        self.assertEqual(second.tiles[:2], first.tiles[:2])
+        self.assertIsNotNone(second.tiles[2])
+        self.assertEqual(second.scale, first.scale)
+
+    def testPacksAgainWithoutFreeSpace(self):
+        uvBounds = [[0, 0, 1, 1]] * 3
+        first = visitor.AreaPacker([1.0, 1.0], [1.0, 1.0], uvBounds[:2], 64,
+                                   names=['.a', '.b'])
+        second = visitor.AreaPacker([1.0, 1.0, 16.0], [1.0] * 3, uvBounds,
+                                    64,
+                                    names=['.a', '.b', '.c'],
+                                    placement=first.placement())
+        self.assertLess(second.scale, first.scale)
+        self.assertTrue(all(tile is not None for tile in second.tiles))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+import bakerman
+from jobstore import JobStore
+from tests.test_bakerman import bakedOutput
+
+
+class JobStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = Path(self.directory.name) / 'jobs.sqlite'
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def testChangesSurviveReopening(self):
+        store = JobStore(self.filename)
+        store.add("1", "a", 0, 0, {"resolution": 64}, 10.0)
+        store.add("2", "b", 1, 1, {"resolution": 32}, 11.0)
+        store.add("3", None, 0, 2, {}, 12.0)
+        store.started("1")
+        store.finished("2", "b", {"jobId": "2", "state": "finished",
+                                  "timeCreated": 11.0})
+        store.remove(["3"])
+        store.close()
+
+        store = JobStore(self.filename)
+        jobs = store.load()
+        store.close()
+        self.assertEqual([job["jobId"] for job in jobs], ["1", "2"])
+        self.assertEqual(jobs[0]["state"], "running")
+        self.assertEqual(jobs[0]["args"], {"resolution": 64})
+        self.assertIsNone(jobs[0]["summary"])
+        self.assertEqual(jobs[1]["key"], "b")
+        self.assertIsNone(jobs[1]["args"])
+        self.assertEqual(jobs[1]["summary"]["state"], "finished")
+
+    def testFlushCommitsQueuedChanges(self):
+        # flush does not wait for the batch interval
+        store = JobStore(self.filename, interval=10.0)
+        store.add("1", None, 0, 0, {}, 10.0)
+        start = time.monotonic()
+        store.flush()
+        self.assertLess(time.monotonic() - start, 5.0)
+        reader = JobStore(self.filename)
+        self.assertEqual(len(reader.load()), 1)
+        reader.close()
+        store.close()
+
+
+class ResumeTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = Path(self.directory.name)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def bakingMan(self):
+        # a started BakingMan without workers, jobs stay queued
+        man = bakerman.BakingMan(workers=1)
+        man.results = bakerman.ResultStore(self.path)
+        man.store = JobStore(self.path / 'jobs.sqlite')
+        man.resume()
+        return man
+
+    def testQueuedAndInterruptedJobsAreResumed(self):
+        man = self.bakingMan()
+        first = str(man.addJob({"resolution": 64}, priority=1, key="first"))
+        second = str(man.addJob({"resolution": 32}, key="second"))
+        running = str(man.addJob({"resolution": 16}, key="running"))
+        finished = str(man.addFinishedJob({"resolution": 8},
+                                          bakedOutput("finished"),
+                                          key="finished"))
+        man.store.started(running)
+        man.store.close()
+
+        man = self.bakingMan()
+        try:
+            self.assertEqual([jobId for _, _, jobId in sorted(man.queue)],
+                             [second, running, first])
+            self.assertEqual(man.getJobStatus(running)["state"], "pending")
+            self.assertEqual(man.getJob(first)["jobArgs"],
+                             {"resolution": 64})
+            self.assertEqual(man.getJob(finished)["state"], "finished")
+            self.assertEqual(man.getJob(finished)["jobArgs"],
+                             {"resolution": 8})
+
+            # requests are still coalesced with the resumed jobs
+            self.assertEqual(str(man.addJob({}, key="first")), first)
+            self.assertEqual(
+                str(man.addFinishedJob({}, bakedOutput("finished"),
+                                       key="finished")), finished)
+            # new jobs are numbered and ordered after the resumed ones
+            later = str(man.addJob({}, priority=1))
+            self.assertGreater(int(later), int(finished))
+            self.assertEqual(sorted(man.queue)[-1][2], later)
+        finally:
+            man.store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
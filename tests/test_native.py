@@ -0,0 +1,111 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy
+
+import benchmark
+import service
+
+try:
+    import ig_rendering_support
+except ImportError:
+    ig_rendering_support = None
+
+
+@unittest.skipIf(ig_rendering_support is None,
+                 "ig_rendering_support is not built")
+class BVHTest(unittest.TestCase):
+    def setUp(self):
+        root = benchmark.soupScene(200, 2, 0.1)
+        self.vertices, self.normals, self.texcoord = benchmark.extract(root)
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = Path(self.directory.name)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def testSaveAndLoad(self):
+        bvh = ig_rendering_support.BVH(self.vertices)
+        bvh.save(str(self.path / 'scene.bvh'))
+        loaded = ig_rendering_support.BVH.load(str(self.path / 'scene.bvh'))
+        self.assertEqual(loaded.triangleCount, len(self.vertices))
+        self.assertEqual(loaded.nbytes, bvh.nbytes)
+
+        loaded.save(str(self.path / 'again.bvh'))
+        self.assertEqual((self.path / 'again.bvh').read_bytes(),
+                         (self.path / 'scene.bvh').read_bytes())
+
+    def testLoadRejectsOtherFiles(self):
+        ig_rendering_support.BVH(self.vertices).save(
+            str(self.path / 'scene.bvh'))
+        content = (self.path / 'scene.bvh').read_bytes()
+        (self.path / 'truncated.bvh').write_bytes(content[:len(content) // 2])
+        (self.path / 'numpy.bvh').write_bytes(b'PK' + bytes(64))
+        for name in ('truncated.bvh', 'numpy.bvh', 'missing.bvh'):
+            with self.assertRaises(RuntimeError):
+                ig_rendering_support.BVH.load(str(self.path / name))
+
+    def testBakeRejectsBVHOfOtherGeometry(self):
+        bvh = ig_rendering_support.BVH(self.vertices[:10])
+        with self.assertRaises(ValueError):
+            ig_rendering_support.bakeAO(
+                numpy.zeros((8, 8, 4), dtype=numpy.uint8), self.vertices,
+                self.normals, self.texcoord, bvh=bvh)
+
+
+@unittest.skipIf(ig_rendering_support is None,
+                 "ig_rendering_support is not built")
+class ArgumentTest(unittest.TestCase):
+    # end=0 draws no triangle, so only the argument checks run
+    def setUp(self):
+        root = benchmark.soupScene(16, 1, 0.1)
+        self.vertices, self.normals, self.texcoord = benchmark.extract(root)
+        self.bvh = ig_rendering_support.BVH(self.vertices)
+
+    def bake(self, data=None, rays=None, **arrays):
+        if data is None:
+            data = numpy.zeros((8, 8, 4), dtype=numpy.uint8)
+        geometry = dict(vertices=self.vertices,
+                        normals=self.normals,
+                        texcoord=self.texcoord)
+        geometry.update(arrays)
+        ig_rendering_support.bakeAO(data,
+                                    bvh=self.bvh,
+                                    end=0,
+                                    rays=rays,
+                                    **geometry)
+
+    def testAcceptsConformingArrays(self):
+        self.bake(rays=numpy.zeros(8 * 8, dtype=numpy.int32))
+        # read-only face normals of the service
+        self.bake(normals=service.noNormals)
+
+    def testRejectsOtherDtypes(self):
+        for name in ('vertices', 'normals', 'texcoord'):
+            with self.assertRaises(TypeError):
+                self.bake(**{name: getattr(self, name).astype(numpy.float64)})
+        with self.assertRaises(TypeError):
+            self.bake(numpy.zeros((8, 8, 4), dtype=numpy.float32))
+        with self.assertRaises(ValueError):
+            self.bake(rays=numpy.zeros(8 * 8, dtype=numpy.int64))
+
+    def testRejectsNonContiguousArrays(self):
+        with self.assertRaises(TypeError):
+            self.bake(vertices=numpy.asfortranarray(self.vertices))
+        with self.assertRaises(TypeError):
+            self.bake(texcoord=self.texcoord[:, ::-1])
+        with self.assertRaises(TypeError):
+            self.bake(numpy.zeros((8, 16, 4), dtype=numpy.uint8)[:, ::2])
+
+    def testRejectsWrongShapes(self):
+        with self.assertRaises(ValueError):
+            self.bake(texcoord=self.texcoord[:-1])
+        with self.assertRaises(ValueError):
+            self.bake(numpy.zeros((8, 8, 3), dtype=numpy.uint8))
+        with self.assertRaises(ValueError):
+            self.bake(rays=numpy.zeros(8, dtype=numpy.int32))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import unittest
+
+import numpy
+
+import benchmark
+import numpybake
+import service
+
+try:
+    import ig_rendering_support
+except ImportError:
+    ig_rendering_support = None
+
+
+def bake(backend, quality):
+    # a few thousand texels, the bias of the AO values stays well below
+    # benchmark.maxBias
+    root = benchmark.soupScene(800, 4, 0.1)
+    vertices, normals, texcoord = benchmark.extract(root)
+    return service.bakeBuffer(vertices,
+                              normals,
+                              texcoord, (64, 64),
+                              backend=backend,
+                              sampling=service.samplingFor(quality))
+
+
+class CheckDataTest(unittest.TestCase):
+    def setUp(self):
+        root = benchmark.soupScene(16, 1, 0.1)
+        self.vertices, self.normals, self.texcoord = benchmark.extract(root)
+
+    def bakeInto(self, data):
+        numpybake.bakeAO(data, self.vertices, self.normals, self.texcoord)
+
+    def testRejectsWrongType(self):
+        with self.assertRaises(TypeError):
+            self.bakeInto(numpy.zeros((8, 8, 4), dtype=numpy.float32))
+        with self.assertRaises(TypeError):
+            self.bakeInto([[[0] * 4] * 8] * 8)
+
+    def testRejectsViewsAndReadOnlyBuffers(self):
+        with self.assertRaises(TypeError):
+            self.bakeInto(numpy.zeros((8, 16, 4), dtype=numpy.uint8)[:, ::2])
+        data = numpy.zeros((8, 8, 4), dtype=numpy.uint8)
+        data.flags.writeable = False
+        with self.assertRaises(TypeError):
+            self.bakeInto(data)
+
+    def testRejectsWrongShape(self):
+        with self.assertRaises(ValueError):
+            self.bakeInto(numpy.zeros((8, 8, 3), dtype=numpy.uint8))
+        with self.assertRaises(ValueError):
+            self.bakeInto(numpy.zeros((8, 32), dtype=numpy.uint8))
+
+
+class GBufferTest(unittest.TestCase):
+    # overlapping random UV triangles, so tiles share many texels
+    def setUp(self):
+        root = benchmark.soupScene(400, 2, 0.1)
+        self.vertices, self.normals, self.texcoord = benchmark.extract(root)
+        self.tiles = service.tilesFor([(0, len(self.texcoord))], limit=50)
+
+    def testTilesShadeEveryTexelOnce(self):
+        gbuffer = numpybake.GBuffer(self.texcoord, 64, 32)
+        pixels = numpy.concatenate([
+            py * 64 + px
+            for px, py, _, _ in (gbuffer.texels(start, end)
+                                 for start, end, _ in self.tiles)
+        ])
+        px, py, _, _ = numpybake.rasterize(self.texcoord, 64, 32)
+        self.assertEqual(len(pixels), gbuffer.texelCount)
+        self.assertEqual(sorted(pixels), sorted(py * 64 + px))
+
+    def testTiledBakeCoversTheAtlas(self):
+        sampling = service.samplingFor("preview")
+        whole = service.bakeBuffer(self.vertices, self.normals,
+                                   self.texcoord, (64, 32), backend="numpy",
+                                   sampling=sampling)
+        tiled = service.bakeBuffer(self.vertices, self.normals,
+                                   self.texcoord, (64, 32), backend="numpy",
+                                   tiles=self.tiles, sampling=sampling)
+        numpy.testing.assert_array_equal(whole[..., 3], tiled[..., 3])
+
+    def testRejectsGBufferOfAnotherMap(self):
+        gbuffer = numpybake.GBuffer(self.texcoord, 32, 32)
+        with self.assertRaises(ValueError):
+            numpybake.bakeAO(numpy.zeros((64, 32, 4), dtype=numpy.uint8),
+                             self.vertices, self.normals, self.texcoord,
+                             gbuffer=gbuffer)
+
+
+class AgreementTest(unittest.TestCase):
+    # the same sampling on both backends; adaptive sampling stops early on
+    # texels with little variance and is not compared to fixed sampling
+    @unittest.skipIf(ig_rendering_support is None,
+                     "ig_rendering_support is not built")
+    def testNativeMatchesNumpy(self):
+        for quality in ("reference", "final"):
+            comparison = benchmark.compareBuffers(bake("native", quality),
+                                                  bake("numpy", quality))
+            self.assertTrue(benchmark.buffersAgree(comparison), comparison)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+
+import numpy
+
+import visitor
+
+
+def randomMeshes(count, seed):
+    """Areas, UV areas and UV bounds of count meshes over three orders of
+    magnitude of surface area."""
+    rng = numpy.random.default_rng(seed)
+    areas = (10**rng.uniform(-1.5, 1.5, count)).tolist()
+    corners = rng.random((count, 2, 2))
+    lower, upper = corners.min(axis=1), corners.max(axis=1) + 0.01
+    uvBounds = numpy.concatenate([lower, upper], axis=1).tolist()
+    uvAreas = (0.5 * numpy.prod(upper - lower, axis=1)).tolist()
+    return areas, uvAreas, uvBounds
+
+
+class AreaPackerTest(unittest.TestCase):
+    def assertPacked(self, packer, padding=2):
+        tiles = [tile for tile in packer.tiles if tile is not None]
+        size = packer.pixelSize
+        for x, y, w, h in tiles:
+            self.assertTrue(0 <= x and x + w <= size and 0 <= y and
+                            y + h <= size)
+        # tiles grown by the padding must not overlap either
+        grid = numpy.zeros((size + padding, size + padding), dtype=int)
+        for x, y, w, h in tiles:
+            grid[y:y + h + padding, x:x + w + padding] += 1
+        self.assertLessEqual(grid.max(), 1)
+
+    def testTilesDoNotOverlap(self):
+        for count, seed in [(1, 0), (7, 1), (60, 2), (400, 3)]:
+            packer = visitor.AreaPacker(*randomMeshes(count, seed), 1024)
+            self.assertPacked(packer)
+            self.assertTrue(all(tile is not None for tile in packer.tiles))
+
+    def testTilesFollowSurfaceArea(self):
+        areas, uvAreas, uvBounds = randomMeshes(30, 4)
+        packer = visitor.AreaPacker(areas, uvAreas, uvBounds, 2048)
+        density = [
+            w * h * uvArea / ((b[2] - b[0]) * (b[3] - b[1])) / area
+            for (_, _, w, h), area, uvArea, b in zip(
+                packer.tiles, areas, uvAreas, uvBounds) if w > 16 and h > 16
+        ]
+        self.assertGreater(len(density), 5)
+        self.assertLess(max(density) / min(density), 1.5)
+
+    def testTooManyMeshesGetNoTile(self):
+        packer = visitor.AreaPacker(*randomMeshes(400, 5), 64)
+        self.assertPacked(packer)
+        self.assertIn(None, packer.tiles)
+
+    def testRefitDoesNotOverlap(self):
+        areas, uvAreas, uvBounds = randomMeshes(80, 6)
+        first = visitor.AreaPacker(areas, uvAreas, uvBounds, 1024)
+        # every other mesh grows and has to be placed again
+        grown = [a * (4.0 if i % 2 else 1.0) for i, a in enumerate(areas)]
+        second = visitor.AreaPacker(grown, uvAreas, uvBounds, 1024,
+                                    placement=first.placement())
+        self.assertPacked(second)
+        self.assertTrue(all(tile is not None for tile in second.tiles))
+
+    def testBucketsMapUVBoundsOntoTiles(self):
+        areas, uvAreas, uvBounds = randomMeshes(5, 7)
+        packer = visitor.AreaPacker(areas, uvAreas, uvBounds, 512)
+        for (x, y, w, h), (u0, v0, u1, v1) in zip(packer.tiles, uvBounds):
+            M = visitor.toArray(packer.bucket())
+            corners = numpy.array([[u0, v0, 1], [u1, v1, 1]]) @ M.T
+            numpy.testing.assert_allclose(
+                corners[:, :2] * 512, [[x, y], [x + w, y + h]], atol=1e-3)
+        self.assertIsNone(packer.bucket())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from unittest import mock
+
+import requests
+from urlpath import URL
+
+import remote
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # keep-alive, like the servers geometry is fetched from
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(self.path)
+            server.connections.add(self.client_address)
+        time.sleep(server.delay)
+
+        content = server.files.get(self.path)
+        if content is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(content)))
+        self.send_header('ETag', '"{}"'.format(hash(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FetchAllTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        self.server.connections = set()
+        self.server.delay = 0.0
+        self.server.files = {
+            '/geo/{}.ctm'.format(i): 'geometry {}'.format(i).encode()
+            for i in range(8)
+        }
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        self.base = URL('http://127.0.0.1:{}/geo'.format(
+            self.server.server_port))
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.previousCache = remote.cache
+        remote.cache = remote.DownloadCache(Path(self.directory.name))
+
+    def tearDown(self):
+        remote.cache = self.previousCache
+        self.directory.cleanup()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def entries(self, names):
+        return {
+            name: (self.base / '{}.ctm'.format(name), '.ctm')
+            for name in names
+        }
+
+    def testFetchesAllEntries(self):
+        result = remote.fetchAll(self.entries(range(8)), workers=4)
+        self.assertEqual(sorted(result), list(range(8)))
+        for name, cachedFile in result.items():
+            with cachedFile.open('rb') as f:
+                self.assertEqual(f.read(),
+                                 'geometry {}'.format(name).encode())
+
+    def testMissingFileIsNone(self):
+        result = remote.fetchAll(self.entries(['missing', 0]))
+        self.assertIsNone(result['missing'])
+        self.assertIsNotNone(result[0])
+
+    def testCachedFilesAreNotFetchedAgain(self):
+        remote.fetchAll(self.entries(range(4)))
+        remote.fetchAll(self.entries(range(4)))
+        self.assertEqual(len(self.server.requests), 4)
+
+    def testFetchesConcurrently(self):
+        self.server.delay = 0.2
+        start = time.perf_counter()
+        remote.fetchAll(self.entries(range(8)), workers=8)
+        self.assertLess(time.perf_counter() - start, 8 * 0.2 / 2)
+
+    def testConnectionsAreReusedAcrossCalls(self):
+        for name in range(8):
+            remote.fetchAll(self.entries([name]), workers=2)
+        self.assertEqual(len(self.server.requests), 8)
+        self.assertLessEqual(len(self.server.connections), 2)
+
+    def testStalledDownloadTimesOut(self):
+        self.server.delay = 2.0
+        start = time.perf_counter()
+        with mock.patch.dict(remote.remoteConfig, fetchTimeout=0.2):
+            with self.assertRaises(requests.Timeout):
+                remote.fetchAll(self.entries([0]))
+        self.assertLess(time.perf_counter() - start, 1.0)
+
+
+class SharedCacheTest(unittest.TestCase):
+    # two caches on one directory stand for two baking processes
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = Path(self.directory.name)
+        self.first = remote.DownloadCache(self.path)
+        self.second = remote.DownloadCache(self.path)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def testIndexKeepsEntriesOfAllProcesses(self):
+        self.first.store('a', b'aaaa')
+        self.second.store('b', b'bb')
+        self.first.flush(force=True)
+        self.assertEqual(sorted(self.first.entries), ['a', 'b'])
+        self.assertEqual(sorted(remote.DownloadCache(self.path).entries),
+                         ['a', 'b'])
+
+    def testLookupFindsFilesOfOtherProcesses(self):
+        self.first.store('a', b'aaaa')
+        self.assertEqual(self.second.lookup('a'), self.path / 'a')
+
+    def testMetricsAddUpAllProcesses(self):
+        self.first.store('a', b'aaaa')
+        self.first.lookup('a')
+        self.first.lookup('missing')
+        self.second.lookup('a')
+        self.first.flush()
+        self.second.flush()
+        metrics = remote.DownloadCache(self.path).metrics()
+        self.assertEqual((metrics["hits"], metrics["misses"]), (2, 1))
+        self.assertEqual((metrics["files"], metrics["bytes"]), (1, 4))
+
+    def testEvictionSeesEntriesOfAllProcesses(self):
+        self.first.budget = self.second.budget = 6
+        self.first.store('a', b'aaaa')
+        time.sleep(0.01)
+        self.second.store('b', b'bbbb')
+        self.assertFalse((self.path / 'a').exists())
+        self.first.flush(force=True)
+        self.assertEqual(sorted(self.first.entries), ['b'])
+        self.assertEqual(self.first.metrics()["filesEvicted"], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
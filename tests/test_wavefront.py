@@ -0,0 +1,102 @@
+import io
+import unittest
+from unittest import mock
+
+import numpy
+
+import scene
+import wavefront
+
+
+def read(text: bytes) -> list:
+    group = scene.Group('geometry')
+    wavefront.read(group, io.BytesIO(text))
+    return group.children
+
+
+square = b'''v 0 0 0
+v 1 0 0
+v 1 1 0
+v 0 1 0
+'''
+
+
+class ParserTest(unittest.TestCase):
+    def testPolygonsAreFanned(self):
+        mesh, = read(square + b'v 0.5 2 0\nf 1 2 3 5 4\n')
+        self.assertEqual(mesh.triangleCount(), 3)
+        numpy.testing.assert_array_equal(
+            mesh.vertices[:, 0], [[0, 0, 0]] * 3)
+        numpy.testing.assert_array_equal(
+            mesh.vertices[:, 1:, :2],
+            [[[1, 0], [1, 1]], [[1, 1], [0.5, 2]], [[0.5, 2], [0, 1]]])
+
+    def testNegativeIndicesCountBack(self):
+        mesh, = read(square + b'f -4 -3 -2\nv 5 5 5\nf -5 -3 -1\n')
+        numpy.testing.assert_array_equal(
+            mesh.vertices,
+            [[[0, 0, 0], [1, 0, 0], [1, 1, 0]],
+             [[0, 0, 0], [1, 1, 0], [5, 5, 5]]])
+
+    def testVertexNormalCorners(self):
+        mesh, = read(square + b'vn 0 0 1\nvn 0 0 -1\nf 1//1 2//1 3//2\n')
+        numpy.testing.assert_array_equal(
+            mesh.normals, [[[0, 0, 1], [0, 0, 1], [0, 0, -1]]])
+        self.assertIsNone(mesh.texcoords)
+
+    def testCornerFormats(self):
+        mesh, = read(square + b'vt 0 0\nvt 1 1\nvn 0 0 1\n'
+                     b'f 1/1/1 2/2/1 3/1/1\nf 1 3 4\nf 1/2 3/1 4//1\n')
+        numpy.testing.assert_array_equal(
+            mesh.texcoords[:, :, 0], [[0, 1, 0], [0, 0, 0], [1, 0, 0]])
+        numpy.testing.assert_array_equal(mesh.normals[1], numpy.zeros((3, 3)))
+        numpy.testing.assert_array_equal(mesh.normals[2, 2], [0, 0, 1])
+
+    def testIndexOutOfRange(self):
+        with self.assertRaises(ValueError):
+            read(square + b'o broken\nf 1 2 5\n')
+        with self.assertRaises(ValueError):
+            read(square + b'vn 0 0 1\nf 1//1 2//2 3//1\n')
+        with self.assertRaises(ValueError):
+            read(square + b'f -5 1 2\n')
+        with self.assertRaises(ValueError):
+            read(square + b'f 0 1 2\n')
+
+    def testObjectsAndTabs(self):
+        meshes = read(square + b'f 1 2 3\no first\n'
+                      b'f\t1 3 4\r\n\to ignored\no second\nf 2 3 4 \n')
+        self.assertEqual([mesh.name for mesh in meshes],
+                         ['unnamed mesh', 'first', 'second'])
+        self.assertEqual([mesh.triangleCount() for mesh in meshes],
+                         [1, 1, 1])
+
+    def testChunksSplitLines(self):
+        text = square + b''.join(
+            b'o part%d\nf 1 2 3 4\n' % i for i in range(20))
+        whole = read(text)
+        with mock.patch.object(wavefront, 'chunkSize', 7):
+            chunked = read(text)
+        self.assertEqual([m.name for m in chunked], [m.name for m in whole])
+        for a, b in zip(whole, chunked):
+            numpy.testing.assert_array_equal(a.vertices, b.vertices)
+
+
+class CountTrianglesTest(unittest.TestCase):
+    def testCountsTheTrianglesOfTheParser(self):
+        text = square + b'vt 0 0\nvn 0 0 1\n' + (
+            b'f 1 2 3\nf 1 2 3 4\nf\t1/1 2/1 3/1 4/1 1/1\r\n'
+            b'f 1//1   2//1 3//1 \nfo 1 2 3\nf 1 2\nf\n') * 50
+        triangles = sum(mesh.triangleCount() for mesh in read(text))
+        self.assertEqual(triangles, 50 * (1 + 2 + 3 + 1))
+        for size in (7, 64, 1 << 22):
+            with mock.patch.object(wavefront, 'chunkSize', size):
+                self.assertEqual(
+                    wavefront.countTriangles(io.BytesIO(text)), triangles)
+
+    def testNoFaces(self):
+        self.assertEqual(wavefront.countTriangles(io.BytesIO(b'')), 0)
+        self.assertEqual(wavefront.countTriangles(io.BytesIO(square)), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -15,8 +15,16 @@ def colorprint(text: str, color: int) -> None:
 
 
 def prepareOutFilename(inFileName: str, resolution: int) -> str:
-    utf8bytes: bytes = (inFileName + str(resolution)).encode("utf8")
-    hash_object = hashlib.md5(utf8bytes)
+    return prepareOutFilenameFromParts([inFileName], resolution)
+
+
+def prepareOutFilenameFromParts(parts, resolution: int) -> str:
+    """prepareOutFilename of the concatenated parts, hashed one after
+    another instead of concatenating them."""
+    hash_object = hashlib.md5()
+    for part in parts:
+        hash_object.update(part.encode("utf8"))
+    hash_object.update(str(resolution).encode("utf8"))
     result: str = "AO_" + hash_object.hexdigest()
     return result
 
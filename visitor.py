@@ -1,8 +1,32 @@
+import math
+from collections import Counter
+
 import glm
+import numpy
 
 import scene
 
 
+def toArray(m) -> numpy.ndarray:
+    """Converts a column-major glm matrix into a row-major NumPy array."""
+    n = len(m)
+    return numpy.array([[m[c][r] for c in range(n)] for r in range(n)])
+
+
+def normalized(v: numpy.ndarray) -> numpy.ndarray:
+    """Unit length rows of v, zero rows stay zero."""
+    l = numpy.linalg.norm(v, axis=-1, keepdims=True)
+    return numpy.divide(v, l, out=numpy.zeros_like(v), where=l > 0)
+
+
+def normalMatrix(tf: glm.mat4) -> glm.mat3:
+    """Inverse-transpose of the linear part of tf, used for normals."""
+    linear = glm.mat3(tf)
+    if glm.determinant(linear) == 0:
+        return linear
+    return glm.transpose(glm.inverse(linear))
+
+
 class SceneVisitor:
     def visit_SceneNode(self, node: scene.SceneNode, direction: str):
         pass
@@ -34,7 +58,7 @@ class TriCounter(SceneVisitor):
     def visit_Mesh(self, mesh: scene.Mesh, direction: str):
         if direction != 'forward' or self.disable:
             return
-        self.count += len(mesh.triangles)
+        self.count += mesh.triangleCount()
         # self.disable = True
 
 
@@ -69,6 +93,260 @@ class SimplePacker(object):
         return M
 
 
+class MeshAreas(SceneVisitor):
+    """Collects per visited mesh its world-space area, the area of its
+    global UVs, their bounds (umin, vmin, umax, vmax) and the object it
+    belongs to, in the order TransformedTriExtractor asks its packer for
+    buckets."""
+    def __init__(self, globalTf=glm.mat4(1)):
+        self.tfStack = []
+        self.groupStack = []
+        self.tf = globalTf
+        self.disable = False
+        self.areas = []
+        self.uvAreas = []
+        self.uvBounds = []
+        self.names = []
+
+    def visit_Group(self, group: scene.Group, direction: str):
+        if self.disable:
+            return
+
+        if direction == 'forward':
+            self.tfStack.append(self.tf)
+            self.groupStack.append(group.name)
+            self.tf = self.tf * group.transform
+        else:
+            self.tf = self.tfStack.pop()
+            self.groupStack.pop()
+
+    def visit_Mesh(self, mesh: scene.Mesh, direction: str):
+        if self.disable or direction != 'forward':
+            return
+
+        # the object name of TransformedTriExtractor.visit_Mesh
+        self.names.append(self.groupStack[max(len(self.groupStack) - 2, 0)])
+
+        if isinstance(mesh, scene.ArrayMesh):
+            vertices = mesh.corners('vertices')
+            uvs = mesh.corners('globalUVs')
+        else:
+            vertices = numpy.array([[list(v) for v in tri.vertices]
+                                    for tri in mesh.triangles]).reshape(
+                                        -1, 3, 3)
+            uvs = None
+            if all(tri.globalUVs is not None for tri in mesh.triangles):
+                uvs = numpy.array([[list(t) for t in tri.globalUVs]
+                                   for tri in mesh.triangles]).reshape(
+                                       -1, 3, 2)
+
+        M = toArray(self.tf)
+        vo = vertices @ M[:3, :3].T + M[:3, 3]
+        w = vertices @ M[3, :3] + M[3, 3]
+        self.areas.append(triangleArea(vo / w[..., None]))
+
+        if uvs is None or len(uvs) == 0:
+            self.uvAreas.append(0.0)
+            self.uvBounds.append(None)
+        else:
+            flat = uvs.reshape(-1, 2)
+            self.uvAreas.append(triangleArea(uvs))
+            self.uvBounds.append(flat.min(axis=0).tolist() +
+                                 flat.max(axis=0).tolist())
+
+
+def triangleArea(corners: numpy.ndarray) -> float:
+    """Summed area of (n, 3, 2) or (n, 3, 3) triangle corners."""
+    e1 = corners[:, 1] - corners[:, 0]
+    e2 = corners[:, 2] - corners[:, 0]
+    if corners.shape[-1] == 2:
+        return 0.5 * float(numpy.abs(e1[:, 0] * e2[:, 1] -
+                                     e1[:, 1] * e2[:, 0]).sum())
+    return 0.5 * float(numpy.linalg.norm(numpy.cross(e1, e2), axis=-1).sum())
+
+
+class AreaPacker(object):
+    """Packs one tile per mesh, sized by the world-space area of the mesh so
+    that all meshes get about the same texel density.
+
+    The tiles are fitted to the global UV bounds of the meshes and placed
+    on shelves, tallest first, at the largest scale for which all of them
+    fit into the atlas. Meshes without global UVs get no bucket; so do
+    meshes that do not fit at the minimum tile size.
+
+    Given the placement of a previous packing of the same scene, meshes of
+    the same size keep their tiles and only the others are placed into the
+    free space at the previous scale, so incremental bakes can reuse the
+    AO of unchanged objects. The meshes are told apart by the names of
+    their objects. If the free space is too small, all tiles are packed
+    again.
+    """
+    def __init__(self,
+                 areas: list,
+                 uvAreas: list,
+                 uvBounds: list,
+                 pixelSize: int,
+                 padding: int = 2,
+                 minSize: int = 4,
+                 names: list = None,
+                 placement: dict = None):
+        self.i = 0
+        self.pixelSize = pixelSize
+        self.padding = padding
+        self.minSize = minSize
+        self.scale = 0.0
+
+        # tile extent in world units, for the bounds of the UVs
+        self.extents = []
+        for area, uvArea, bounds in zip(areas, uvAreas, uvBounds):
+            if bounds is None or area <= 0:
+                self.extents.append(None)
+                continue
+            bw = max(bounds[2] - bounds[0], 1e-6)
+            bh = max(bounds[3] - bounds[1], 1e-6)
+            boxArea = area * bw * bh / (uvArea if uvArea > 0 else bw * bh)
+            self.extents.append((math.sqrt(boxArea * bw / bh),
+                                 math.sqrt(boxArea * bh / bw)))
+        self.order = sorted(
+            (i for i, e in enumerate(self.extents) if e is not None),
+            key=lambda i: -self.extents[i][1])
+        self.uvBounds = uvBounds
+
+        # n-th mesh of an object, stable while other objects change
+        names = names or [str(i) for i in range(len(areas))]
+        seen = Counter()
+        self.keys = []
+        for name in names:
+            self.keys.append('{}#{}'.format(name, seen[name]))
+            seen[name] += 1
+
+        self.tiles = None
+        if placement is not None:
+            self.tiles = self.refit(placement)
+        if self.tiles is None:
+            self.tiles = self.fit()
+
+    def size(self, i: int, scale: float):
+        limit = self.pixelSize - self.padding
+        ex, ey = self.extents[i]
+        return (min(max(math.ceil(scale * ex), self.minSize), limit),
+                min(max(math.ceil(scale * ey), self.minSize), limit))
+
+    def pack(self, scale: float):
+        """Pixel rectangles (x, y, w, h) of the tiles at the given scale in
+        pixels per world unit, None for tiles that do not fit."""
+        limit = self.pixelSize - self.padding
+        tiles = [None] * len(self.extents)
+        x = y = shelf = 0
+        fits = True
+        for i in self.order:
+            w, h = self.size(i, scale)
+            if x + w > limit:
+                x, y, shelf = 0, y + shelf + self.padding, 0
+            if y + h > limit:
+                fits = False
+                continue
+            tiles[i] = (x, y, w, h)
+            x += w + self.padding
+            shelf = max(shelf, h)
+        return tiles, fits
+
+    def fit(self) -> list:
+        self.scale = 0.0
+        if not self.order:
+            return [None] * len(self.extents)
+        lower = 0.0
+        upper = self.pixelSize / max(max(e) for e in self.extents if e)
+        tiles, fits = self.pack(lower)
+        if not fits:
+            return tiles
+        for _ in range(40):
+            scale = 0.5 * (lower + upper)
+            candidate, fits = self.pack(scale)
+            if fits:
+                lower, tiles = scale, candidate
+            else:
+                upper = scale
+        self.scale = lower
+        return tiles
+
+    def refit(self, placement: dict):
+        """Tiles keeping the previous placement, None if the other meshes
+        do not fit into the free space."""
+        scale, previous = placement["scale"], placement["tiles"]
+        # occupied pixels, every tile blocks the padding right and below it
+        occupied = numpy.zeros((self.pixelSize, self.pixelSize), dtype=bool)
+        tiles = [None] * len(self.extents)
+        pending = []
+        for i in self.order:
+            w, h = self.size(i, scale)
+            tile = previous.get(self.keys[i])
+            if tile is not None and tuple(tile[2:]) == (w, h):
+                x, y = tile[0], tile[1]
+                tiles[i] = (x, y, w, h)
+                occupied[y:y + h + self.padding, x:x + w + self.padding] = True
+            else:
+                pending.append(i)
+
+        for i in pending:
+            w, h = self.size(i, scale)
+            spot = freeSpot(occupied, w + self.padding, h + self.padding)
+            if spot is None:
+                return None
+            x, y = spot
+            tiles[i] = (x, y, w, h)
+            occupied[y:y + h + self.padding, x:x + w + self.padding] = True
+        self.scale = scale
+        return tiles
+
+    def placement(self) -> dict:
+        """Scale and tiles of the packing, to be passed to the packer of
+        the next bake of the scene."""
+        return {
+            "scale": self.scale,
+            "tiles": {
+                key: list(tile)
+                for key, tile in zip(self.keys, self.tiles)
+                if tile is not None
+            }
+        }
+
+    def bucket(self):
+        if self.i >= len(self.tiles):
+            return None
+        tile, bounds = self.tiles[self.i], self.uvBounds[self.i]
+        self.i += 1
+        if tile is None:
+            return None
+
+        # maps the UV bounds of the mesh onto its tile
+        x, y, w, h = (v / self.pixelSize for v in tile)
+        sx = w / max(bounds[2] - bounds[0], 1e-6)
+        sy = h / max(bounds[3] - bounds[1], 1e-6)
+        M = glm.mat3(sx, 0, 0, 0, sy, 0, 0, 0, 1)
+        M[2][0] = x - sx * bounds[0]
+        M[2][1] = y - sy * bounds[1]
+        return M
+
+
+def freeSpot(occupied: numpy.ndarray, w: int, h: int):
+    """Top-most, then left-most (x, y) of a free w x h rectangle of the
+    occupied pixels, None if there is none."""
+    size = occupied.shape[0]
+    if w > size or h > size:
+        return None
+    # occupied pixels in every w x h window from a summed-area table
+    table = numpy.zeros((size + 1, size + 1), dtype=numpy.int32)
+    table[1:, 1:] = occupied.cumsum(axis=0, dtype=numpy.int32).cumsum(axis=1)
+    windows = table[h:, w:] - table[:-h, w:] - table[h:, :-w] + \
+        table[:-h, :-w]
+    free = numpy.flatnonzero(windows == 0)
+    if len(free) == 0:
+        return None
+    y, x = divmod(int(free[0]), windows.shape[1])
+    return x, y
+
+
 class TransformedTriExtractor(SceneVisitor):
     def __init__(self,
                  vertices,
@@ -81,11 +359,14 @@ class TransformedTriExtractor(SceneVisitor):
         self.normals = normals
         self.texcoord = texcoord
         self.tfStack = []
+        self.groupStack = []
         self.tf = globalTf
         self.idx = startIdx
         self.disable = False
         self.packer = packer
         self.mapping = {}
+        self.ranges = {}
+        self.tiles = {}
 
     def visit_Group(self, group: scene.Group, direction: str):
         if self.disable:
@@ -93,9 +374,11 @@ class TransformedTriExtractor(SceneVisitor):
 
         if direction == 'forward':
             self.tfStack.append(self.tf)
+            self.groupStack.append(group.name)
             self.tf = self.tf * group.transform
         else:
             self.tf = self.tfStack.pop()
+            self.groupStack.pop()
 
     def visit_Mesh(self, mesh: scene.Mesh, direction: str):
         if self.disable:
@@ -103,22 +386,75 @@ class TransformedTriExtractor(SceneVisitor):
         if direction != 'forward':
             return
 
-        # print("visitting mesh {} with geometry {}".format(
-        #     mesh.parent.parent.name, mesh.parent.name))
-        hasGlobalUVs = False
-        for tri in mesh.triangles:
-            if tri.globalUVs is not None:
-                hasGlobalUVs = True
+        # instanced meshes share their parent links, so the owning object
+        # is taken from the traversal: object group -> geometry group -> mesh
+        objectName = self.groupStack[max(len(self.groupStack) - 2, 0)]
 
-        # print("   {}".format(hasGlobalUVs))
-
-        # if hasGlobalUVs:
+        # print("visitting mesh {} with geometry {}".format(
+        #     objectName, self.groupStack[-1]))
         uvTf = self.packer.bucket()
         if uvTf is not None:
             allEntries = [x for col in uvTf for x in col]
             # print("   allEntries")
             # print("   {}".format(allEntries))
-            self.mapping[mesh.parent.parent.name] = allEntries
+            self.mapping[objectName] = allEntries
+
+        start = self.idx
+        if isinstance(mesh, scene.ArrayMesh):
+            self.extractArrays(mesh, uvTf)
+        else:
+            self.extractTriangles(mesh, uvTf)
+        self.ranges.setdefault(objectName, []).append((start, self.idx))
+        if uvTf is not None and self.idx > start:
+            # atlas UV rectangle (umin, vmin, umax, vmax) the mesh ended up in
+            uvs = numpy.asarray(self.texcoord[start:self.idx]).reshape(-1, 2)
+            self.tiles.setdefault(objectName, []).append(
+                uvs.min(axis=0).tolist() + uvs.max(axis=0).tolist())
+        # self.disable = True
+
+    def extractArrays(self, mesh: scene.ArrayMesh, uvTf):
+        # transform whole attribute arrays at once; indexed meshes are
+        # transformed per shared vertex and expanded into the output slice
+        count = mesh.triangleCount()
+        out = slice(self.idx, self.idx + count)
+
+        def expand(array, target):
+            if mesh.indices is None:
+                target[out] = array
+            else:
+                numpy.take(array.astype(target.dtype, copy=False),
+                           mesh.indices,
+                           axis=0,
+                           out=target[out])
+
+        # float32 like the outputs, float64 temporaries would double the
+        # memory used per mesh
+        M = toArray(self.tf).astype(numpy.float32)
+        vo = mesh.vertices @ M[:3, :3].T + M[:3, 3]
+        w = mesh.vertices @ M[3, :3] + M[3, 3]
+        expand(vo / w[..., None], self.vertices)
+
+        if self.normals is not None and mesh.normals is not None:
+            N = toArray(normalMatrix(self.tf)).astype(numpy.float32)
+            expand(normalized(mesh.normals @ N.T), self.normals)
+        elif self.normals is not None:
+            # face normals of the transformed triangles for every corner
+            tris = self.vertices[out]
+            faceNormals = normalized(
+                numpy.cross(tris[:, 1] - tris[:, 0], tris[:, 2] - tris[:, 0]))
+            self.normals[out] = faceNormals[:, None]
+
+        if mesh.globalUVs is None or uvTf is None:
+            self.texcoord[out] = 1.0
+        else:
+            T = toArray(uvTf).astype(numpy.float32)
+            to = mesh.globalUVs @ T[:, :2].T + T[:, 2]
+            expand(to[..., :2] / to[..., 2:], self.texcoord)
+
+        self.idx += count
+
+    def extractTriangles(self, mesh: scene.Mesh, uvTf):
+        normalTf = normalMatrix(self.tf)
 
         # print("   {}".format(mesh.triangles[0].globalUVs))
         for tri in mesh.triangles:
@@ -128,13 +464,14 @@ class TransformedTriExtractor(SceneVisitor):
                 vo = self.tf * vi
                 for i in range(3):
                     self.vertices[self.idx, k, i] = vo[i] / vo[3]
-                if tri.normals is not None:
-                    ni = glm.vec4(tri.normals[k], 0.0)
-                    no = self.tf * ni
+                if self.normals is not None and tri.normals is not None:
+                    no = normalTf * glm.vec3(tri.normals[k])
                     l = glm.length(no)
                     if l > 0:
                         for i in range(3):
                             self.normals[self.idx, k, i] = no[i] / l
+                    else:
+                        self.normals[self.idx, k, :] = 0.0
                 if tri.globalUVs is None or uvTf is None:
                     self.texcoord[self.idx, k, :] = [1.0, 1.0]
                 else:
@@ -143,5 +480,9 @@ class TransformedTriExtractor(SceneVisitor):
                     for i in range(2):
                         self.texcoord[self.idx, k, i] = to[i] / to[2]
 
+            if self.normals is not None and tri.normals is None:
+                v0, v1, v2 = self.vertices[self.idx]
+                self.normals[self.idx] = normalized(numpy.cross(v1 - v0,
+                                                                v2 - v0))
+
             self.idx += 1
-        # self.disable = True
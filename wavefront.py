@@ -1,94 +1,248 @@
-import glm
+import numpy
 import scene
 
+# bytes read per chunk; bounds the memory used besides the results
+chunkSize = 1 << 22
+
+whitespace = numpy.zeros(256, dtype=bool)
+whitespace[[ord(c) for c in ' \t\r\n']] = True
+
+
+def parseFloats(text: bytes, keyword: bytes, count: int,
+                width: int) -> numpy.ndarray:
+    """(count, width) float32 array of the first width values of count
+    lines starting with keyword."""
+    values = numpy.fromstring(text.replace(keyword, b' '),
+                              dtype=numpy.float32,
+                              sep=' ')
+    if values.size == width * count:
+        return values.reshape(-1, width)
+
+    # optional values (w, colors) on some lines, parse them one by one
+    result = numpy.zeros((count, width), dtype=numpy.float32)
+    for i, line in enumerate(text.split(b'\n')[:count]):
+        row = line.split()[1:width + 1]
+        result[i, :len(row)] = [float(v) for v in row]
+    return result
+
+
+def parseCorners(text: bytes, count: int):
+    """Corner indices (vertex, texcoord, normal; 0 where missing) of count
+    face lines as an (n, 3) int64 array, and the corner count per face."""
+    data = numpy.frombuffer(text, dtype=numpy.uint8)
+    # a token starts after whitespace; the first one of a line is 'f'
+    space = whitespace[data]
+    tokens = numpy.flatnonzero(~space & numpy.concatenate([[True],
+                                                           space[:-1]]))
+    lines = numpy.concatenate([[0], numpy.flatnonzero(data == ord('\n')) + 1])
+    counts = numpy.diff(numpy.searchsorted(tokens, lines[:count + 1])) - 1
+
+    first = text[tokens[1]:].split(None, 1)[0]
+    slashes = first.count(b'/')
+    double = b'//' in first
+    corners = counts.sum()
+    if slashes <= 2 and text.count(b'/') == corners * slashes and \
+            text.count(b'//') == (corners if double else 0):
+        values = numpy.fromstring(text.replace(b'f', b' ').replace(
+            b'//', b' 0 ').replace(b'/', b' '),
+                                  dtype=numpy.int64,
+                                  sep=' ')
+        width = slashes + 1
+        if values.size == corners * width:
+            result = numpy.zeros((corners, 3), dtype=numpy.int64)
+            result[:, :width] = values.reshape(-1, width)
+            return result, counts
+
+    # mixed corner formats, parse them one by one
+    result = []
+    for line in text.split(b'\n')[:count]:
+        for ref in line.split()[1:]:
+            result.append((list(map(int, [j or 0 for j in ref.split(b'/')])) +
+                           [0, 0])[:3])
+    return numpy.array(result, dtype=numpy.int64).reshape(-1, 3), counts
+
+
+def fanTriangles(counts: numpy.ndarray) -> numpy.ndarray:
+    """(n, 3) corner indices of the triangle fans of faces with the given
+    corner counts."""
+    starts = numpy.cumsum(counts) - counts
+    fans = numpy.maximum(counts - 2, 0)
+    face = numpy.repeat(numpy.arange(len(counts)), fans)
+    i = numpy.arange(len(face)) - numpy.repeat(numpy.cumsum(fans) - fans,
+                                               fans) + 1
+    first = starts[face]
+    return numpy.stack([first, first + i, first + i + 1], axis=1)
+
+
+def lineChunks(file):
+    """Chunks of about chunkSize bytes of whole lines of file, each ending
+    with a newline."""
+    rest = b''
+    while True:
+        data = file.read(chunkSize)
+        if not data:
+            break
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        data = rest + data
+        end = data.rfind(b'\n') + 1
+        rest = data[end:]
+        if end > 0:
+            yield data[:end]
+    if rest:
+        yield rest + b'\n'
+
+
+def faceTriangles(chunk: bytes) -> int:
+    """Triangles of the fans of the face lines of a chunk of whole lines,
+    counted from their tokens without parsing any index."""
+    data = numpy.frombuffer(chunk, dtype=numpy.uint8)
+    ends = numpy.flatnonzero(data == ord('\n'))
+    starts = numpy.concatenate([[0], ends[:-1] + 1])
+    second = data[numpy.minimum(starts + 1, len(data) - 1)]
+    faces = (data[starts] == ord('f')) & whitespace[second]
+
+    space = whitespace[data]
+    tokens = numpy.flatnonzero(~space & numpy.concatenate([[True],
+                                                           space[:-1]]))
+    counts = numpy.diff(
+        numpy.searchsorted(tokens, numpy.append(starts, len(data))))
+    # the keyword is a token too, faces of less than 3 corners add nothing
+    return int(numpy.maximum(counts[faces] - 3, 0).sum())
+
+
+def countTriangles(file) -> int:
+    """Triangles the Parser makes of the faces of an OBJ file."""
+    return sum(faceTriangles(chunk) for chunk in lineChunks(file))
 
-def readVec2(data):
-    v = [float(val) for val in data[0:2]]
-    return glm.vec2(*v)
 
+class Parser(object):
+    """Streaming OBJ reader producing one ArrayMesh per object.
 
-def readVec3(data):
-    v = [float(val) for val in data[0:3]]
-    return glm.vec3(*v)
-
+    The file is read in chunks of whole lines. The lines of a chunk are
+    classified by their keyword on the raw bytes, and all lines of a kind
+    are parsed at once by NumPy. Faces are triangulated as fans, negative
+    indices count back from the last element read before them.
+    """
+    V, VT, VN, F, O = range(1, 6)
 
-class Parser(object):
     def __init__(self, group):
-        self.vertices = [glm.vec3(0.0)]
-        self.normals = [glm.vec3(0.0)]
-        self.texcoords = [glm.vec2(0.0)]
-        self.mesh = None
+        self.vertices = []
+        self.normals = []
+        self.texcoords = []
+        # element counts so far, for negative indices
+        self.counts = numpy.zeros(3, dtype=numpy.int64)
+        self.meshes = []
         self.group = group
 
     def read_file(self, file):
-        for line in file:
-            self.parse(line)
-
-    def parse(self, line):
-        if line.startswith('#'):
+        for chunk in lineChunks(file):
+            self.parse(chunk)
+        self.finish()
+
+    def classify(self, data: numpy.ndarray, starts: numpy.ndarray):
+        """Kind of every line from its first two characters."""
+        first = data[starts]
+        second = data[numpy.minimum(starts + 1, len(data) - 1)]
+        separated = whitespace[second]
+        kinds = numpy.zeros(len(starts), dtype=numpy.uint8)
+        kinds[(first == ord('v')) & separated] = self.V
+        kinds[(first == ord('v')) & (second == ord('t'))] = self.VT
+        kinds[(first == ord('v')) & (second == ord('n'))] = self.VN
+        kinds[(first == ord('f')) & separated] = self.F
+        kinds[(first == ord('o')) & separated] = self.O
+        return kinds
+
+    def parse(self, chunk: bytes):
+        data = numpy.frombuffer(chunk, dtype=numpy.uint8)
+        ends = numpy.flatnonzero(data == ord('\n'))
+        starts = numpy.concatenate([[0], ends[:-1] + 1])
+        kinds = self.classify(data, starts)
+        byteKinds = numpy.repeat(kinds, ends - starts + 1)
+
+        def select(kind):
+            return data[byteKinds == kind].tobytes()
+
+        # counts of vertices, texcoords and normals up to every line
+        before = numpy.cumsum(numpy.stack(
+            [kinds == self.V, kinds == self.VT, kinds == self.VN], axis=1),
+                              axis=0) + self.counts
+        added = before[-1] - self.counts
+        self.counts = before[-1]
+
+        if added[0] > 0:
+            self.vertices.append(
+                parseFloats(select(self.V), b'v', added[0], 3))
+        if added[1] > 0:
+            self.texcoords.append(
+                parseFloats(select(self.VT), b'vt', added[1], 2))
+        if added[2] > 0:
+            self.normals.append(
+                parseFloats(select(self.VN), b'vn', added[2], 3))
+
+        start = len(self.meshes)
+        for i in numpy.flatnonzero(kinds == self.O):
+            name = chunk[starts[i] + 2:ends[i]].decode('utf-8').strip()
+            self.meshes.append((name, []))
+
+        faceLines = numpy.flatnonzero(kinds == self.F)
+        if len(faceLines) == 0:
             return
-
-        values = line.split()
-        if len(values) < 2:
-            return
-
-        attrib = 'parse_%s' % values[0]
-        args = values[1:]
-
-        if hasattr(self, attrib):
-            parse_function = getattr(self, attrib)
-            parse_function(args)
-        # else:
-        # print("unable to read line:", line)
-
-    def parse_v(self, args):
-        self.vertices.append(readVec3(args))
-
-    def parse_vn(self, args):
-        self.normals.append(readVec3(args))
-
-    def parse_vt(self, args):
-        self.texcoords.append(readVec2(args))
-
-    def parse_o(self, args):
-        self.mesh = scene.Mesh(args[0])
-        self.group.add(self.mesh)
-
-    def parse_f(self, args):
-        if self.mesh is None:
-            self.parse_o(['unnamed mesh'])
-
-        prim0 = scene.Triangle(*[glm.vec3(0.0), glm.vec3(0.0), glm.vec3(0.0)])
-        self.mesh.add(prim0)
-
-        for i, v in enumerate(args):
-            vidx, tidx, nidx = (list(map(int, [j or 0
-                                               for j in v.split('/')])) +
-                                [0, 0])[:3]
-
-            # wrap index around
-            if vidx < 0:
-                vidx = len(self.vertices) - vidx
-            if tidx < 0:
-                tidx = len(self.texcoords) - tidx
-            if nidx < 0:
-                nidx = len(self.normals) - nidx
-
-            if i < 3:
-                prim0.vertex(i, self.vertices[vidx], self.texcoords[tidx],
-                             self.normals[nidx])
-            elif i == 3:
-                # second triangle for quad face
-                prim1 = scene.Triangle(prim0.vertices[0], prim0.vertices[2],
-                                       self.vertices[vidx])
-                prim1.texcoords = [
-                    prim0.texcoords[0], prim0.texcoords[2],
-                    self.texcoords[tidx]
-                ]
-                prim1.normals = [
-                    prim0.normals[0], prim0.normals[2], self.normals[nidx]
-                ]
-                self.mesh.add(prim1)
+        corners, counts = parseCorners(select(self.F), len(faceLines))
+        faceOf = numpy.repeat(numpy.arange(len(counts)), counts)
+        negative = corners < 0
+        if negative.any():
+            # -1 is the last element read before the face
+            last = before[faceLines[faceOf]]
+            corners[negative] += last[negative] + 1
+
+        # faces belong to the last object started before them
+        meshOf = numpy.cumsum(kinds == self.O)[faceLines] + start - 1
+        if (meshOf < 0).any():
+            self.meshes.insert(0, ('unnamed mesh', []))
+            meshOf += 1
+
+        # 0 stands for a missing texcoord or normal, never for a vertex;
+        # negative indices reaching back before the first element end there
+        invalid = (corners[:, 0] <= 0) | (negative &
+                                          (corners <= 0)).any(axis=1)
+        if invalid.any():
+            name = self.meshes[meshOf[faceOf[numpy.argmax(invalid)]]][0]
+            raise ValueError("face index out of range in " + name)
+
+        triangles = fanTriangles(counts)
+        triangleMesh = meshOf[faceOf[triangles[:, 0]]]
+        for mesh in numpy.unique(triangleMesh):
+            self.meshes[mesh][1].append(
+                corners[triangles[triangleMesh == mesh]].astype(numpy.int32))
+
+    def finish(self):
+        def attribute(arrays, width):
+            # index 0 is the missing element
+            return numpy.concatenate([numpy.zeros((1, width), numpy.float32)] +
+                                     arrays)
+
+        vertices = attribute(self.vertices, 3)
+        texcoords = attribute(self.texcoords, 2)
+        normals = attribute(self.normals, 3)
+
+        for name, parts in self.meshes:
+            if len(parts) == 0:
+                continue
+            corners = numpy.concatenate(parts)
+            sizes = [len(vertices), len(texcoords), len(normals)]
+            if (corners.reshape(-1, 3).max(axis=0) >= sizes).any():
+                raise ValueError("face index out of range in " + name)
+
+            mesh = scene.ArrayMesh(
+                name,
+                vertices[corners[..., 0]],
+                normals=normals[corners[..., 2]] if len(normals) > 1 else None,
+                texcoords=texcoords[corners[..., 1]]
+                if len(texcoords) > 1 else None)
+            mesh.parent = self.group
+            self.group.add(mesh)
+        self.meshes = []
 
 
 def read(group, file):